@@ -0,0 +1,226 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# Minimal MQTT 3.1.1 broker stand-in for benchmarks.
+#
+# It accepts any client, acknowledges CONNECT, SUBSCRIBE, PINGREQ and
+# QoS 1/2 PUBLISH packets, and records every published message as a
+# (time, topic, payload) tuple instead of routing it.
+# Nothing is ever delivered to subscribers.
+#
+# Broker and its connections are readable objects, so they run in any
+# ema.server.Server reactor next to the EMA simulator.
+#
+# ======================================================================
+
+import time
+import socket
+import struct
+import logging
+
+log = logging.getLogger('broker')
+
+# Control packet types
+CONNECT     = 1
+CONNACK     = 2
+PUBLISH     = 3
+PUBACK      = 4
+PUBREC      = 5
+PUBREL      = 6
+PUBCOMP     = 7
+SUBSCRIBE   = 8
+SUBACK      = 9
+UNSUBSCRIBE = 10
+UNSUBACK    = 11
+PINGREQ     = 12
+PINGRESP    = 13
+DISCONNECT  = 14
+
+
+
+def packet(ptype, body, flags=0):
+    '''Builds a control packet with its remaining length header'''
+    n, length = len(body), ''
+    while True:
+        n, digit = n >> 7, n & 0x7F
+        length += chr(digit | 0x80 if n else digit)
+        if not n:
+            break
+    return chr(ptype << 4 | flags) + length + body
+
+
+
+def parse(buffer):
+    '''
+    Returns (type, flags, body, size) of the first complete packet
+    in buffer or None if more data is needed.
+    '''
+    n, shift, i = 0, 0, 1
+    while True:
+        if i >= len(buffer):
+            return None
+        digit = ord(buffer[i])
+        n |= (digit & 0x7F) << shift
+        shift += 7
+        i += 1
+        if not digit & 0x80:
+            break
+    if len(buffer) < i + n:
+        return None
+    first = ord(buffer[0])
+    return (first >> 4, first & 0x0F, buffer[i:i+n], i+n)
+
+
+
+class Connection(object):
+    '''A client connection to the broker'''
+
+    MAXREAD = 65536
+
+    def __init__(self, broker, sock, address):
+        self.broker  = broker
+        self.sock    = sock
+        self.address = address
+        self.buffer  = ''
+        self.sock.setblocking(False)
+
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+    def onInput(self):
+        try:
+            data = self.sock.recv(Connection.MAXREAD)
+        except socket.error:
+            data = ''
+        if not data:
+            self.close()
+            return
+        self.buffer += data
+        while True:
+            result = parse(self.buffer)
+            if result is None:
+                break
+            ptype, flags, body, size = result
+            self.buffer = self.buffer[size:]
+            self.handle(ptype, flags, body)
+
+
+    def handle(self, ptype, flags, body):
+        if ptype == CONNECT:
+            self.send(packet(CONNACK, '\x00\x00'))
+        elif ptype == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            n   = struct.unpack('!H', body[:2])[0]
+            topic, i = body[2:2+n], 2+n
+            if qos:
+                pid, i = body[i:i+2], i+2
+                self.send(packet(PUBACK if qos == 1 else PUBREC, pid))
+            self.broker.record(topic, body[i:])
+        elif ptype == PUBREL:
+            self.send(packet(PUBCOMP, body[:2]))
+        elif ptype == SUBSCRIBE:
+            # one granted QoS 0 per topic filter
+            i, codes = 2, ''
+            while i < len(body):
+                n = struct.unpack('!H', body[i:i+2])[0]
+                i += 2 + n + 1
+                codes += '\x00'
+            self.send(packet(SUBACK, body[:2] + codes))
+        elif ptype == UNSUBSCRIBE:
+            self.send(packet(UNSUBACK, body[:2]))
+        elif ptype == PINGREQ:
+            self.send(packet(PINGRESP, ''))
+        elif ptype == DISCONNECT:
+            self.close()
+
+
+    def send(self, data):
+        # Acks are tiny, the socket buffer always has room for them
+        try:
+            self.sock.sendall(data)
+        except socket.error as e:
+            log.warning("%s: %s", self.address, e)
+            self.close()
+
+
+    def close(self):
+        if self.sock is None:
+            return
+        self.broker.drop(self)
+        self.sock.close()
+        self.sock = None
+
+
+
+class Broker(object):
+    '''Listens on host:port (port 0 picks a free one)'''
+
+    def __init__(self, server, host='127.0.0.1', port=0):
+        self.server   = server
+        self.messages = []      # (time, topic, payload)
+        self.clients  = []
+        self.sock     = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+        self.host, self.port = self.sock.getsockname()
+        self.listener = None
+        server.addReadable(self)
+        log.info("MQTT stand-in listening on %s:%d", self.host, self.port)
+
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+    def onInput(self):
+        try:
+            sock, address = self.sock.accept()
+        except socket.error:
+            return
+        conn = Connection(self, sock, address)
+        self.clients.append(conn)
+        self.server.addReadable(conn)
+
+
+    def drop(self, conn):
+        self.clients.remove(conn)
+        self.server.delReadable(conn)
+
+
+    def record(self, topic, payload):
+        now = time.time()
+        self.messages.append((now, topic, payload))
+        if self.listener is not None:
+            self.listener(now, topic, payload)
+
+
+    def close(self):
+        for conn in self.clients[:]:
+            conn.close()
+        self.server.delReadable(self)
+        self.sock.close()
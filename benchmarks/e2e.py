@@ -0,0 +1,431 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# End to end benchmark of the EMA daemon.
+#
+# For each status message rate, the daemon is started as a separate
+# process ('python -m ema') with a config file derived from the sample
+# one, attached to:
+#
+# 1) an EMA simulator (ema.sim) on a pseudo terminal, sending status
+#    messages at the given rate,
+# 2) a multicast UDP client, as a PC on the local network would be,
+# 3) a local MQTT broker stand-in (benchmarks/broker.py),
+# 4) a watcher of the generated HTML page.
+#
+# Each status message carries its sequence number in the wind
+# direction (seq % 360) and current wind speed (seq // 360) readings,
+# so that it can be recognized on every channel. The latency of a
+# channel is the time from the message being written to the pty until
+# it is first seen in that channel. HTML and MQTT latencies include
+# their publishing periods (html_period, 2*mqtt_period), UDP latency
+# is the true processing latency of onSerialMessage().
+# Above one message per publishing period, HTML and MQTT only show a
+# sample of the messages, so their 'ratio' of messages seen drops and
+# their latency is the age of the freshest reading when published.
+#
+# Once the daemon multicasts its first status message, it is measured
+# during 'duration' seconds (at least MINFRAMES messages): CPU time
+# (user + system, from /proc) per status message, peak RSS (VmHWM) and
+# the latency percentiles of each channel, along with how many of the
+# messages sent were seen. Results are printed as JSON.
+#
+# Latencies are measured with time.time(): ema.server.monotonic() may
+# fall back to clock tick (10 ms) resolution in Python 2.
+#
+# Run from the repository root, e.g.:
+#   python benchmarks/e2e.py --rates 1 50 200 --duration 20 -o out.json
+#
+# ======================================================================
+
+import os
+import re
+import sys
+import json
+import time
+import errno
+import shutil
+import signal
+import socket
+import struct
+import platform
+import tempfile
+import argparse
+import datetime
+import subprocess
+import ConfigParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ema.server    import Server, Lazy, monotonic
+from ema.serdriver import FRAME
+from ema.emaproto  import STATLEN, SPSB, StatusFrame
+from ema.sim       import Simulator
+from broker        import Broker
+
+RATES     = (0.2, 1, 10, 50, 100, 200, 500)
+CHANNELS  = ('udp', 'html', 'mqtt')
+MINFRAMES = 10
+MCAST_IP  = '225.100.20.15'
+
+SPEED     = re.compile('Velocidad del viento</td>\s*<td>([\d.]+) ')
+DIRECTION = re.compile('Direcci\xc3\xb3n del viento</td>\s*<td>([\d.]+) ')
+
+
+
+def tag(status):
+    '''Sequence number stamped in a status message'''
+    return status.windcurrent * 360 + status.winddir
+
+
+
+class TaggedSimulator(Simulator):
+    '''Simulator stamping a sequence number in every status message'''
+
+    def __init__(self, rate):
+        Simulator.__init__(self, rate, seed=0)
+        self.sent = {}      # seq -> time of writing
+
+    def frame(self):
+        seq    = self.nframes
+        status = self.nextStatus()._replace(windcurrent=(seq // 360) % 10000, winddir=seq % 360)
+        self.sent[seq] = time.time()
+        return status.encode()
+
+
+
+class Probe(object):
+    '''Latencies of status messages in each channel'''
+
+    def __init__(self, sim):
+        self.sim     = sim
+        self.first   = None     # seq measured are (first, last]
+        self.last    = None
+        self.ready   = False    # daemon published something
+        self.seen    = dict((ch, set()) for ch in CHANNELS)
+        self.latency = dict((ch, []) for ch in CHANNELS)
+
+
+    def start(self):
+        self.first, self.last = self.sim.nframes, None
+
+
+    def stop(self):
+        self.last = self.sim.nframes
+
+
+    def observe(self, channel, seq, now):
+        self.ready = True
+        seen = self.seen[channel]
+        if seq in seen:
+            return
+        seen.add(seq)
+        if self.first is None or seq <= self.first or (self.last is not None and seq > self.last):
+            return
+        self.latency[channel].append(now - self.sim.sent[seq])
+
+
+    def results(self):
+        n = self.last - self.first
+        result = {}
+        for ch in CHANNELS:
+            samples = sorted(self.latency[ch])
+            result[ch] = summary(samples)
+            result[ch]['seen'] = len(samples)
+            result[ch]['ratio'] = round(float(len(samples)) / n, 4) if n else None
+        return result
+
+
+
+def summary(samples):
+    '''Latency percentiles in milliseconds of a sorted list of seconds'''
+    if not samples:
+        return {'n': 0}
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))]
+    ms   = lambda x: round(1000 * x, 3)
+    return {
+        'n'    : len(samples),
+        'mean' : ms(sum(samples) / len(samples)),
+        'p50'  : ms(pick(0.50)),
+        'p90'  : ms(pick(0.90)),
+        'p99'  : ms(pick(0.99)),
+        'max'  : ms(samples[-1]),
+    }
+
+
+
+class UDPClient(object):
+    '''Multicast listener of status messages relayed by the daemon'''
+
+    def __init__(self, probe, port, ip=MCAST_IP):
+        self.probe = probe
+        self.sock  = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', port))
+        mreq = struct.pack("4sl", socket.inet_aton(ip), socket.INADDR_ANY)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        self.sock.setblocking(False)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def onInput(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error:
+            return
+        now = time.time()
+        for matched in FRAME.finditer(data):
+            message = matched.group()
+            if len(message) == STATLEN:
+                self.probe.observe('udp', tag(StatusFrame.decode(message)), now)
+
+    def close(self):
+        self.sock.close()
+
+
+
+class HTMLWatcher(Lazy):
+    '''Polls the generated HTML page for a new current wind reading'''
+
+    PERIOD = 0.01
+
+    def __init__(self, probe, path):
+        Lazy.__init__(self, HTMLWatcher.PERIOD)
+        self.probe = probe
+        self.path  = path
+        self.stamp = None
+
+    def work(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        stamp = (st.st_ino, st.st_mtime)
+        if stamp == self.stamp:
+            return
+        now = time.time()
+        self.stamp = stamp
+        with open(self.path) as page:
+            text = page.read()
+        speed, direction = SPEED.search(text), DIRECTION.search(text)
+        if speed and direction:
+            seq = int(round(float(speed.group(1)) * 10)) * 360 + int(float(direction.group(1)))
+            self.probe.observe('html', seq, now)
+
+
+
+def mqttListener(probe):
+    '''Broker callback picking the raw status messages'''
+    def listener(now, topic, payload):
+        if not topic.endswith('/current/status'):
+            return
+        line = payload.split('\n')[0]
+        if len(line) != STATLEN + 2:
+            return          # '()', nothing new since last publish
+        message = line[:SPSB] + chr(int(line[SPSB:SPSB+3])) + line[SPSB+3:]
+        probe.observe('mqtt', tag(StatusFrame.decode(message)), now)
+    return listener
+
+
+
+def configure(opts, sim, broker, workdir):
+    '''Writes the daemon config file, derived from the sample one'''
+    parser = ConfigParser.RawConfigParser()
+    parser.read(os.path.join(ROOT, 'config'))
+    parser.set('GENERIC', 'sync',          str(opts.sync))
+    parser.set('GENERIC', 'reactor',       opts.reactor)
+    parser.set('SERIAL',  'serial_port',   sim.port)
+    parser.set('UDP',     'udp_tx_port',   str(opts.udp_port))
+    parser.set('UDP',     'udp_rx_port',   str(opts.udp_port - 1))
+    parser.set('UDP',     'mcast_enabled', 'True')
+    parser.set('UDP',     'mcast_ip',      MCAST_IP)
+    parser.set('MQTT',    'mqtt_host',     broker.host)
+    parser.set('MQTT',    'mqtt_port',     str(broker.port))
+    parser.set('MQTT',    'mqtt_period',   str(opts.mqtt_period))
+    parser.set('MQTT',    'mqtt_publish_status',  'yes')
+    parser.set('MQTT',    'mqtt_publish_history', 'no')
+    parser.set('MQTT',    'mqtt_publish_mode',    opts.mqtt_mode)
+    parser.set('MQTT',    'mqtt_deadband',        str(opts.mqtt_deadband))
+    parser.set('HTML',    'html_file',     os.path.join(workdir, 'ema.html'))
+    parser.set('HTML',    'html_period',   str(opts.html_period))
+    path = os.path.join(workdir, 'ema.cfg')
+    with open(path, 'w') as cfg:
+        parser.write(cfg)
+    return path
+
+
+# ------------------------
+# Daemon process accounting
+# ------------------------
+
+TICKS = float(os.sysconf('SC_CLK_TCK'))
+
+def cputime(pid):
+    '''User + system CPU seconds of process pid'''
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / TICKS
+
+
+def peakrss(pid):
+    '''Peak resident set size (kB) of process pid'''
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return None
+
+
+# -----------
+# A whole run
+# -----------
+
+def run(opts, rate):
+    workdir = tempfile.mkdtemp(prefix='ema-bench-')
+    server  = Server()
+    server.setReactor('epoll')
+    sim     = TaggedSimulator(rate)
+    probe   = Probe(sim)
+    broker  = Broker(server)
+    broker.listener = mqttListener(probe)
+    udp     = UDPClient(probe, opts.udp_port)
+    html    = HTMLWatcher(probe, os.path.join(workdir, 'ema.html'))
+    server.addReadable(sim)
+    server.addLazy(sim)
+    server.addReadable(udp)
+    server.addLazy(html)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ROOT] + filter(None, [env.get('PYTHONPATH')]))
+    logfile = os.path.join(workdir, 'ema.log')
+    daemon  = subprocess.Popen([sys.executable, '-m', 'ema', '-c', configure(opts, sim, broker, workdir),
+                                '-l', logfile], cwd=ROOT, env=env)
+    try:
+        # Warm up until the daemon relays status messages
+        deadline = monotonic() + opts.warmup
+        while not probe.ready:
+            if daemon.poll() is not None:
+                raise RuntimeError("EMA daemon exited with code %d, see %s" % (daemon.returncode, logfile))
+            if monotonic() > deadline:
+                raise RuntimeError("EMA daemon not ready after %g s, see %s" % (opts.warmup, logfile))
+            server.step(0.05)
+        duration = max(opts.duration, MINFRAMES / rate)
+        probe.start()
+        cpu0, t0 = cputime(daemon.pid), monotonic()
+        while monotonic() < t0 + duration:
+            server.step(0.05)
+        probe.stop()
+        if daemon.poll() is not None:
+            raise RuntimeError("EMA daemon exited with code %d, see %s" % (daemon.returncode, logfile))
+        cpu1, t1 = cputime(daemon.pid), monotonic()
+        rss = peakrss(daemon.pid)
+        # Let the slowest channels catch up with the last messages
+        drain = monotonic() + opts.html_period + 2 * opts.mqtt_period + 1
+        while monotonic() < drain:
+            server.step(0.05)
+    finally:
+        if daemon.poll() is None:
+            daemon.send_signal(signal.SIGINT)
+            for i in range(50):
+                if daemon.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                daemon.kill()
+                daemon.wait()
+        broker.close()
+        udp.close()
+        sim.close()
+        if not opts.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    frames = probe.last - probe.first
+    result = {
+        'rate'            : rate,
+        'duration'        : round(t1 - t0, 3),
+        'frames'          : frames,
+        'overrun'         : sim.noverrun,
+        'cpu_s'           : round(cpu1 - cpu0, 3),
+        'cpu_load'        : round((cpu1 - cpu0) / (t1 - t0), 4),
+        'cpu_per_frame_ms': round(1000 * (cpu1 - cpu0) / frames, 4) if frames else None,
+        'peak_rss_kb'     : rss,
+        'mqtt_messages'   : len(broker.messages),
+        'mqtt_bytes'      : sum(len(topic) + len(payload) for t, topic, payload in broker.messages),
+        'latency_ms'      : probe.results(),
+    }
+    return result
+
+
+
+def meta(opts):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                         stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'date'       : datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'commit'     : commit,
+        'python'     : platform.python_version(),
+        'platform'   : platform.platform(),
+        'reactor'    : opts.reactor,
+        'sync'       : opts.sync,
+        'html_period': opts.html_period,
+        'mqtt_period': opts.mqtt_period,
+        'mqtt_mode'  : opts.mqtt_mode,
+    }
+
+
+
+def parser():
+    _parser = argparse.ArgumentParser(prog='e2e', description='EMA daemon end to end benchmark')
+    _parser.add_argument('-r', '--rates', type=float, nargs='+', default=RATES, metavar='<Hz>', help='status message rates')
+    _parser.add_argument('-d', '--duration', type=float, default=30, help='seconds measured per rate (default 30)')
+    _parser.add_argument('-w', '--warmup', type=float, default=120, help='max. seconds waiting for the daemon (default 120)')
+    _parser.add_argument('--reactor', type=str, default='epoll', choices=('select', 'epoll', 'asyncio'), help='daemon reactor')
+    _parser.add_argument('--sync', action='store_true', help='synchronize parameters at daemon startup')
+    _parser.add_argument('--html-period', type=float, default=0.5, help='html_period in seconds (default 0.5)')
+    _parser.add_argument('--mqtt-period', type=int, default=1, help='mqtt_period in seconds (default 1)')
+    _parser.add_argument('--mqtt-mode', type=str, default='keys', choices=('keys', 'delta', 'snapshot'), help='mqtt_publish_mode (default keys)')
+    _parser.add_argument('--mqtt-deadband', type=float, default=0, help='mqtt_deadband in delta mode (default 0)')
+    _parser.add_argument('--udp-port', type=int, default=21025, help='udp_tx_port, udp_rx_port is the one below')
+    _parser.add_argument('-k', '--keep', action='store_true', help='keep config, log and page of each run')
+    _parser.add_argument('-o', '--output', type=str, default=None, metavar='<file>', help='JSON output file (default stdout)')
+    return _parser
+
+
+
+if __name__ == "__main__":
+
+    opts    = parser().parse_args()
+    results = []
+    for rate in opts.rates:
+        sys.stderr.write("rate %g Hz ...\n" % rate)
+        results.append(run(opts, rate))
+    report = json.dumps({'meta': meta(opts), 'results': results}, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print report
@@ -0,0 +1,159 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# asyncio flavour of the MQTT library handling in ema.mqttclient.
+#
+# With the asyncio reactor, MQTTClient hands its paho client to a
+# MQTTPublisher, which drives it from the asyncio loop instead of
+# through readable registration and loop_misc() calls from the
+# MQTTClient work(): the client socket is watched with add_reader(),
+# add_writer() is used only while paho has pending output, and the
+# loop_misc() keepalive housekeeping is done by the work() of this
+# native Lazy every second.
+#
+# publish() and will_set() behave as paho's, so that MQTTClient does
+# not depend on the reactor in use. paho callbacks set before are
+# still called. The connect() coroutine waits for the broker CONNACK,
+# so a broker accepting the TCP connection but not answering is seen
+# as a connection failure and retried by MQTTClient.
+# ======================================================================
+
+import logging
+
+import trollius as asyncio
+from   trollius import From, Return
+
+from ema.aio.server import Lazy
+
+log = logging.getLogger('mqtt')
+
+
+
+class MQTTPublisher(Lazy):
+
+    def __init__(self, client, loop=None):
+        Lazy.__init__(self, 1, loop)
+        self.__loop    = loop or asyncio.get_event_loop()
+        self.__mqtt    = client
+        self.__fd      = None
+        self.__connack = None
+        self.on_connect    = client.on_connect
+        self.on_disconnect = client.on_disconnect
+        client.on_connect    = self.__onConnect
+        client.on_disconnect = self.__onDisconnect
+
+
+    def will_set(self, *args, **kargs):
+        self.__mqtt.will_set(*args, **kargs)
+
+
+    def publish(self, *args, **kargs):
+        info = self.__mqtt.publish(*args, **kargs)
+        self.__flush()
+        return info
+
+    # -------------------
+    # Connection handling
+    # -------------------
+
+    @asyncio.coroutine
+    def connect(self, host, port=1883, keepalive=60):
+        '''
+        Connects to the broker and waits for CONNACK, at most keepalive
+        seconds. Returns its result code.
+        '''
+        self.__connack = asyncio.Future(loop=self.__loop)
+        self.__mqtt.connect(host, port, keepalive)
+        self.__fd = self.__mqtt.socket().fileno()
+        self.__loop.add_reader(self.__fd, self.__onReadable)
+        self.start()
+        self.__flush()
+        try:
+            rc = yield From(asyncio.wait_for(self.__connack, keepalive, loop=self.__loop))
+        except asyncio.TimeoutError:
+            self.__detach()
+            raise IOError("No CONNACK from MQTT Broker %s:%s" % (host, port))
+        raise Return(rc)
+
+
+    def run(self, host, port, keepalive, failed):
+        '''
+        Runs the connect() coroutine as a task, calling failed(exc)
+        on connection errors.
+        '''
+        def done(task):
+            try:
+                task.result()
+            except IOError as e:
+                self.__detach()
+                failed(e)
+        task = asyncio.ensure_future(self.connect(host, port, keepalive), loop=self.__loop)
+        task.add_done_callback(done)
+
+
+    def __onConnect(self, client, userdata, flags, rc):
+        if not self.__connack.done():
+            self.__connack.set_result(rc)
+        self.on_connect(client, userdata, flags, rc)
+
+
+    def __onDisconnect(self, client, userdata, rc):
+        self.__detach()
+        self.on_disconnect(client, userdata, rc)
+
+
+    def __detach(self):
+        self.stop()
+        if self.__fd is not None:
+            self.__loop.remove_reader(self.__fd)
+            self.__loop.remove_writer(self.__fd)
+            self.__fd = None
+
+    # ------------------------
+    # Loop driven paho library
+    # ------------------------
+
+    def __onReadable(self):
+        self.__mqtt.loop_read()
+        self.__flush()
+
+
+    def __onWritable(self):
+        self.__mqtt.loop_write()
+        self.__flush()
+
+
+    def work(self):
+        self.__mqtt.loop_misc()
+        self.__flush()
+
+
+    def __flush(self):
+        '''Watch for writability only while paho has pending output'''
+        if self.__fd is None:
+            return
+        if self.__mqtt.want_write():
+            self.__loop.add_writer(self.__fd, self.__onWritable)
+        else:
+            self.__loop.remove_writer(self.__fd)
@@ -0,0 +1,329 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# asyncio flavour of the SerialDriver.
+#
+# pyserial is only used to open and configure the port. Once opened,
+# its file descriptor is put in non blocking mode and SerialTransport
+# reads and writes it through the loop add_reader()/add_writer()
+# callbacks, so that a slow EMA never blocks the loop.
+#
+# SerialProtocol reassembles the byte stream into EMA messages with
+# the FrameDecoder and delivers all complete messages in each chunk.
+#
+# SerialDriver keeps the public interface of ema.serdriver.SerialDriver
+# (write, queueDelay, hold, addHandler) so that EMAServer and the
+# devices do not care which flavour is running. Pacing of output
+# messages is done by a sender coroutine which waits for messages
+# in the queue instead of polling it every Server.TIMEOUT, sleeping
+# the adaptive gap given by the same Pacer as ema.serdriver.
+#
+# ======================================================================
+
+import os
+import fcntl
+import errno
+import logging
+
+import serial
+import trollius as asyncio
+from   trollius import From
+
+from ema.server    import Server, monotonic
+from ema.serdriver import FrameDecoder, Pacer, OutputQueue, classify
+
+log = logging.getLogger('serdriver')
+
+
+
+class SerialTransport(asyncio.Transport):
+    '''Non blocking transport over an opened serial.Serial object'''
+
+    MAXREAD = 1024
+
+    def __init__(self, loop, protocol, port):
+        asyncio.Transport.__init__(self, {'serial': port})
+        self.__loop     = loop
+        self.__protocol = protocol
+        self.__port     = port
+        self.__fd       = port.fileno()
+        self.__outbuf   = bytearray()
+        self.__closing  = False
+        flags = fcntl.fcntl(self.__fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.__fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.__loop.add_reader(self.__fd, self.__onReadable)
+        self.__loop.call_soon(self.__protocol.connection_made, self)
+
+
+    def __onReadable(self):
+        try:
+            data = os.read(self.__fd, SerialTransport.MAXREAD)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self.__fatal(e)
+            return
+        if data:
+            self.__protocol.data_received(data)
+
+
+    def __onWritable(self):
+        try:
+            n = os.write(self.__fd, bytes(self.__outbuf))
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            self.__fatal(e)
+            return
+        del self.__outbuf[:n]
+        if not self.__outbuf:
+            self.__loop.remove_writer(self.__fd)
+            if self.__closing:
+                self.__finish(None)
+
+
+    def write(self, data):
+        '''Writes as much as possible now and buffers the rest'''
+        if self.__closing or not data:
+            return
+        if not self.__outbuf:
+            try:
+                n = os.write(self.__fd, data)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    self.__fatal(e)
+                    return
+                n = 0
+            data = data[n:]
+            if not data:
+                return
+            self.__loop.add_writer(self.__fd, self.__onWritable)
+        self.__outbuf.extend(data)
+
+
+    def get_write_buffer_size(self):
+        return len(self.__outbuf)
+
+
+    def is_closing(self):
+        return self.__closing
+
+
+    def close(self):
+        if self.__closing:
+            return
+        self.__closing = True
+        self.__loop.remove_reader(self.__fd)
+        if not self.__outbuf:
+            self.__finish(None)
+
+
+    def abort(self):
+        self.__closing = True
+        self.__finish(None)
+
+
+    def __fatal(self, exc):
+        log.error("%s: %s", self.__port.port, exc)
+        self.__closing = True
+        self.__finish(exc)
+
+
+    def __finish(self, exc):
+        self.__loop.remove_reader(self.__fd)
+        self.__loop.remove_writer(self.__fd)
+        self.__outbuf = bytearray()
+        self.__port.close()
+        self.__loop.call_soon(self.__protocol.connection_lost, exc)
+
+
+
+def create_serial_connection(loop, protocol_factory, port, baud):
+    '''Opens port at baud bps. Returns (transport, protocol) tuple'''
+    ser = serial.Serial()
+    ser.port     = port
+    ser.baudrate = baud
+    try:
+        ser.open()
+        ser.flushInput()
+        ser.flushOutput()
+    except serial.SerialException as e:
+        log.error("Could not open serial port %s: %s", ser.name, e)
+        raise
+    protocol  = protocol_factory()
+    transport = SerialTransport(loop, protocol, ser)
+    return (transport, protocol)
+
+
+
+class SerialProtocol(asyncio.Protocol):
+    '''Reassembles EMA messages and hands them to the driver'''
+
+    def __init__(self, driver, maxlen=FrameDecoder.MAXLEN):
+        self.__driver  = driver
+        self.__decoder = FrameDecoder(maxlen)
+
+    def connection_made(self, transport):
+        self.__driver.connection_made(transport)
+
+    def data_received(self, data):
+        for message in self.__decoder.feed(data):
+            self.__driver.onMessage(message)
+
+    def connection_lost(self, exc):
+        self.__driver.connection_lost(exc)
+
+
+
+class SerialDriver(object):
+
+    NSTATS = 1000  # Print number of reads each NSTATs times
+
+    def __init__(self, port, baud, loop=None, **kargs):
+        self.__loop     = loop or asyncio.get_event_loop()
+        self.__nreads   = 0
+        self.__nwrites  = 0
+        self.__handlers = []
+        self.__outqueue = OutputQueue()
+        self.__stopped  = False
+        self.__ready    = asyncio.Event(loop=self.__loop)
+        self.__pacer    = Pacer(baud,
+                                float(kargs.get('serial_mingap', Pacer.MINGAP)),
+                                float(kargs.get('serial_maxgap', Pacer.MAXGAP)))
+        maxlen = int(kargs.get('serial_maxframe', FrameDecoder.MAXLEN))
+        self.__transport, self.__protocol = create_serial_connection(
+            self.__loop, lambda: SerialProtocol(self, maxlen), port, baud)
+        self.__sender = asyncio.ensure_future(self.__send(), loop=self.__loop)
+        log.info("Opened %s at %s bps", port, baud)
+
+    # ----------------------------------------
+    # Public interface exposed to upper layers
+    # -----------------------------------------
+
+    def write(self, message, priority=None):
+        '''
+        Enqueues message to output queue in priority class,
+        by default as given by classify()
+        '''
+        if priority is None:
+            priority = classify(message)
+        if self.__outqueue.push(message, priority, monotonic()):
+            self.__ready.set()
+
+
+    def queueDelay(self, priority=OutputQueue.BULK):
+        '''returns the max wait time in multiples of Server.TIMEOUT
+        for a message in priority class'''
+        return (1+self.__outqueue.ahead(priority)) * self.__pacer.gap / Server.TIMEOUT
+
+
+    def pacing(self):
+        '''Returns a dictionary of pacing, queue wait and line statistics'''
+        self.__pacer.update(monotonic())
+        stats = self.__pacer.stats()
+        stats['queue']     = self.__outqueue.lengths()
+        stats['coalesced'] = self.__outqueue.ncoalesced
+        return stats
+
+
+    def hold(self, flag):
+        '''
+        Stop/Resume dequeuing messages from the output queue
+        and transmitting to serial port.
+        '''
+        self.__stopped = flag
+        if flag:
+            self.__pacer.forget()
+        if not flag and self.__outqueue:
+            self.__ready.set()
+        log.debug("on hold = %s", flag)
+
+
+    def addHandler(self, object):
+        '''Registers an object implementing a handle(message) method'''
+        self.__handlers.append(object)
+
+
+    def close(self):
+        self.__sender.cancel()
+        self.__transport.close()
+
+    # ------------------------------
+    # Callbacks from SerialProtocol
+    # ------------------------------
+
+    def connection_made(self, transport):
+        log.debug("serial transport ready")
+
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            log.error("serial port lost: %s", exc)
+        self.__sender.cancel()
+
+
+    def onMessage(self, message):
+        self.__nreads += 1
+        self.__pacer.received(message, monotonic())
+        log.debug("Rx %s", message)
+        for handler in self.__handlers:
+            handler.onSerialMessage(message)
+
+    # --------------
+    # Helper methods
+    # --------------
+
+    @asyncio.coroutine
+    def __send(self):
+        '''Transmits queued messages one every pacer gap'''
+        while True:
+            if self.__stopped or not self.__outqueue:
+                self.__ready.clear()
+                yield From(self.__ready.wait())
+                continue
+            now = monotonic()
+            self.__pacer.update(now)
+            self.__pacer.expire(now)
+            message, queued, priority = self.__outqueue.pop()
+            log.debug("Tx %s", message)
+            self.__nwrites += 1
+            self.__transport.write(message)
+            self.__pacer.sent(message, queued, now)
+            yield From(asyncio.sleep(self.__pacer.gap, loop=self.__loop))
+
+
+    def counters(self):
+        '''Returns a dictionary of read/written message counters'''
+        return {
+            'reads'  : self.__nreads,
+            'writes' : self.__nwrites,
+            'queued' : len(self.__outqueue),
+        }
+
+
+    def show(self):
+        '''print read/written message statistcs every NSTATs times'''
+        n = max(self.__nreads, self.__nwrites) % SerialDriver.NSTATS
+        if not n:
+            log.info("nreads = %d, nwrites = %d , queue = %d", self.__nreads, self.__nwrites, len(self.__outqueue))
@@ -0,0 +1,484 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# asyncio flavour of the tiny server framework in ema.server.
+#
+# Python 2.7 has no asyncio module, so we use trollius, its Python 2
+# backport. Coroutines are written the trollius way, with
+# 'yield From(...)' and 'raise Return(...)'. trollius is only
+# needed when the asyncio reactor is selected in the config file.
+#
+# AsyncioReactor plugs into ema.server.Server.setReactor() like the
+# select() and epoll() reactors, so that every existing Lazy,
+# Alarmable and Alarmable2 object runs unchanged on the asyncio loop:
+# readables and writables are watched with add_reader()/add_writer()
+# and timers become call_later() handles rescheduled on deadline
+# changes. Other asyncio based services can share the same loop.
+# Callbacks are timed by the Server Instruments, as in the other
+# reactors.
+#
+# Lazy, Alarmable and Alarmable2 in this module are their native
+# asyncio equivalents. They are not registered in a Server, they
+# schedule themselves in the loop once started. EMAServer.loop is
+# set when the asyncio reactor is selected, and then the MQTT client
+# and the TOD Timer use them instead of the tick based ones.
+#
+# For request/response exchanges with EMA, the request() coroutine
+# replaces the per-tick timeout & retry counters of Command and
+# Parameter objects. It waits on an Exchange, a native Alarmable
+# restarted by their response handlers on every matched response.
+#
+# ======================================================================
+
+import logging
+import datetime
+from   abc import ABCMeta, abstractmethod
+
+import trollius as asyncio
+from   trollius import From, Return
+
+from ema.server   import Instruments, monotonic
+
+log = logging.getLogger('server')
+
+
+
+class AsyncioReactor(object):
+    '''
+    Runs objects registered in a Server on an asyncio event loop.
+    '''
+
+    # Timer kinds
+    ALARM = 0
+    LAZY  = 1
+
+    def __init__(self, loop=None):
+        self.loop      = loop or asyncio.get_event_loop()
+        self.__rfd     = {}    # readable object -> registered fd
+        self.__wfd     = {}    # writable object -> registered fd
+        self.__handles = {}    # timer object -> (TimerHandle, kind)
+        self.__error   = None
+        self.instruments = Instruments()
+        self.loop.set_exception_handler(self.__onError)
+
+
+    def registered(self):
+        '''Returns a tuple of lists with all registered objects'''
+        alarms = [obj for obj, (h, kind) in self.__handles.items() if kind == AsyncioReactor.ALARM]
+        lazies = [obj for obj, (h, kind) in self.__handles.items() if kind == AsyncioReactor.LAZY]
+        return (self.__rfd.keys(), self.__wfd.keys(), alarms, lazies)
+
+
+    def close(self):
+        for handle, kind in self.__handles.values():
+            handle.cancel()
+        for fd in self.__rfd.values():
+            self.loop.remove_reader(fd)
+        for fd in self.__wfd.values():
+            self.loop.remove_writer(fd)
+
+    # ------------------------
+    # I/O objects registration
+    # ------------------------
+
+    def addReadable(self, obj):
+        fd = obj.fileno()
+        self.__rfd[obj] = fd
+        self.loop.add_reader(fd, self.__dispatch, obj, 'onInput')
+
+    def delReadable(self, obj):
+        if obj not in self.__rfd:
+            raise ValueError("not a registered readable object")
+        self.loop.remove_reader(self.__rfd.pop(obj))
+
+    def addWritable(self, obj):
+        fd = obj.fileno()
+        self.__wfd[obj] = fd
+        self.loop.add_writer(fd, self.__dispatch, obj, 'onOutput')
+
+    def delWritable(self, obj):
+        if obj not in self.__wfd:
+            raise ValueError("not a registered writable object")
+        self.loop.remove_writer(self.__wfd.pop(obj))
+
+    # ---------------------------
+    # Timer objects registration
+    # ---------------------------
+
+    def __schedule(self, obj, kind):
+        old = self.__handles.get(obj)
+        if old is not None:
+            old[0].cancel()
+        delay  = max(0, obj.deadline() - monotonic())
+        handle = self.loop.call_later(delay, self.__fire, obj, kind)
+        self.__handles[obj] = (handle, kind)
+
+
+    def __fire(self, obj, kind):
+        now = monotonic()
+        if obj.deadline() > now:
+            self.__schedule(obj, kind)    # clock granularity
+            return
+        lag = now - obj.deadline()
+        if kind == AsyncioReactor.ALARM:
+            del self.__handles[obj]
+            obj.rearm(now)
+            self.instruments.call(obj, 'onTimeoutDo', lag)
+        else:
+            obj.rearm(now)
+            self.__schedule(obj, kind)
+            self.instruments.call(obj, 'work', lag)
+
+
+    def __dispatch(self, obj, method):
+        self.instruments.call(obj, method)
+
+
+    def addAlarmable(self, obj):
+        self.__schedule(obj, AsyncioReactor.ALARM)
+
+    def delAlarmable(self, obj):
+        if obj not in self.__handles:
+            raise ValueError("not a registered timer object")
+        self.__handles.pop(obj)[0].cancel()
+
+    def addLazy(self, obj):
+        self.__schedule(obj, AsyncioReactor.LAZY)
+
+    def reschedule(self, obj):
+        entry = self.__handles.get(obj)
+        if entry is not None:
+            self.__schedule(obj, entry[1])
+
+    # --------------
+    # Loop execution
+    # --------------
+
+    def __onError(self, loop, context):
+        '''Stops the loop on callback exceptions, as the other reactors do'''
+        exc = context.get('exception')
+        if exc is None:
+            loop.default_exception_handler(context)
+            return
+        self.__error = exc
+        loop.stop()
+
+
+    def step(self, timeout):
+        '''
+        Runs the asyncio loop for timeout seconds or, with no timeout,
+        until stopped. Exceptions in callbacks are raised here.
+        '''
+        handle = None
+        if timeout is not None:
+            handle = self.loop.call_later(timeout, self.loop.stop)
+        try:
+            self.loop.run_forever()
+        finally:
+            if handle is not None:
+                handle.cancel()
+        if self.__error is not None:
+            error, self.__error = self.__error, None
+            raise error
+
+# ==========================================================
+
+class Lazy(object):
+    '''
+    Abstract class for all objects implementing a periodic work()
+    method, scheduled in an asyncio loop without drifting.
+    '''
+
+    __metaclass__ = ABCMeta     # Only Python 2.7
+
+    def __init__(self, period=1.0, loop=None):
+        self.__loop     = loop or asyncio.get_event_loop()
+        self.__period   = period
+        self.__deadline = None
+        self.__handle   = None
+
+
+    def start(self):
+        '''Start calling work() every period seconds from now'''
+        self.stop()
+        self.__deadline = self.__loop.time() + self.__period
+        self.__handle   = self.__loop.call_at(self.__deadline, self.__fire)
+
+
+    def stop(self):
+        if self.__handle is not None:
+            self.__handle.cancel()
+            self.__handle = None
+
+
+    def reset(self):
+        if self.__handle is not None:
+            self.start()
+
+
+    def setPeriod(self, period):
+        self.__period = period
+        self.reset()
+
+
+    def __fire(self):
+        now = self.__loop.time()
+        self.__deadline += self.__period
+        if self.__deadline <= now:
+            self.__deadline = now + self.__period  # lagging, resync
+        self.__handle = self.__loop.call_at(self.__deadline, self.__fire)
+        self.work()
+
+
+    @abstractmethod
+    def work(self):
+        '''
+        Work procedure for lazy objects.
+        To be subclassed and overriden
+        '''
+        pass
+
+# ==========================================================
+
+class Alarmable(object):
+    '''
+    Abstract class for all objects implementing a OnTimeoutDo() method
+    called once, timeout seconds after the alarm is started or reset.
+    '''
+
+    __metaclass__ = ABCMeta     # Only Python 2.7
+
+    def __init__(self, timeout=1.0, loop=None):
+        self.__loop    = loop or asyncio.get_event_loop()
+        self.__timeout = timeout
+        self.__t0      = self.__loop.time()
+        self.__handle  = None
+
+
+    def start(self):
+        '''Arms the alarm from now'''
+        self.__t0 = self.__loop.time()
+        self.__arm()
+
+
+    def cancel(self):
+        if self.__handle is not None:
+            self.__handle.cancel()
+            self.__handle = None
+
+
+    def pending(self):
+        '''Returns True if the alarm is armed'''
+        return self.__handle is not None
+
+
+    def resetAlarm(self):
+        self.__t0 = self.__loop.time()
+        if self.__handle is not None:
+            self.__arm()
+
+
+    def setTimeout(self, timeout):
+        self.__timeout = timeout
+        if self.__handle is not None:
+            self.__arm()
+
+
+    def __arm(self):
+        self.cancel()
+        self.__handle = self.__loop.call_at(self.__t0 + self.__timeout, self.__fire)
+
+
+    def __fire(self):
+        self.__handle = None
+        self.onTimeoutDo()
+
+
+    @abstractmethod
+    def onTimeoutDo(self):
+        '''
+        To be subclassed and overriden
+        '''
+        pass
+
+# ==========================================================
+
+class Alarmable2(object):
+    '''
+    Abstract class for all objects implementing a OnTimeoutDo() method
+    for timeouts of several hours, with a final timestamp in UTC.
+    '''
+
+    __metaclass__ = ABCMeta     # Only Python 2.7
+
+    def __init__(self, timeout=1, loop=None):
+        self.__loop    = loop or asyncio.get_event_loop()
+        self.__delta   = datetime.timedelta(seconds=timeout)
+        self.__tsFinal = datetime.datetime.utcnow() + self.__delta
+        self.__handle  = None
+
+
+    def start(self):
+        '''Arms the alarm from now'''
+        self.resetAlarm()
+        self.__arm()
+
+
+    def cancel(self):
+        if self.__handle is not None:
+            self.__handle.cancel()
+            self.__handle = None
+
+
+    def resetAlarm(self):
+        self.__tsFinal = datetime.datetime.utcnow() + self.__delta
+        if self.__handle is not None:
+            self.__arm()
+
+
+    def setTimeout(self, timeout):
+        self.__delta = datetime.timedelta(seconds=timeout)
+
+
+    def timeout(self):
+        '''
+        Returns True if timeout elapsed.
+        '''
+        return datetime.datetime.utcnow() >= self.__tsFinal
+
+
+    def __arm(self):
+        self.cancel()
+        remaining = (self.__tsFinal - datetime.datetime.utcnow()).total_seconds()
+        self.__handle = self.__loop.call_later(max(0, remaining), self.__fire)
+
+
+    def __fire(self):
+        # Wall clock may have been stepped back meanwhile
+        if not self.timeout():
+            self.__arm()
+            return
+        self.__handle = None
+        self.onTimeoutDo()
+
+
+    @abstractmethod
+    def onTimeoutDo(self):
+        '''
+        To be subclassed and overriden
+        '''
+        pass
+
+# ==========================================================
+
+class Wakeup(Alarmable2):
+    '''
+    Native Alarmable2 calling back the onTimeoutDo() method of an
+    object from the ema.server hierarchy, like the TOD Timer.
+    '''
+
+    def __init__(self, obj, loop=None):
+        Alarmable2.__init__(self, loop=loop)
+        self.obj = obj
+
+    def onTimeoutDo(self):
+        self.obj.onTimeoutDo()
+
+# ==========================================================
+
+class Exchange(Alarmable):
+    '''
+    Timeout of a request/response exchange with EMA, waited on by the
+    request() coroutine. The owner sets its timeout when sending and
+    calls progress() on every matched response.
+    '''
+
+    def __init__(self, loop=None):
+        Alarmable.__init__(self, loop=loop)
+        self.__loop    = loop or asyncio.get_event_loop()
+        self.__wakeup  = asyncio.Future(loop=self.__loop)
+        self.matched   = False   # responses matched since the last wait()
+        self.completed = False
+
+
+    def progress(self, complete=False):
+        '''A response matched, restarts the timeout or ends the exchange'''
+        self.matched = True
+        if not complete:
+            self.resetAlarm()
+            return
+        self.completed = True
+        self.cancel()
+        self.__wake()
+
+
+    def onTimeoutDo(self):
+        self.__wake()
+
+
+    def __wake(self):
+        if not self.__wakeup.done():
+            self.__wakeup.set_result(None)
+
+
+    @asyncio.coroutine
+    def wait(self):
+        '''
+        Starts the timeout and waits for it or for the last response.
+        Returns True if the exchange completed.
+        '''
+        self.matched = False
+        self.start()
+        yield From(self.__wakeup)
+        self.__wakeup = asyncio.Future(loop=self.__loop)
+        raise Return(self.completed)
+
+
+    def run(self, send, retries, failed):
+        '''
+        Runs the request() coroutine as a task, calling failed()
+        if EMA does not respond.
+        '''
+        task = asyncio.ensure_future(request(send, self, retries), loop=self.__loop)
+        task.add_done_callback(lambda task: task.result() or failed())
+
+
+
+@asyncio.coroutine
+def request(send, exchange, retries):
+    '''
+    Request/response exchange with EMA, retried on timeout.
+    send(retry) sends the request (retry 0) or resends it and sets
+    the exchange timeout. As with the tick counters, retries start
+    over after a matched response. Returns True when the exchange
+    completes or False if EMA is not responding.
+    '''
+    retry = 0
+    while True:
+        send(retry)
+        if (yield From(exchange.wait())):
+            raise Return(True)
+        retry = 1 if exchange.matched else retry + 1
+        if retry > retries:
+            raise Return(False)
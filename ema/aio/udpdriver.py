@@ -0,0 +1,140 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# asyncio flavour of the UDPDriver.
+#
+# UDPProtocol is a DatagramProtocol bound to rx_port in all interfaces,
+# optionally joined to the multicast group. It just forwards datagrams
+# to UDPDriver, which reassembles EMA messages per origin IP+port with
+# the same Reassembler as ema.udpdriver.UDPDriver and keeps its public
+# interface (write, addHandler) and onUDPMessage(message, origin) upcall.
+#
+# ======================================================================
+
+import struct
+import socket
+import logging
+
+import trollius as asyncio
+
+from ema.udpdriver import Reassembler
+
+log = logging.getLogger('udpdriver')
+
+
+
+class UDPProtocol(asyncio.DatagramProtocol):
+    '''Forwards datagrams to the UDP driver'''
+
+    def __init__(self, driver):
+        self.__driver = driver
+
+    def datagram_received(self, data, origin):
+        self.__driver.onDatagram(data, origin)
+
+    def error_received(self, exc):
+        log.error(exc)
+
+
+
+class UDPDriver(object):
+
+    NSTATS = 100  # Print number of reads ecah NSTATs times
+
+    def __init__(self, ip, rx_port, tx_port, loop=None, **kargs):
+        self.__loop     = loop or asyncio.get_event_loop()
+        self.__nreads   = 0
+        self.__nwrites  = 0
+        self.__buffer   = Reassembler()
+        self.__handlers = []
+        self.__ip       = ip
+        self.__tx_port  = tx_port
+        try:
+            endpoint = self.__loop.create_datagram_endpoint(
+                lambda: UDPProtocol(self),
+                local_addr=('0.0.0.0', rx_port))
+            self.__transport, self.__protocol = self.__loop.run_until_complete(endpoint)
+            if ip:
+                sock = self.__transport.get_extra_info('socket')
+                mreq = struct.pack("4sl", socket.inet_aton(ip), socket.INADDR_ANY)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        except Exception as e:
+            log.error(e)
+            raise
+        log.info("Receive UDP packets on port %d (all interfaces)", rx_port)
+
+    # ----------------------------------------
+    # Public interface exposed to upper layers
+    # ----------------------------------------
+
+    def write(self, data, unicast_ip=None):
+        '''
+        Write EMA message to multicast IP (by default) or given unicast_ip
+        '''
+        ip = unicast_ip if unicast_ip else self.__ip
+        log.debug("Tx %s to '%s'", data, (ip, self.__tx_port))
+        self.__transport.sendto(data, (ip, self.__tx_port))
+        self.__nwrites += 1
+
+
+    def addHandler(self, object):
+        '''Registers an object implementing a handle(message) method'''
+        self.__handlers.append(object)
+
+
+    def close(self):
+        self.__transport.close()
+
+    # --------------
+    # Helper methods
+    # --------------
+
+    def onDatagram(self, chunk, origin):
+        '''
+        Update message buffer and notify
+        if necessary by invoking onUDPMessage()
+        '''
+        log.debug("Rx %s from '%s'", chunk, origin)
+        for message in self.__buffer.feed(chunk, origin):
+            self.__nreads += 1
+            for handler in self.__handlers:
+                handler.onUDPMessage(message, origin)
+
+
+    def counters(self):
+        '''Returns a dictionary of read/written message counters'''
+        return {
+            'reads'   : self.__nreads,
+            'writes'  : self.__nwrites,
+            'dropped' : self.__buffer.ndropped,
+        }
+
+
+    def show(self):
+        '''print read/written message statistcs every NSTATs times'''
+        n = max(self.__nreads, self.__nwrites) % UDPDriver.NSTATS
+        if not n:
+            log.info("nreads = %d, nwrites = %d, buffer =%s, dropped = %d bytes",
+                     self.__nreads, self.__nwrites, self.__buffer.pending(), self.__buffer.ndropped)
@@ -0,0 +1,203 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# EMA keeps its history of hourly maxima and minima in flash pages,
+# read with the '(@Hpppp)' bulk dump request. The response to each
+# page is 24 triplets of maxima, minima and timestamp lines.
+#
+# BulkDump walks a configurable range of pages, one request at a time,
+# and hands each page to a sink as soon as it completes, instead of
+# collecting the whole range in memory first.
+#
+# A checksum of every page delivered is kept in a cache, so that pages
+# whose contents did not change since the previous walk are not
+# delivered again. EMA offers no way to know if a page changed without
+# reading it, so pages are still requested on every walk.
+#
+# The page to continue from is kept as well. If a page request times
+# out, the walk stops there and the next start() resumes from that
+# page instead of from the first one. Pages completed before the
+# failure are neither requested nor delivered again.
+#
+# A page request that is retried after a timeout starts over from the
+# first record, as EMA sends the whole page again. Lines received in
+# the failed attempt are discarded.
+#
+# If a cache file is given, checksums and resume point are saved in it
+# as JSON after every page, so that they survive daemon restarts.
+# ======================================================================
+
+import os
+import json
+import hashlib
+import logging
+
+from command import Command, COMMAND
+
+log = logging.getLogger('mqtt')
+
+
+
+class BulkDumpCommand(Command):
+   '''
+   Commad subclass to handle bulk dump request and responses via callbacks
+   '''
+
+   def __init__(self, ema, dump, retries, **kargs):
+      Command.__init__(self,ema,retries,**kargs)
+      self.dump = dump
+
+   # delegate to the BulkDump object as it has all the needed context
+   def onPartialCommand(self, message, userdata):
+      '''
+      Partial bulk dump handler
+      '''
+      self.dump.onPartialPage(message, userdata)
+
+   def onCommandComplete(self, message, userdata):
+      '''
+      Bulk dump Command complete handler
+      '''
+      self.dump.onPageComplete(message, userdata)
+
+   def onCommandTimeout(self, userdata):
+      '''
+      Bulk dump Command failure handler
+      '''
+      self.dump.onPageTimeout(userdata)
+
+   def onRetry(self):
+      '''
+      EMA sends a page again from its first record when the request is
+      resent, so the partial page is discarded before retrying
+      '''
+      self.indexRes  = 0
+      self.iteration = 1
+      self.dump.onPageRetry(self.userdata)
+
+
+
+class BulkDump(object):
+   '''
+   Walks EMA history flash pages first to last, calling
+   sink(page, lines) for each completed page that changed.
+   '''
+
+   def __init__(self, ema, first, last, sink, path=None, retries=Command.RETRIES):
+      if not 0 <= first <= last <= 9999:
+         raise ValueError("Invalid history page range %d-%d" % (first, last))
+      self.ema      = ema
+      self.first    = first
+      self.last     = last
+      self.sink     = sink
+      self.path     = path
+      self.retries  = retries
+      self.checksum = {}      # page -> SHA1 of its lines
+      self.next     = None    # page to resume from
+      self.busy     = False
+      self.lines    = []
+      self.load()
+
+
+   def start(self):
+      '''Starts a walk, resuming the previous one if it was interrupted'''
+      if self.busy:
+         log.info("History dump already in progress, page %d", self.next)
+         return
+      if self.next is None or not self.first <= self.next <= self.last:
+         self.next = self.first
+      log.info("Dumping history pages %d to %d", self.next, self.last)
+      self.busy = True
+      self.request(self.next)
+
+
+   def request(self, page):
+      '''
+      Request a flash page to EMA
+      '''
+      log.debug("requesting page %d", page)
+      self.lines = []
+      cmd = BulkDumpCommand(self.ema, self, self.retries, **COMMAND[-1])
+      cmd.request("(@H%04d)" % page, page)
+
+   # ----------------
+   # Command callbacks
+   # ----------------
+
+   def onPartialPage(self, message, page):
+      self.lines.append(message)
+
+
+   def onPageComplete(self, message, page):
+      self.lines.append(message)
+      checksum = hashlib.sha1('\n'.join(self.lines)).hexdigest()
+      if self.checksum.get(page) != checksum:
+         self.checksum[page] = checksum
+         self.sink(page, self.lines)
+      else:
+         log.debug("History page %d unchanged", page)
+      if page < self.last:
+         self.next = page + 1
+         self.save()
+         self.request(self.next)
+      else:
+         self.next = None
+         self.busy = False
+         self.save()
+         log.info("History dump complete")
+
+
+   def onPageRetry(self, page):
+      log.debug("Retrying history page %d from its first record", page)
+      self.lines = []
+
+
+   def onPageTimeout(self, page):
+      self.busy = False
+      self.save()
+      log.error("History dump interrupted at page %d, to be resumed from there", page)
+
+   # ----------------
+   # Cache persistence
+   # ----------------
+
+   def load(self):
+      if self.path is None or not os.path.exists(self.path):
+         return
+      try:
+         with open(self.path) as f:
+            cache = json.load(f)
+         self.checksum = dict((int(page), checksum) for page, checksum in cache['checksum'].iteritems())
+         self.next     = cache['next']
+      except (IOError, ValueError, KeyError) as e:
+         log.warning("Ignoring history cache %s: %s", self.path, e)
+
+
+   def save(self):
+      if self.path is None:
+         return
+      tmp = self.path + '.tmp'
+      with open(tmp, 'w') as f:
+         json.dump({'checksum': self.checksum, 'next': self.next}, f)
+      os.rename(tmp, self.path)
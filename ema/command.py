@@ -46,6 +46,11 @@
 # Verion v2.0 also generalized the response string expected from EMA to handle
 # the bulk dum responses from EMA, where response messages are organized 
 # in a 3 x 24 pattern
+#
+# With the asyncio reactor, timeouts and retries are handled by the
+# aio.server.request() coroutine waiting on an Exchange instead of
+# the tick based Alarmable. Both paths share resend(), progress()
+# and fail().
 # ======================================================================
 
 # ====================================================================
@@ -70,8 +75,9 @@ import re
 from   abc import abstractmethod
 
 
-from server   import Server, Alarmable
-from emaproto import STATLENEXT
+from server    import Server, Alarmable
+from emaproto  import STATLENEXT, patternKey
+from serdriver import classify
 
 log = logging.getLogger('command')
 
@@ -177,6 +183,7 @@ class Command(Alarmable):
 		self.iteration       = 1
 		self.partialHandler  = None
 		self.completeHandler = None
+		self.exchange        = None   # asyncio reactor only
 
 	# --------------
 	# Helper methods
@@ -187,16 +194,50 @@ class Command(Alarmable):
 		Do the actual sending of message to EMA and associated 
 		timeout bookeeping
 		'''
-		t = self.ema.serdriver.queueDelay()*Server.TIMEOUT + Command.TIMEOUT*self.NIterations
+		t = self.ema.serdriver.queueDelay(classify(message))*Server.TIMEOUT + Command.TIMEOUT*self.NIterations
 		self.setTimeout(t)
-		self.resetAlarm()
-		self.ema.addAlarmable(self)
+		if self.exchange is None:
+			self.resetAlarm()
+			self.ema.addAlarmable(self)
 		self.ema.serdriver.write(message)
 
+	def setTimeout(self, timeout):
+		Alarmable.setTimeout(self, timeout)
+		if self.exchange is not None:
+			self.exchange.setTimeout(timeout)
+
+	def resend(self, retry):
+		'''Sends the request (retry 0) or resends it'''
+		if retry:
+			self.retries = retry
+			log.debug("Timeout waiting for command %s response, retrying", self.message)
+			self.onRetry()
+		self.sendMessage(self.message)
+
+	def progress(self, complete):
+		'''A response matched, restart timeout or stop it when complete'''
+		self.retries = 0
+		if self.exchange is not None:
+			self.exchange.progress(complete)
+		elif complete:
+			self.ema.delAlarmable(self)
+		else:
+			self.resetAlarm()
+
+	def fail(self):
+		'''Retries exhausted, to END state'''
+		self.ema.delCommand(self)
+		log.error("Timeout: EMA not responding to %s command", self.message)
+		self.onCommandTimeout(self.userdata)
+
 	# --------------
 	# Main interface
 	# --------------
 
+	def routes(self):
+		'''Routing keys of the expected responses'''
+		return [patternKey(p.pattern) for p in self.resPat]
+
 	def request(self, message, userdata):
 		'''Send a request to EMA on behalf of external origin'''
 		log.debug("executing external command %s", self.name)
@@ -205,9 +246,14 @@ class Command(Alarmable):
 		self.retries   = 0
 		self.indexRes  = 0
 		self.iteration = 1
-		self.resetAlarm()       
 		self.ema.addCommand(self)
-		self.sendMessage(message)
+		if self.ema.loop is None:
+			self.resetAlarm()
+			self.sendMessage(message)
+			return
+		import aio.server      # trollius only needed by the asyncio reactor
+		self.exchange = aio.server.Exchange(self.ema.loop)
+		self.exchange.run(self.resend, self.NRetries, self.fail)
 		
 		
 	def onResponseDo(self, message):
@@ -215,11 +261,10 @@ class Command(Alarmable):
 		log.debug("trying to match %s", message)
 		matched = self.resPat[self.indexRes].search(message)
 		if matched:
-			self.resetAlarm()
-			self.retries = 0
-			if (self.indexRes + 1) == len(self.resPat) and self.iteration == self.NIterations:
+			complete = (self.indexRes + 1) == len(self.resPat) and self.iteration == self.NIterations
+			self.progress(complete)
+			if complete:
 				log.debug("Matched command response, command complete")
-				self.ema.delAlarmable(self)
 				self.ema.delCommand(self)
 				self.onCommandComplete(message, self.userdata)
 			elif (self.indexRes + 1) == len(self.resPat) and self.iteration < self.NIterations:
@@ -237,12 +282,9 @@ class Command(Alarmable):
 	def onTimeoutDo(self):
 		'''Timeout event handler'''
 		if self.retries < self.NRetries:
-			self.retries += 1
-			self.sendMessage(self.message)
-			log.debug("Timeout waiting for command %s response, retrying", self.message)
+			self.resend(self.retries + 1)
 		else:	# to END state
-			self.ema.delCommand(self)
-			log.error("Timeout: EMA not responding to %s command", self.message)
+			self.fail()
 	
 	# ----------------------------------------------
 	# Abstract methods to be overriden in subclasses
@@ -258,5 +300,13 @@ class Command(Alarmable):
 		'''To be subclassed and overriden'''
 		pass
 
+	def onCommandTimeout(self, userdata):
+		'''Called when retries are exhausted. May be overriden'''
+		pass
+
+	def onRetry(self):
+		'''Called before resending the request. May be overriden'''
+		pass
+
 
 
@@ -24,10 +24,9 @@
 import logging
 import re
 
-from ema.emaproto  import SAAB, SAAE, SACB, SACE, SWDB, SWDE
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('anemomete')
 
@@ -109,6 +108,9 @@ class Anemometer(Device):
         ema.addSync(self.wind10th)
         ema.addSync(self.calib)
         ema.addSync(self.model)
+        ema.restore(self.windSpeed, 'windcurrent')
+        ema.restore(self.windSpeed10, 'windaccum')
+        ema.restore(self.windDir, 'winddir')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
@@ -116,13 +118,14 @@ class Anemometer(Device):
         ema.addParameter(self)
        
 
-    def onStatus(self, message):
-        self.windSpeed.append(int(message[SACB:SACE]))
-        self.windSpeed10.append(int(message[SAAB:SAAE]))
-        self.windDir.append(int(message[SWDB:SWDE]))
+    def onStatus(self, status):
+        self.touch()
+        self.windSpeed.append(status.windcurrent)
+        self.windSpeed10.append(status.windaccum)
+        self.windDir.append(status.winddir)
 
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return {
@@ -132,7 +135,7 @@ class Anemometer(Device):
         }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary averaged values over a period of N samples'''
         accum, n = self.windSpeed.sum()
@@ -146,6 +149,16 @@ class Anemometer(Device):
             Anemometer.SPEED10: av2, 
             Anemometer.DIRECTION: av3 
             }
+
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            Anemometer.SPEED: (self.windSpeed.stats(10), "Km/h"),
+            Anemometer.SPEED10: (self.windSpeed10.stats(1), "Km/h"),
+            Anemometer.DIRECTION: (self.windDir.stats(1), "degrees")
+            }
+
     
 
     @property
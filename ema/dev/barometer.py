@@ -24,10 +24,9 @@
 import logging
 import re
 
-from ema.emaproto  import SABB, SABE
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('barometer')
 
@@ -75,17 +74,19 @@ class Barometer(Device):
         self.pressure  = Vector(N)
         ema.addSync(self.height)
         ema.addSync(self.offset)
+        ema.restore(self.pressure, 'abspressure')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
         ema.addParameter(self)
 
 
-    def onStatus(self, message):
-        self.pressure.append(int(message[SABB:SABE]))
+    def onStatus(self, status):
+        self.touch()
+        self.pressure.append(status.abspressure)
 
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return {
@@ -93,12 +94,20 @@ class Barometer(Device):
         }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary averaged values over a period of N samples'''
         accum, n = self.pressure.sum()
         return { Barometer.PRESSURE: (accum/(10.0*n), "HPa")}
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            Barometer.PRESSURE: (self.pressure.stats(10), "HPa")
+            }
+
+
 
     @property
     def parameter(self):
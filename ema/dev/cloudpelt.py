@@ -24,10 +24,9 @@
 import logging
 import re
 
-from ema.emaproto  import SCLB, SCLE
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('peltier')
 
@@ -76,6 +75,7 @@ class CloudSensor(Device):
         self.cloud       = Vector(N)
         ema.addSync(self.thres)
         ema.addSync(self.gain)
+        ema.restore(self.cloud, 'cloud')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
@@ -83,22 +83,31 @@ class CloudSensor(Device):
         ema.addParameter(self)
 
 
-    def onStatus(self, message):
-        self.cloud.append(int(message[SCLB:SCLE]))
+    def onStatus(self, status):
+        self.touch()
+        self.cloud.append(status.cloud)
 
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return { CloudSensor.CLOUD: (self.cloud.last() / 10.0 , '%') }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary averaged values over a period of N samples'''
         accum, n = self.cloud.sum()
         return { CloudSensor.CLOUD: (accum/(10.0*n), '%') }
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            CloudSensor.CLOUD: (self.cloud.stats(10), '%')
+            }
+
+
 
     @property
     def threshold(self):
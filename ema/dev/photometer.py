@@ -28,7 +28,7 @@ import re
 from ema.emaproto  import MVI, MVD
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('photomete')
 
@@ -84,21 +84,30 @@ class Photometer(Device):
 
 
     def add(self, message, matchobj):
+        self.touch()
         self.photom.append(int(message[MVI:MVI+2])*100 + int(message[MVD:MVD+2]))
         
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return {  Photometer.MAGNITUDE: (self.photom.last() / 100.0 , 'Mv/arcsec^2') }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary of averaged values over a period of N samples'''
         accum, n = self.photom.sum()
         return { Photometer.MAGNITUDE: (accum/(100.0*n), 'Mv/arcsec^2' ) }
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            Photometer.MAGNITUDE: (self.photom.stats(100), 'Mv/arcsec^2')
+            }
+
+
 
     @property
     def threshold(self):
@@ -24,10 +24,9 @@
 import logging
 import re
 
-from ema.emaproto  import SPCB, SPCE, SPAB, SPAE
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('pluviomet')
 
@@ -62,18 +61,21 @@ class Pluviometer(Device):
         self.instant       = Vector(N)
         self.accumulated   = Vector(N)
         ema.addSync(self.calibration)
+        ema.restore(self.instant, 'pluvcurrent')
+        ema.restore(self.accumulated, 'pluvaccum')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
         ema.addParameter(self)
 
 
-    def onStatus(self, message):
-        self.instant.append(int(message[SPCB:SPCE]))
-        self.accumulated.append(int(message[SPAB:SPAE]))
+    def onStatus(self, status):
+        self.touch()
+        self.instant.append(status.pluvcurrent)
+        self.accumulated.append(status.pluvaccum)
 
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return {
@@ -82,7 +84,7 @@ class Pluviometer(Device):
         }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary averaged values over a period of N samples'''
         accum, n = self.instant.sum()
@@ -91,6 +93,15 @@ class Pluviometer(Device):
         av2 = (float(accum)/n, "mm")
         return { Pluviometer.CURRENT: av1, 'accumulated': av2 }
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            Pluviometer.CURRENT: (self.instant.stats(10), "mm"),
+            'accumulated': (self.accumulated.stats(1), "mm")
+            }
+
+
 
     @property
     def parameter(self):
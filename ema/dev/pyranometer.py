@@ -26,10 +26,9 @@
 import logging
 import re
 
-from ema.emaproto  import SPYB, SPYE
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('pyranomet')
 
@@ -77,28 +76,38 @@ class Pyranometer(Device):
         self.led    = Vector(N)
         ema.addSync(self.gain)
         ema.addSync(self.offset)
+        ema.restore(self.led, 'pyrometer')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
         ema.addParameter(self)
 
 
-    def onStatus(self, message):
-        self.led.append(int(message[SPYB:SPYE]))
+    def onStatus(self, status):
+        self.touch()
+        self.led.append(status.pyrometer)
 
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return { Pyranometer.IRRADIATION: (self.led.last() / 10.0 , '%') }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary averaged values over a period of N samples'''
         accum, n = self.led.sum()
         return { Pyranometer.IRRADIATION: (accum/(10.0*n), '%') }
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            Pyranometer.IRRADIATION: (self.led.stats(10), '%')
+            }
+
+
 
     @property
     def parameter(self):
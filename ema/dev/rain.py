@@ -24,10 +24,9 @@
 import logging
 import re
 
-from ema.emaproto  import SRAB, SRAE
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('rainsenso')
 
@@ -60,6 +59,7 @@ class RainSensor(Device):
         self.thres     = Parameter(ema, thres, **THRESHOLD)
         self.rain      = Vector(N)
         ema.addSync(self.thres)
+        ema.restore(self.rain, 'rain')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
@@ -67,22 +67,31 @@ class RainSensor(Device):
 
 
 
-    def onStatus(self, message):
-        self.rain.append(int(message[SRAB:SRAE]))
+    def onStatus(self, status):
+        self.touch()
+        self.rain.append(status.rain)
 
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return { RainSensor.RAIN: (self.rain.last() / 10.0 , 'mm') }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary averaged values over a period of N samples'''
         accum, n = self.rain.sum()
         return { RainSensor.RAIN: (accum/(10.0*n), 'mm') }
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            RainSensor.RAIN: (self.rain.stats(10), 'mm')
+            }
+
+
     @property
     def threshold(self):
         '''Return dictionary with thresholds'''
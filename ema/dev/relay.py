@@ -28,8 +28,7 @@ import datetime
 from ema.server    import Server, Alarmable
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.emaproto  import SRRB, SARB
-from ema.device    import Device
+from ema.device    import Device, memoized
 from ema.intervals import Interval, Intervals
 from todtimer      import Timer
 
@@ -60,7 +59,7 @@ class RoofRelay(Device):
 		scripts       = parser.get("ROOF_RELAY","roof_relay_script").split(',')
 		relay_mode    = parser.get("ROOF_RELAY","roof_relay_mode")
                 Device.__init__(self, publish_where, publish_what)
-		self.relay = Vector(N)
+		self.relay = Vector(N, 'b')
 		self.ema   = ema
 		ema.subscribeStatus(self)
 		ema.addCurrent(self)
@@ -69,9 +68,10 @@ class RoofRelay(Device):
 			ema.notifier.addScript('RoofRelaySwitch', relay_mode, script)
 		
 
-	def onStatus(self, message):
+	def onStatus(self, status):
 		'''Roof Relay, accumulate open (True) /close (False) readings'''
-		c = message[SRRB]
+		self.touch()
+		c = status.roof
 		openFlag = False if c == 'C' else True
 
 		# Handle initial feed
@@ -92,13 +92,13 @@ class RoofRelay(Device):
 			self.relay.append(openFlag)
 
 
-	@property
+	@memoized
 	def current(self):
 		'''Return dictionary with current measured values'''
-		return { RoofRelay.OPEN: (self.relay.last() , '') }
+		return { RoofRelay.OPEN: (bool(self.relay.last()) , '') }
 
 
-	@property
+	@memoized
 	def average(self):
 		'''Return dictionary averaged values over a period of N samples'''
 		accum, n = self.relay.sum()
@@ -204,7 +204,7 @@ class AuxRelay(Device):
 		self.mode     = Parameter(ema, AuxRelay.MAPPING[mode], **MODE)	
 		self.ton      = None
 		self.toff     = None
-		self.relay    = Vector(N)
+		self.relay    = Vector(N, 'b')
 		ema.addSync(self.mode)
 		ema.subscribeStatus(self)
 		ema.addParameter(self)
@@ -217,9 +217,10 @@ class AuxRelay(Device):
 	# Implements the EMA status message interface
 	# -------------------------------------------
 
-	def onStatus(self, message):
+	def onStatus(self, status):
 		'''Aux Relay, accumulate open/close readings'''
-		c = message[SARB]
+		self.touch()
+		c = status.aux
 		openFlag = True if c == 'E' or c == 'e' else False
 
 		# Handle initial feed
@@ -244,12 +245,12 @@ class AuxRelay(Device):
 	# Properties
 	# ----------
 
-	@property
+	@memoized
 	def current(self):
 		'''Return dictionary with current measured values'''
-		return { AuxRelay.OPEN: (self.relay.last() , '') }
+		return { AuxRelay.OPEN: (bool(self.relay.last()) , '') }
 
-	@property
+	@memoized
 	def average(self):
 		'''Return dictionary averaged values over a period of N samples'''
 		accum, n = self.relay.sum()
@@ -28,6 +28,7 @@ import datetime
 from ema.server    import Server, Lazy
 from ema.parameter import AbstractParameter
 from ema.emaproto  import PERIOD
+from ema.serdriver import OutputQueue
 
 log = logging.getLogger('rtc')
 
@@ -51,22 +52,22 @@ class RTCParameter(AbstractParameter):
 
 
     def sendDateTime(self):
-        t    = self.ema.serdriver.queueDelay()*Server.TIMEOUT
+        t    = self.ema.serdriver.queueDelay(OutputQueue.SYNC)*Server.TIMEOUT
         tadj = int(round(t))
         self.now = (datetime.datetime.utcnow() + datetime.timedelta(seconds=tadj)).replace(microsecond=0)
         msg = self.now.strftime('(Y%d%m%y%H%M%S)')
-        self.ema.serdriver.write(msg)
+        self.ema.serdriver.write(msg, OutputQueue.SYNC)
         self.setTimeout(t+RTCParameter.TIMEOUT)      # adjusted for queue length
         self.resetAlarm()        
         log.debug("Tadj = %d seconds", tadj)
 
 
     def actionStart(self):
-        n = self.ema.serdriver.queueDelay()
+        n = self.ema.serdriver.queueDelay(OutputQueue.SYNC)
         n += RTCParameter.TIMEOUT
         self.setTimeout(n)      # adjust for queue length
         self.resetAlarm()        
-        self.ema.serdriver.write('(y)')
+        self.ema.serdriver.write('(y)', OutputQueue.SYNC)
 
 
     def actionGet(self, message, matchobj):
@@ -26,10 +26,9 @@
 import logging
 import re
 
-from ema.emaproto  import SATB, SATE, SRHB, SRHE, SDPB, SDPE
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('thermomet')
 
@@ -67,18 +66,22 @@ class Thermometer(Device):
         self.humidity = Vector(N)
         self.dewpoint = Vector(N)
         ema.addSync(self.thres)
+        ema.restore(self.ambient, 'ambient')
+        ema.restore(self.humidity, 'humidity')
+        ema.restore(self.dewpoint, 'dewpoint')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
         ema.addThreshold(self)
 
 
-    def onStatus(self, message):
-        self.ambient.append(int(message[SATB:SATE]))
-        self.humidity.append(int(message[SRHB:SRHE]))
-        self.dewpoint.append(int(message[SDPB:SDPE]))
+    def onStatus(self, status):
+        self.touch()
+        self.ambient.append(status.ambient)
+        self.humidity.append(status.humidity)
+        self.dewpoint.append(status.dewpoint)
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return { 
@@ -87,7 +90,7 @@ class Thermometer(Device):
             Thermometer.DEWPOINT: (self.dewpoint.last() / 10.0 , 'deg C')
             }
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary averaged values over a period of N samples'''
         accum, n = self.ambient.sum()
@@ -102,6 +105,16 @@ class Thermometer(Device):
             Thermometer.DEWPOINT: av3
             }
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            Thermometer.AMBIENT: (self.ambient.stats(10), 'deg C'),
+            Thermometer.HUMIDITY: (self.humidity.stats(10), '%'),
+            Thermometer.DEWPOINT: (self.dewpoint.stats(10), 'deg C')
+            }
+
+
     @property
     def threshold(self):
         '''Return dictionary with thresholds'''
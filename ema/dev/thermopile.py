@@ -27,7 +27,7 @@ import logging
 
 from ema.emaproto  import THERMOINF
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('thermopil')
 
@@ -49,13 +49,14 @@ class Thermopile(Device):
 		publish_where = parser.get("THERMOPILE","thermop_publish_where").split(',')
 		publish_what = parser.get("THERMOPILE","thermop_publish_what").split(',')
 		Device.__init__(self, publish_where, publish_what)
-		self.infrared = Vector(N)
-		self.capsule  = Vector(N)
+		self.infrared = Vector(N, 'd')
+		self.capsule  = Vector(N, 'd')
 		ema.addCurrent(self)
 		ema.addAverage(self)
 
 
 	def add(self, message, matchobj):
+		self.touch()
 		log.debug("themopile.add(%s)", message)
 		temp = float(matchobj.group(1))
 		if message[THERMOINF] == '0':
@@ -63,7 +64,7 @@ class Thermopile(Device):
 		else:
 			self.capsule.append(temp)
 
-	@property
+	@memoized
 	def current(self):
 		'''Return dictionary with current measured values'''
 		return { 
@@ -71,7 +72,7 @@ class Thermopile(Device):
 			Thermopile.AMBIENT: (self.capsule.last()  , ' deg C')
 			}
 
-	@property
+	@memoized
 	def average(self):
 		'''Return dictionary of averaged values over a period of N samples'''
 		accum, n = self.infrared.sum()
@@ -80,4 +81,12 @@ class Thermopile(Device):
 		av2 = (accum / n, ' deg C')
 		return {  Thermopile.SKY: av1 , Thermopile.AMBIENT: av2 }
 
+	@memoized
+	def statistics(self):
+		'''Return dictionary of rolling statistics over a period of N samples'''
+		return {
+			Thermopile.SKY: (self.infrared.stats(1), ' deg C'),
+			Thermopile.AMBIENT: (self.capsule.stats(1), ' deg C')
+			}
+
 	
@@ -87,6 +87,10 @@ class Timer(Device, Alarmable2):
 		self.where    = None
 		self.i        = None
 		self.subscribedList = []
+		self.wakeup   = None	# native alarm, asyncio reactor only
+		if ema.loop is not None:
+			from ema.aio.server import Wakeup	# needs trollius
+			self.wakeup = Wakeup(self, ema.loop)
 		ema.addParameter(self)
 		ema.addCurrent(self)
 		ema.addAverage(self)
@@ -174,6 +178,10 @@ class Timer(Device, Alarmable2):
 		'''Program next alarm'''
 		t = int(durationFromNow(tMID).total_seconds())
 		log.info("Next check at %s, %d seconds from now",tMID.strftime("%H:%M:%S"), t)
+		if self.wakeup is not None:
+			self.wakeup.setTimeout(t)
+			self.wakeup.start()
+			return
 		self.setTimeout(t)
 		self.resetAlarm()
 		self.ema.addAlarmable(self)
@@ -24,10 +24,10 @@
 import logging
 import re
 
-from ema.emaproto  import SPSB, PERIOD
+from ema.emaproto  import PERIOD
 from ema.parameter import Parameter
 from ema.vector    import Vector
-from ema.device    import Device
+from ema.device    import Device, memoized
 
 log = logging.getLogger('voltmeter')
 
@@ -76,10 +76,11 @@ class Voltmeter(Device):
         self.ema         = ema
         self.offset      = Parameter(ema, offset, **OFFSET)
         self.thres       = Parameter(ema, thres, self.offset, **THRESHOLD)
-        self.voltage     = Vector(N)
         self.averlen     = int(round(time / PERIOD))
+        self.voltage     = Vector(N, window=self.averlen)
         self.lowvolt     = delta + thres
         ema.addSync(self.thres)
+        ema.restore(self.voltage, 'power')
         ema.subscribeStatus(self)
         ema.addCurrent(self)
         ema.addAverage(self)
@@ -89,25 +90,34 @@ class Voltmeter(Device):
 		ema.notifier.addScript('VoltageLow',mode,script)
        
 
-    def onStatus(self, message):
-        self.voltage.append(ord(message[SPSB]))
+    def onStatus(self, status):
+        self.touch()
+        self.voltage.append(status.power)
         accum, n = self.voltage.sum(self.averlen)
         average = accum / (n * 10.0)
         if average < self.lowvolt:
             self.ema.notifier.onEventExecute('VoltageLow', '--voltage', "%.1f" % average, '--threshold', "%.1f" % self.lowvolt, '--size' , str(n))
 
-    @property
+    @memoized
     def current(self):
         '''Return dictionary with current measured values'''
         return { Voltmeter.VOLTAGE: (self.voltage.last() / 10.0 , "V") }
 
 
-    @property
+    @memoized
     def average(self):
         '''Return dictionary of averaged values over a period of N samples'''
         accum, n = self.voltage.sum()
         return { Voltmeter.VOLTAGE: (accum/(10.0*n), "V") }
 
+    @memoized
+    def statistics(self):
+        '''Return dictionary of rolling statistics over a period of N samples'''
+        return {
+            Voltmeter.VOLTAGE: (self.voltage.stats(10), "V")
+            }
+
+
 
     @property
     def threshold(self):
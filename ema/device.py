@@ -21,10 +21,55 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 # ----------------------------------------------------------------------
 
+# ========================== DESIGN NOTES ==============================
+# Device properties (current, average, statistics, threshold and
+# parameter dictionaries) are read by every MQTT publishing cycle and
+# HTML page generation, some of them several times per page.
+#
+# Devices fed by samples declare current, average and statistics
+# @memoized instead of @property and call touch() on every new
+# sample, which bumps their generation counter. A memoized property
+# is computed at most once per generation and the result is shared by
+# all its consumers, so nothing is recomputed when no sample has
+# arrived since the last render.
+# Consumers must not modify the returned dictionaries.
+# Exceptions (i.e. empty vectors) are not cached.
+# Threshold and parameter dictionaries stay plain properties, as they
+# change on Parameter GET/SET replies and not on new samples.
+# ======================================================================
+
+
+class memoized(object):
+	'''Read only property computed once per device sample generation'''
+
+	def __init__(self, compute):
+		self.compute = compute
+		self.name    = compute.__name__
+		self.__doc__ = compute.__doc__
+
+	def __get__(self, device, owner=None):
+		if device is None:
+			return self
+		cache = device._Device__snapshots
+		entry = cache.get(self.name)
+		if entry is not None and entry[0] == device.generation:
+			return entry[1]
+		value = self.compute(device)
+		cache[self.name] = (device.generation, value)
+		return value
+
+
+
 class Device(object):
 
 	def __init__(self, publish_where=tuple(), publish_what=tuple()):
 		self.__publishable = [(where,what) for where in publish_where for what in publish_what]
+		self.__snapshots   = {}		# property name -> (generation, value)
+		self.generation    = 0
+
+	def touch(self):
+		'''Accounts a new sample, invalidating memoized properties'''
+		self.generation += 1
 	
 	@property
 	def name(self):
@@ -43,6 +88,12 @@ class Device(object):
 		return {}
 
 
+	@property
+	def statistics(self):
+		'''Return dictionary of rolling statistics over a period of N samples'''
+		return {}
+
+
 	@property
 	def threshold(self):
 		'''Return dictionary with thresholds'''
@@ -106,3 +106,192 @@ THERMOINF = 4 		# Thermopile digit string offset ('0' = infrared ; '1' = ambient
 MVI = 13	# Integer part
 MVD = 16	# decimal part
 
+
+# ---------------------------------------------------------------------
+# Status message decoder.
+# The whole status message is split in one pass by a precompiled
+# struct layout built from the offsets above and numeric fields are
+# converted once, so that status subscribers get a ready to use
+# StatusFrame record instead of slicing the message on their own.
+# Calibrated pressure and photometer fields have no consumer and
+# are left as strings.
+# ---------------------------------------------------------------------
+
+import struct
+from collections import namedtuple
+
+STATUS_FIELDS = (
+	('roof',        SRRB, SRRE),
+	('aux',         SARB, SARE),
+	('power',       SPSB, SPSE),
+	('rain',        SRAB, SRAE),
+	('cloud',       SCLB, SCLE),
+	('calpressure', SCBB, SCBE),
+	('abspressure', SABB, SABE),
+	('pluvcurrent', SPCB, SPCE),
+	('pluvaccum',   SPAB, SPAE),
+	('pyrometer',   SPYB, SPYE),
+	('photometer',  SPHB, SPHE),
+	('ambient',     SATB, SATE),
+	('humidity',    SRHB, SRHE),
+	('dewpoint',    SDPB, SDPE),
+	('windaccum',   SAAB, SAAE),
+	('windcurrent', SACB, SACE),
+	('winddir',     SWDB, SWDE),
+	('mtype',       SMTB, SMTE),
+)
+
+def layout(fields, length):
+	'''Builds a struct format string for fixed width fields'''
+	fmt = []
+	pos = 0
+	for name, begin, end in fields:
+		if begin > pos:
+			fmt.append('%dx' % (begin - pos))
+		fmt.append('%ds' % (end - begin))
+		pos = end
+	if length > pos:
+		fmt.append('%dx' % (length - pos))
+	return ''.join(fmt)
+
+STATUS = struct.Struct(layout(STATUS_FIELDS, STATLEN))
+
+
+class StatusFrame(namedtuple('StatusFrame', [f[0] for f in STATUS_FIELDS] + ['raw'])):
+	'''
+	Decoded EMA status message.
+	Numeric fields are ints, power is the raw byte value (0.1 V units),
+	roof, aux and mtype are single characters and raw is the message.
+	'''
+
+	__slots__ = ()
+
+	@classmethod
+	def decode(cls, message):
+		'''
+		Decodes a STATLEN status message.
+		Raises struct.error or ValueError on malformed messages.
+		'''
+		(roof, aux, power, rain, cloud, calpres, abspres, pluvcur, pluvacc,
+		pyro, photo, ambient, hum, dew, windacc, windcur, winddir, mtype) = STATUS.unpack(message)
+		return cls(roof, aux, ord(power), int(rain), int(cloud), calpres,
+			int(abspres), int(pluvcur), int(pluvacc), int(pyro), photo,
+			int(ambient), int(hum), int(dew), int(windacc), int(windcur),
+			int(winddir), mtype, message)
+
+	def encode(self, tail='0000'):
+		'''
+		Encodes the record as a STATLEN status message, the inverse
+		of decode(). tail fills the characters after the message type.
+		raw is ignored.
+		'''
+		msg = bytearray(' ' * STATLEN)
+		msg[0], msg[-1] = '(', ')'
+		for name, begin, end in STATUS_FIELDS:
+			value = getattr(self, name)
+			if name == 'power':
+				text = chr(value)
+			elif isinstance(value, basestring):
+				text = value
+			else:
+				text = '%0*d' % (end - begin, value)
+			if len(text) != end - begin:
+				raise ValueError("%s = %r does not fit in %d characters" % (name, value, end - begin))
+			msg[begin:end] = text
+		msg[SMTE:STATLEN-1] = tail
+		return str(msg)
+
+# ---------------------------------------------------------------------
+# Message routing keys.
+# EMA messages are very regular: the character after the opening
+# bracket mostly tells the message family, so it is used as a key to
+# route messages to a small set of candidate handlers instead of
+# trying every handler regexp. All digits map to the same '#' key
+# (timestamped messages). patternKey() gives the key of the messages
+# a regexp may match, or None if it may match any message.
+# ---------------------------------------------------------------------
+
+DIGITS = '#'
+
+def messageKey(message):
+	'''Routing key of a message'''
+	c = message[1:2]
+	return DIGITS if c.isdigit() else c
+
+
+def patternKey(pattern):
+	'''Routing key of the messages matched by a regexp pattern string'''
+	if not pattern.startswith('\\('):
+		return None
+	rest = pattern[2:]
+	if rest.startswith('\\d'):
+		key, tail = DIGITS, rest[2:]
+	elif rest[:1] == '\\' and rest[1:2] and not rest[1].isalnum():
+		key, tail = rest[1], rest[2:]
+	elif rest[:1] and rest[0] not in '.^$*+?{}[]|()\\':
+		key, tail = rest[0], rest[1:]
+	else:
+		return None
+	if tail[:1] in ('?', '*') or tail.startswith('{0'):
+		return None		# optional first character
+	return key
+
+
+# Routing key of the first response to a request, when it differs
+# from the request key in uppercase. None if there is no single one.
+REPLY = {
+	'y' : DIGITS,	# get RTC
+	'Y' : DIGITS,	# set RTC
+	'@' : None,		# bulk dump
+}
+
+def responseKey(request):
+	'''Routing key of the expected response to a request message'''
+	key = messageKey(request)
+	return REPLY[key] if key in REPLY else key.upper()
+
+# ---------------------------------------------------------------------
+# Local queries.
+# Messages like (!name args) arriving by UDP are answered by the
+# daemon itself and never forwarded to EMA. The reply is JSON text
+# split in numbered chunks (!name i/n text), small enough to fit in
+# a datagram and in a message buffer. ')' is escaped in text, which
+# is still valid JSON.
+# ---------------------------------------------------------------------
+
+import re
+
+QUERY = re.compile('\(!(\w+)(?: ([^)]*))?\)')
+CHUNK = re.compile('\(!(\w+) (\d+)/(\d+) ([^)]*)\)')
+
+CHUNKSIZE = 900
+
+def chunks(name, text, size=CHUNKSIZE):
+	'''Splits JSON text in reply messages to query name'''
+	text = text.replace(')', '\\u0029')
+	n = max(1, (len(text) + size - 1) // size)
+	return ['(!%s %d/%d %s)' % (name, i+1, n, text[i*size:(i+1)*size]) for i in range(n)]
+
+
+class Chunks(object):
+	'''Reassembles the JSON text of a chunked reply'''
+
+	def __init__(self, name):
+		self.name  = name
+		self.parts = {}
+		self.n     = None
+
+	def add(self, message):
+		'''Returns True if message was a chunk of the reply'''
+		matched = CHUNK.match(message)
+		if not matched or matched.group(1) != self.name:
+			return False
+		self.n = int(matched.group(3))
+		self.parts[int(matched.group(2))] = matched.group(4)
+		return True
+
+	def done(self):
+		return self.n is not None and len(self.parts) == self.n
+
+	def text(self):
+		return ''.join(self.parts[i+1] for i in range(self.n))
@@ -34,9 +34,35 @@
 # 3) Dispatchnig message events from Serial Port and UDP ports
 #  to the proper embedded objects
 #
+# Serial messages are dispatched through Routers, tables of handlers
+# indexed by the message routing key (see emaproto.messageKey), so that
+# only the handlers that may match a message are tried, instead of
+# every pending request and command regexp. Handlers declare their keys
+# with a routes() method; those without it are tried for any message.
+# Status messages are still recognized first by their length.
+#
+# Local queries (see emaproto.QUERY) coming by UDP, like (!stats),
+# are answered by the daemon itself with a chunked JSON reply.
+# stats() gathers the reactor callback histograms, the routing
+# counters and the serial, UDP and parameter sync statistics. It is
+# also published by MQTT if mqtt_publish_stats is set.
+#
+# The history store (if history_dir is set) is queried the same way,
+# without going to EMA through the serial line:
+#   (!series <field> [<from> [<to>]])
+#   (!aggregate <field> <minutes> [<from> [<to>]])
+# field is a status field of the history store, in raw EMA units.
+# from and to are UTC seconds, or seconds before now if not positive
+# (the last hour by default). series replies with the recorded values,
+# aggregate with the min, max and mean per window of minutes. Replies
+# are limited to the latest MAXROWS rows. Bad queries get an error
+# reply, so that clients do not have to wait for a timeout.
+#
 # ======================================================================
 
 import logging
+import time
+import json
 import re
 import os
 
@@ -49,8 +75,11 @@ import server
 import notifier
 import genpage
 import command
+import parameter
 
-from emaproto import STATLEN, MTCUR, SMTB
+from emaproto import STATLEN, MTCUR, SMTB, StatusFrame, messageKey, patternKey, QUERY, chunks
+from vector   import Vector
+from history  import StatusHistory
 
 import dev.rtc         as rtc
 import dev.watchdog    as wdog
@@ -72,10 +101,50 @@ import ConfigParser as parser
 
 log = logging.getLogger('emaserver')
 
+
+def routes(obj):
+	'''Routing keys of a handler, None meaning any message'''
+	return obj.routes() if hasattr(obj, 'routes') else (None,)
+
+
+class Router(object):
+	'''
+	Message handlers indexed by routing key (see emaproto.messageKey).
+	Handlers for any message are tried after the key specific ones.
+	'''
+
+	def __init__(self):
+		self.buckets = {}	# routing key -> handler list
+		self.keys    = {}	# handler -> routing keys
+
+	def add(self, obj):
+		keys = set(routes(obj))
+		self.keys[obj] = keys
+		for key in keys:
+			self.buckets.setdefault(key, []).append(obj)
+
+	def remove(self, obj):
+		for key in self.keys.pop(obj):
+			bucket = self.buckets[key]
+			bucket.pop(bucket.index(obj))
+			if not bucket:
+				del self.buckets[key]
+
+	def candidates(self, key):
+		'''Returns a new list of handlers to try for key'''
+		return self.buckets.get(key, []) + self.buckets.get(None, [])
+
+	def __len__(self):
+		return len(self.keys)
+
+
 class EMAServer(server.Server):
 
 	PERIOD = 5
 
+	# Maximum rows in a series or aggregate query reply
+	MAXROWS = 2000
+
 	# Unsolicited Responses Patterns
 	URPAT = ( '\(\d{2}:\d{2}:\d{2} wait\)' ,            # Photometer 1
 			  '\(\d{2}:\d{2}:\d{2} mv:\d{2}\.\d{2}\)' , # Photometer 2
@@ -86,15 +155,22 @@ class EMAServer(server.Server):
 	def __init__(self, configfile=None):
 		server.Server.__init__(self)
 		self.pattern = [re.compile(p) for p in EMAServer.URPAT]
+		self.unsolicited = {}	# routing key -> [(URPAT index, regexp)]
+		for index, pat in enumerate(EMAServer.URPAT):
+			self.unsolicited.setdefault(patternKey(pat), []).append((index, self.pattern[index]))
+		self.routeCount = {}	# (route, routing key) -> messages
 		self.syncDone = False
-		self.responseHandlers   = []	# parameter object response list
+		self.responseHandlers   = Router()	# parameter object response handlers
 		self.syncList           = []	# parameter object list for sync purposes
 		self.statusList         = []    # device list handling status messages
 		self.currentList        = []	# devices list holding current measurements
 		self.averageList        = []	# devices list holding average measurements
 		self.thresholdList      = []	# devices list containing thresholds
 		self.parameterList      = []	# devices lists containing calibraton constants
-		self.commandList        = []	# command list with active external commands
+		self.commandList        = Router()	# active external commands
+		self.scheduler          = parameter.SyncScheduler(self)	# parameter sync scheduler
+		self.history            = None	# optional on-disk history of status readings
+		self.loop               = None	# asyncio loop, only with the asyncio reactor
 		self.buildFrom(configfile)
 		self.sync()						# start the synchronization process
 
@@ -114,10 +190,27 @@ class EMAServer(server.Server):
 		self.syncNeeded = config.getboolean("GENERIC", "sync")
 		self.uploadPeriod = config.getfloat("GENERIC", "upload_period")
 		VECLEN =  int(round(self.uploadPeriod / EMAServer.PERIOD)) 
+		if config.has_option("GENERIC", "sync_window"):
+			self.scheduler.window = config.getint("GENERIC", "sync_window")
+		if config.has_option("GENERIC", "ewma_halflife"):
+			Vector.HALFLIFE = config.getfloat("GENERIC", "ewma_halflife") / EMAServer.PERIOD
 		lvl = config.get("GENERIC", "generic_log")
 		command.log.setLevel(lvl)
 		log.setLevel(lvl)
 
+		# Event loop selection, before any object gets registered
+		reactor = "select"
+		if config.has_option("GENERIC", "reactor"):
+			reactor = config.get("GENERIC", "reactor")
+		if reactor == "asyncio":
+			# trollius is only needed by this backend
+			import aio.server, aio.serdriver, aio.udpdriver
+			aioreactor = aio.server.AsyncioReactor()
+			self.setReactor(aioreactor)
+			self.loop = aioreactor.loop
+		else:
+			self.setReactor(reactor)
+
 		# Serial Port object Building
 		port = config.get("SERIAL", "serial_port")
 		baud = config.getint("SERIAL", "serial_baud")
@@ -125,10 +218,14 @@ class EMAServer(server.Server):
 		lvl = config.get("SERIAL", "serial_log")
 		serdriver.log.setLevel(lvl)
 
-		self.serdriver = serdriver.SerialDriver(port,baud,**opts)
-		self.serdriver.addHandler(self)
-		self.addLazy(self.serdriver)
-		self.addReadable(self.serdriver)
+		if reactor == "asyncio":
+			self.serdriver = aio.serdriver.SerialDriver(port,baud,**opts)
+			self.serdriver.addHandler(self)
+		else:
+			self.serdriver = serdriver.SerialDriver(port,baud,**opts)
+			self.serdriver.addHandler(self)
+			self.addLazy(self.serdriver)
+			self.addReadable(self.serdriver)
 				
 		# Multicast UDP object building
 		ip      = config.get("UDP", "mcast_ip")
@@ -139,9 +236,13 @@ class EMAServer(server.Server):
 		lvl = config.get("UDP", "udp_log")
 		udpdriver.log.setLevel(lvl)
 
-		self.udpdriver = udpdriver.UDPDriver(ip, rx_port, tx_port, **opts)
-		self.udpdriver.addHandler(self)
-		self.addReadable(self.udpdriver)
+		if reactor == "asyncio":
+			self.udpdriver = aio.udpdriver.UDPDriver(ip, rx_port, tx_port, **opts)
+			self.udpdriver.addHandler(self)
+		else:
+			self.udpdriver = udpdriver.UDPDriver(ip, rx_port, tx_port, **opts)
+			self.udpdriver.addHandler(self)
+			self.addReadable(self.udpdriver)
 
 		# Builds Notifier object which executes scripts
 		self.notifier = notifier.Notifier()
@@ -155,6 +256,15 @@ class EMAServer(server.Server):
 		# MQTT Driver object 
 		self.mqttclient = mqttclient.MQTTClient(self, config, **opts)
 
+		# Optional history store, built before the devices restore their vectors
+		if config.has_option("GENERIC", "history_dir"):
+			days = 1
+			if config.has_option("GENERIC", "history_days"):
+				days = config.getfloat("GENERIC", "history_days")
+			self.history = StatusHistory(config.get("GENERIC", "history_dir"),
+										 int(days * 86400 / EMAServer.PERIOD))
+			self.subscribeStatus(self.history)
+
 		# Builds RTC Object
 		self.rtc = rtc.RTC(self, config)
 		
@@ -228,7 +338,7 @@ class EMAServer(server.Server):
 		Add a parameter request to the lists of pending responses.
 		Used by AbstractParameter.
 		'''
-		self.responseHandlers.append(obj)
+		self.responseHandlers.add(obj)
 
 
 	def delRequest(self, obj):
@@ -236,7 +346,7 @@ class EMAServer(server.Server):
 		Deleted a parameter request from the list of pending responses.
 		Used by AbstractParameter.
 		'''
-		self.responseHandlers.pop(self.responseHandlers.index(obj))
+		self.responseHandlers.remove(obj)
 
 
 	def addSync(self, obj):
@@ -245,9 +355,9 @@ class EMAServer(server.Server):
 
 
 	def isSyncDone(self):
-		if self.syncDone:
+		if self.syncDone or not self.syncNeeded:
 			return True
-		accum = True
+		accum = self.scheduler.idle()
 		for obj in self.syncList:
 			accum &= obj.isDone()
 		self.syncDone = accum
@@ -273,13 +383,26 @@ class EMAServer(server.Server):
 		'''Add object implementing parameter @property'''
 		self.parameterList.append(obj)
 
+	def restore(self, vector, field):
+		'''
+		Rehydrate vector with the field samples stored in the
+		history store during the last vector window, if any.
+		'''
+		if self.history is None:
+			return
+		since = time.time() - vector.N * EMAServer.PERIOD
+		samples = self.history.tail(field, vector.N, since)
+		vector.extend(samples)
+		log.debug("restored %d %s samples", len(samples), field)
+
 	# -------------------------------------------------
 	# Specialied handlers from incoming Serial Messages
 	# -------------------------------------------------
 
 	def subscribeStatus(self, obj):
 		'''Add object collecting measurements from 
-		periodic status message, implementing onStatus()'''
+		periodic status message, implementing onStatus(status)
+		where status is a decoded emaproto.StatusFrame'''
 		self.statusList.append(obj)
 
 
@@ -289,21 +412,25 @@ class EMAServer(server.Server):
 		# Only handles current value messages (type 'a')
 		# if and only if al paramters are syncronized
 		if len(message) == STATLEN and message[SMTB] == MTCUR and self.isSyncDone():
+			try:
+				status = StatusFrame.decode(message)
+			except ValueError as e:
+				log.error("Discarding malformed status message %s: %s", message, e)
+				return True
 			# Loop to distribute to interested parties
 			for obj in self.statusList:
-				obj.onStatus(message)
+				obj.onStatus(status)
 			self.broadcastUDP(message)
 			flag = True
 		return flag
 
 
-	def handleUnsolicited(self, message):
+	def handleUnsolicited(self, message, key):
 		'''Handle most common unsolicited responses whose patterns are declared in URPAT'''
 		flag = False
-		for pat in self.pattern:
+		for index, pat in self.unsolicited.get(key, []) + self.unsolicited.get(None, []):
 			matched = pat.search(message)
 			if matched:
-				index = self.pattern.index(pat)
 				if   index == 0:  # start visual magnitude reading
 					self.serdriver.hold(True)
 				elif index == 1: # end visual magnitude reading
@@ -319,10 +446,10 @@ class EMAServer(server.Server):
 		return flag
 
 
-	def handleRequest(self, message):
+	def handleRequest(self, message, key):
 		'''Handler for internal requests like Parameter sync requests'''
 		flag = False
-		for handler in self.responseHandlers:
+		for handler in self.responseHandlers.candidates(key):
 			if handler.onResponseDo(message):
 				flag = True
 				self.broadcastUDP(message)
@@ -330,10 +457,10 @@ class EMAServer(server.Server):
 		return flag
 
 
-	def handleCommand(self, message):
+	def handleCommand(self, message, key):
 		'''Handler for requests from external hosts'''
 		flag = False
-		for handler in self.commandList:
+		for handler in self.commandList.candidates(key):
 			if handler.onResponseDo(message):
 				flag = True
 				break
@@ -348,14 +475,14 @@ class EMAServer(server.Server):
 		'''
 		Add an external command request to the lists of pending commands.
 		'''
-		self.commandList.append(obj)
+		self.commandList.add(obj)
 
 
 	def delCommand(self, obj):
 		'''
 		Delete an external command request from the lists of pending commands.
 		'''
-		self.commandList.pop(self.commandList.index(obj))
+		self.commandList.remove(obj)
 
 
 	def broadcastUDP(self, message):
@@ -367,24 +494,43 @@ class EMAServer(server.Server):
 	# Event handlers from Serial and UDP Drivers
 	# ------------------------------------------
 
+	def count(self, route, key):
+		'''Accounts a message taking route'''
+		k = (route, key)
+		self.routeCount[k] = self.routeCount.get(k, 0) + 1
+
+
+	def routeStats(self):
+		'''Returns a dictionary of message counts per 'route/key' '''
+		return dict(("%s/%s" % k, n) for k, n in self.routeCount.iteritems())
+
+
 	def onSerialMessage(self, message):
 		'''
 		Generic message handler that dispatches to more specialized message 
-		handlers in turn, by priority
+		handlers in turn, by priority. Only the handlers registered for
+		the message routing key (and those for any message) are tried.
 		'''
-		if self.handleStatus(message):
-			log.debug("handled as ordinary Status Message")
-			return
-		if self.handleRequest(message):
+		if len(message) == STATLEN:
+			if self.handleStatus(message):
+				log.debug("handled as ordinary Status Message")
+				self.count('status', MTCUR)
+				return
+		key = messageKey(message)
+		if self.responseHandlers and self.handleRequest(message, key):
 			log.debug("handled as parameter sync request")
+			self.count('request', key)
 			return
-		if self.handleUnsolicited(message):
-			log.debug("handled as ordinary Status Message")
+		if self.handleUnsolicited(message, key):
+			log.debug("handled as unsolicited response")
+			self.count('unsolicited', key)
 			return
-		if self.handleCommand(message):
+		if self.commandList and self.handleCommand(message, key):
 			log.debug("handled as Command")
+			self.count('command', key)
 			return
 		log.debug("unhandled message from EMA")
+		self.count('unhandled', key)
 
 
 
@@ -393,6 +539,10 @@ class EMAServer(server.Server):
 		Handle incoming commands from UDP driver.
 		Only create and execute command objects for implemented commands.
 		'''
+		matched = QUERY.match(message)
+		if matched:
+			self.onQuery(matched.group(1), matched.group(2), origin)
+			return
 		cmddesc = command.match(message)
 		if cmddesc:
 			cmd = ExternalCommand(self, **cmddesc)
@@ -401,12 +551,80 @@ class EMAServer(server.Server):
 			self.serdriver.write(message)
 		
 
+
+	def onQuery(self, name, args, origin):
+		'''Answers a local query to the originating host'''
+		if name == 'stats':
+			result = self.stats()
+		elif name in ('series', 'aggregate'):
+			result = self.timeseries(name, args.split() if args else [])
+		else:
+			log.warning("Unknown query %s from %s", name, origin)
+			return
+		for chunk in chunks(name, json.dumps(result, separators=(',',':'), sort_keys=True)):
+			self.udpdriver.write(chunk, origin[0])
+
+
+	def timeseries(self, name, args):
+		'''
+		Answers series and aggregate queries from the history store.
+		Returns a dictionary of lists, or with an error message.
+		'''
+		if self.history is None:
+			return {'error': 'history store not enabled'}
+		try:
+			field  = args.pop(0)
+			if field not in self.history.fields:
+				raise ValueError("unknown field %s" % field)
+			window = float(args.pop(0)) * 60 if name == 'aggregate' else None
+			bounds = [float(arg) for arg in args[:2]]
+		except IndexError:
+			return {'error': 'missing arguments'}
+		except ValueError as e:
+			return {'error': str(e)}
+		if window is not None and window <= 0:
+			return {'error': 'window must be positive'}
+		now = time.time()
+		t0, t1 = [t if t > 0 else now + t for t in (bounds + [-3600, 0][len(bounds):])]
+		if window is None:
+			times, values = self.history.select(field, t0, t1)
+			result = {'time': [round(t, 3) for t in times], 'value': values.tolist()}
+		else:
+			result = self.history.aggregate(field, t0, t1, window)
+			result['window'] = window
+		result['field'] = field
+		n = len(result['time'])
+		if n > EMAServer.MAXROWS:
+			for key, column in result.items():
+				if isinstance(column, list):
+					result[key] = column[n - EMAServer.MAXROWS:]
+			result['truncated'] = True
+		return result
+
+
+	def stats(self):
+		'''Returns a dictionary with the daemon instrumentation'''
+		serial = self.serdriver.pacing()
+		serial.update(self.serdriver.counters())
+		return {
+			'loop'   : self.instruments.snapshot(),
+			'routes' : self.routeStats(),
+			'sync'   : self.scheduler.stats(),
+			'serial' : serial,
+			'udp'    : self.udpdriver.counters(),
+			'mqtt'   : self.mqttclient.counters(),
+		}
+
 	# --------------
 	# Server Control
 	# --------------
 
 	def stop(self):
 		log.info("Shutting down EMA server")
+		self.genpage.close()
+		self.mqttclient.close()
+		if self.history is not None:
+			self.history.close()
 		logging.shutdown()
 
 
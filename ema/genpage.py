@@ -51,11 +51,31 @@
 # sample values are available at startup (depends on the page generation
 #  rate) and this causes exceptions. These are caught, logged and
 # silently ignored.
+#
+# The page is now compiled once into a template: a list of static HTML
+# fragments and one Block slot per published device in each table.
+# Blocks keep a Cell per measurement and only re-format the cells
+# whose values changed since the previous render. A device that is
+# not ready yet is logged once and not retried until it gets a new
+# sample (see Device.generation).
+#
+# The rendered page is hashed, without the footer timestamp, and the
+# file is only rewritten when the hash changes, so an idle station
+# does not wear the SD card. The timestamp therefore tells when the
+# contents last changed.
+#
+# If html_http_port is set, no file is written at all. The page is
+# kept in memory and served by HTTPResponder, a tiny HTTP/1.0 server
+# running in the same reactor. It answers any GET or HEAD request
+# with the page and honours If-None-Match with the page hash as ETag.
 # ======================================================================
 
 import logging
 import os
 import os.path
+import errno
+import socket
+import hashlib
 import datetime
 
 from server import Lazy, Server
@@ -177,128 +197,190 @@ PARAMETER = {
 
 
 
-class HTML(Lazy):
-	TEMPNAME = '.ema.html'
 
-	def __init__(self, ema, parser):
-                lvl      = parser.get("HTML", "html_log")
-		log.setLevel(lvl)
-		path     = parser.get("HTML", "html_file")
-                period   = parser.getfloat("HTML", "html_period")
-		Lazy.__init__(self, period)
-		self.path     = path
-		self.dirname  = os.path.dirname(path)
-		self.ema  = ema
-		ema.addLazy(self)
-		
 
-	def generate(self):
-		'''Generates an HTML page on to prediefined path'''
-		tempfile = os.path.join(self.dirname, HTML.TEMPNAME) 
-		with open(tempfile, 'w') as page:
-			self.globalHeader(page)
-			self.instantTable(page)
-			self.parameterTable(page)
-			self.averagesTable(page)
-			t = datetime.datetime.now().replace(microsecond=0).isoformat(' ')
-			self.globalFooter(page, t)
-		# os.rename is atomic in Linux, not in Windows
-		os.rename(tempfile, self.path)
-		#log.debug("Generated HTML page")
+HTTP_RESPONSE = 'HTTP/1.0 %s\r\nContent-Type: text/html; charset=UTF-8\r\nContent-Length: %d\r\n%sCache-Control: no-cache\r\nConnection: close\r\n\r\n'
+HTTP_ETAG     = 'ETag: "%s"\r\n'
 
-	# --------------------------
-	# HTML page generation parts
-	# --------------------------
 
-	
+def header(status, length, digest):
+	'''HTTP response header, with an ETag only if there is a page digest'''
+	etag = HTTP_ETAG % digest if digest is not None else ''
+	return HTTP_RESPONSE % (status, length, etag)
 
-	def instantTable(self, page):
-		self.tableHeader(page, 'Valores actuales')
-		self.tableRowsCurrent(page)
-		self.tableFooter(page)
 
 
-	def averagesTable(self, page):
-		self.tableHeader(page, 'Valores promedio')
-		self.tableRowsAverage(page)
-		self.tableFooter(page)
+class Cell(object):
+	'''Template slot for a measurement, formatted only when its values change'''
 
+	def __init__(self, fmt):
+		self.fmt    = fmt
+		self.values = None
+		self.text   = ''
 
-	def globalHeader(self, page):
-		page.write(HEADER)
+	def update(self, values):
+		'''Returns True if the cell was re-rendered'''
+		if values == self.values:
+			return False
+		self.values = values
+		self.text   = self.fmt % values
+		return True
 
 
-	def globalFooter(self, page, timestamp):
-		page.write(FOOTER % timestamp)
 
+class Block(object):
+	'''
+	Template slot for the rows of a device in a table.
+	rows(device) returns a list of (key, values) tuples,
+	values being the arguments of the fmt row format.
+	'''
 
-	def tableHeader(self, page, caption):
-		page.write(TABLE_HEADER % caption)
+	def __init__(self, device, rows, fmt, table):
+		self.device = device
+		self.rows   = rows
+		self.fmt    = fmt
+		self.table  = table
+		self.head   = TABLE_COLSPAN % (3, DEVICE[device.name])
+		self.keys   = []
+		self.cells  = {}
+		self.text   = self.head
+		self.failed = None		# generation of the last failure
 
+	def update(self):
+		'''Returns True if the block was re-rendered'''
+		generation = getattr(self.device, 'generation', 0)
+		if self.failed is not None and self.failed == generation and generation:
+			return False
+		try:
+			rows = self.rows(self.device)
+		except (IndexError, ZeroDivisionError) as e:
+			if self.failed is None:
+				log.warning("(%s) Too early for HTML page generation of %s, got %s", self.table, self.device.name, e)
+			self.failed = generation
+			return False
+		self.failed = None
+		keys    = [key for key, values in rows]
+		changed = keys != self.keys
+		if changed:
+			self.keys  = keys
+			self.cells = dict((key, self.cells.get(key) or Cell(self.fmt)) for key in keys)
+		for key, values in rows:
+			changed |= self.cells[key].update(values)
+		if changed:
+			self.text = self.head + ''.join(self.cells[key].text for key in self.keys)
+		return changed
 
-	def tableFooter(self,page):
-		page.write(TABLE_FOOTER)
 
 
-	def tableRow(self, page, name, value, units, thres=None, unitthres=None):
-		page.write(TABLE_ROW % (MEASUREMENT[name], value, units, thres, unitthres) )
+class HTML(Lazy):
+	TEMPNAME = '.ema.html'
+
+	def __init__(self, ema, parser):
+		lvl      = parser.get("HTML", "html_log")
+		log.setLevel(lvl)
+		path     = parser.get("HTML", "html_file")
+		period   = parser.getfloat("HTML", "html_period")
+		port     = 0
+		if parser.has_option("HTML", "html_http_port"):
+			port = parser.getint("HTML", "html_http_port")
+		Lazy.__init__(self, period)
+		self.path     = path
+		self.dirname  = os.path.dirname(path)
+		self.ema      = ema
+		self.parts    = None	# compiled template
+		self.blocks   = []
+		self.digest   = None
+		self.page     = None
+		self.http     = HTTPResponder(ema, self, port) if port else None
+		ema.addLazy(self)
 
 
-	def tableDevice(self, page, device):
-		page.write(TABLE_COLSPAN % (3, DEVICE[device.name]))
+	def generate(self):
+		'''Generates an HTML page on to prediefined path, if it changed'''
+		if self.parts is None:
+			self.compile()
+		for block in self.blocks:
+			block.update()
+		body   = ''.join(part if isinstance(part, basestring) else part.text for part in self.parts)
+		digest = hashlib.sha1(body).hexdigest()
+		if digest == self.digest:
+			log.debug("HTML page unchanged")
+			return
+		self.digest = digest
+		t = datetime.datetime.now().replace(microsecond=0).isoformat(' ')
+		self.page = body + FOOTER % t
+		if self.http is None:
+			self.write()
 
 
-	def tableRowsCurrent(self, page):
+	def write(self):
+		'''Writes the page to the predefined path'''
+		tempfile = os.path.join(self.dirname, HTML.TEMPNAME)
+		with open(tempfile, 'w') as page:
+			page.write(self.page)
+		# os.rename is atomic in Linux, not in Windows
+		os.rename(tempfile, self.path)
+		#log.debug("Generated HTML page")
+
+
+	def close(self):
+		if self.http is not None:
+			self.http.close()
+
+	# ---------------------------
+	# HTML page template building
+	# ---------------------------
+
+	def compile(self):
+		'''Compiles the page template for the registered devices'''
+		parts = [HEADER]
+		parts.append(TABLE_HEADER % 'Valores actuales')
 		for device in self.ema.currentList:
 			if not ('html','current') in device.publishable:
 				log.debug("(current) skipping publihing Device = %s", device.name)
 				continue
-			self.tableDevice(page, device)
-			try:
-				for key,value in device.current.iteritems():
-					val = value[0] ; unit=value[1]  
-					th, uth = device.threshold.get(key,('',''))
-					self.tableRow(page, key, val, unit, th, uth)
-			except IndexError as e:
-					log.warning("(current) Too early for HTML page generation, got %s", e)
-			
-
-	def tableRowsAverage(self, page):
+			parts.append(Block(device, self.rowsCurrent, TABLE_ROW, 'current'))
+		parts.append(TABLE_FOOTER)
+		parts.append(TABLE_HEADER % 'Parametros de ajuste')
+		for device in self.ema.parameterList:
+			parts.append(Block(device, self.rowsParameter, TABLE_ROW, 'parameters'))
+		parts.append(TABLE_FOOTER)
+		parts.append(TABLE_HEADER % 'Valores promedio')
 		for device in self.ema.averageList:
 			if not ('html','average') in device.publishable:
-                                log.debug("(average) skipping publihing Device = %s", device.name)
-                                continue
-			self.tableDevice(page, device)
-			try:
-				for key,value in device.average.iteritems():
-					val = value[0] ; unit=value[1]
-					th, uth = device.threshold.get(key,('',''))
-					self.tableRow(page, key, val, unit, th, uth)
-			except (IndexError, ZeroDivisionError) as e:
-				log.warning("(average) Too early for HTML page generation, got %s", e)
-					
-	def parameterTable(self, page):
-		self.tableHeader(page, 'Parametros de ajuste')
-		self.tableRowsParameter(page)
-		self.tableFooter(page)
-
-
-	def tableRowsParameter(self, page):
-		for device in self.ema.parameterList:
-			self.tableDevice(page, device)
-			try:
-				for par in device.parameter:
-					value, unit = device.parameter[par]
-					self.tableRowParameter(page, par, value, unit)
-			except IndexError as e:
-					log.warning("(parameters) Too early for HTML page generation, got %s", e)
-			except KeyError as e:
-					log.debug("(parameters) Ignoring missing parameter for %s",e)
+				log.debug("(average) skipping publihing Device = %s", device.name)
+				continue
+			parts.append(Block(device, self.rowsAverage, TABLE_ROW, 'average'))
+		parts.append(TABLE_FOOTER)
+		self.parts  = parts
+		self.blocks = [part for part in parts if isinstance(part, Block)]
+		log.debug("Compiled HTML page template with %d device blocks", len(self.blocks))
+
 
-	def tableRowParameter(self, page, name, value, units):
-		page.write(TABLE_ROW % (PARAMETER[name], value, units, '', '') )
+	def rowsCurrent(self, device):
+		return self.rowsMeasurement(device.current, device.threshold)
 
 
+	def rowsAverage(self, device):
+		return self.rowsMeasurement(device.average, device.threshold)
+
+
+	def rowsMeasurement(self, values, threshold):
+		rows = []
+		for key, value in values.iteritems():
+			th, uth = threshold.get(key,('',''))
+			rows.append((key, (MEASUREMENT[key], value[0], value[1], th, uth)))
+		return rows
+
+
+	def rowsParameter(self, device):
+		rows = []
+		for par, (value, unit) in device.parameter.iteritems():
+			if par not in PARAMETER:
+				log.debug("(parameters) Ignoring missing parameter for %s", par)
+				continue
+			rows.append((par, (PARAMETER[par], value, unit, '', '')))
+		return rows
 
 	# -------------------------------
 	# Implemanting the Lazy interface
@@ -311,5 +393,149 @@ class HTML(Lazy):
 			return
 		self.generate()
 
+
+
+class HTTPResponder(object):
+	'''
+	Listening socket serving the page kept in memory by an HTML object.
+	'''
+
+	MAXCONN = 8		# oldest connection is dropped beyond this
+
+	def __init__(self, server, html, port, host=''):
+		self.server = server
+		self.html   = html
+		self.conns  = []
+		self.sock   = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.sock.bind((host, port))
+		self.sock.listen(5)
+		self.sock.setblocking(False)
+		server.addReadable(self)
+		log.info("Serving HTML page on TCP port %d (all interfaces)", port)
+
+
+	def fileno(self):
+		return self.sock.fileno()
+
+
+	def onInput(self):
+		'''Accepts a new client connection'''
+		try:
+			sock, address = self.sock.accept()
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				log.error(e)
+			return
+		if len(self.conns) >= HTTPResponder.MAXCONN:
+			self.conns[0].close()
+		self.conns.append(HTTPConnection(self, sock, address))
+
+
+	def response(self, request):
+		'''Returns the full HTTP response to request'''
+		lines  = request.split('\r\n')
+		method = lines[0].split(' ', 1)[0]
+		page   = self.html.page
+		digest = self.html.digest
+		if method not in ('GET', 'HEAD'):
+			return header('405 Method Not Allowed', 0, None)
+		if page is None:
+			return header('503 Service Unavailable', 0, None)
+		for line in lines[1:]:
+			name, _, value = line.partition(':')
+			if name.strip().lower() == 'if-none-match' and digest in value:
+				return header('304 Not Modified', 0, digest)
+		response = header('200 OK', len(page), digest)
+		return response if method == 'HEAD' else response + page
+
+
+	def close(self):
+		for conn in self.conns[:]:
+			conn.close()
+		self.server.delReadable(self)
+		self.sock.close()
+
+
+
+class HTTPConnection(object):
+	'''
+	A client connection. Reads one request, writes the response
+	without blocking and closes.
+	'''
+
+	MAXREAD    = 4096
+	MAXREQUEST = 8192
+
+	def __init__(self, responder, sock, address):
+		self.responder = responder
+		self.server    = responder.server
+		self.sock      = sock
+		self.address   = address
+		self.request   = ''
+		self.response  = ''
+		self.reading   = True
+		self.writing   = False
+		self.sock.setblocking(False)
+		self.server.addReadable(self)
+
+
+	def fileno(self):
+		return self.sock.fileno()
+
+
+	def onInput(self):
+		try:
+			data = self.sock.recv(HTTPConnection.MAXREAD)
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				log.debug("%s: %s", self.address, e)
+				self.close()
+			return
+		if not data:
+			self.close()
+			return
+		self.request += data
+		if '\r\n\r\n' not in self.request:
+			if len(self.request) > HTTPConnection.MAXREQUEST:
+				log.warning("Too long HTTP request from %s", self.address)
+				self.close()
+			return
+		self.server.delReadable(self)
+		self.reading  = False
+		self.response = self.responder.response(self.request)
+		self.onOutput()
+		if self.sock is not None and not self.writing:
+			self.server.addWritable(self)
+			self.writing = True
+
+
+	def onOutput(self):
+		'''Writes the rest of the response, closing when done'''
+		try:
+			n = self.sock.send(self.response)
+		except socket.error as e:
+			if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+				log.debug("%s: %s", self.address, e)
+				self.close()
+			return
+		self.response = self.response[n:]
+		if not self.response:
+			self.close()
+
+
+	def close(self):
+		if self.sock is None:
+			return
+		if self.reading:
+			self.server.delReadable(self)
+		if self.writing:
+			self.server.delWritable(self)
+		self.sock.close()
+		self.sock = None
+		self.responder.conns.remove(self)
+
+
+
 if __name__ == '__main__':
 	HTML().generate()
@@ -0,0 +1,292 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# Vectors keep their samples in RAM only, so restarting the daemon used
+# to lose every averaging window until it filled up again.
+#
+# The history store keeps the readings in the periodic status messages
+# on disk in columnar form: one fixed width binary file per status
+# field plus a shared timestamp column, all rows appended at the same
+# time. Each column is a ring of 'capacity' records in a memory mapped
+# file, so appending is just storing a few bytes in place and the SD
+# card only sees sequential writes, done by the kernel page writeback.
+#
+# Timestamps are UTC seconds kept non decreasing, so a time range is
+# looked up with a binary search in O(log n). Samples older than the
+# last row or too far ahead of the system clock are rejected, instead
+# of being clamped to the last timestamp. If the last row itself is
+# too far ahead of the clock (i.e. rows were stamped with a wrong RTC
+# before NTP stepped the clock back), the stored rows cannot be put in
+# order with the new ones and the store is cleared.
+#
+# On startup, devices rehydrate their Vectors with the samples stored
+# during the last window (see EMAServer.restore()), so that averages
+# are valid right away.
+#
+# Column file layout: a HEADER with magic, typecode, capacity and the
+# number of rows ever appended, followed by capacity fixed width
+# records. The row count is written after the record, and on opening
+# all columns are trimmed to the shortest one, so that a crash in the
+# middle of an append leaves a consistent store.
+#
+# aggregate() answers windowed queries (see EMAServer.onQuery) without
+# a Python loop per row: window boundaries are found by binary search
+# in the selected timestamps and min(), max() and sum() run on array
+# slices.
+# ======================================================================
+
+import os
+import mmap
+import time
+import array
+import struct
+import logging
+from   bisect import bisect_left
+
+log = logging.getLogger('history')
+
+
+
+class Column(object):
+	'''
+	Fixed width binary column in a memory mapped ring file.
+	'''
+
+	MAGIC  = 'EMAH'
+	HEADER = struct.Struct('<4sc3xIQ')
+	OFFSET = 32                # first record offset
+
+	def __init__(self, path, typecode, capacity):
+		self.path     = path
+		self.typecode = typecode
+		self.itemsize = array.array(typecode).itemsize
+		exists = os.path.exists(path)
+		self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+		if exists:
+			header = os.read(self.__fd, Column.HEADER.size)
+			magic, code, cap, count = Column.HEADER.unpack(header) \
+				if len(header) == Column.HEADER.size else (None,)*4
+			if magic == Column.MAGIC and code == typecode:
+				if cap != capacity:
+					log.info("%s keeps its capacity of %d records", path, cap)
+				capacity = cap
+			else:
+				log.warning("%s is not a %s history column, recreating", path, typecode)
+				exists = False
+		self.capacity = capacity
+		size = Column.OFFSET + capacity * self.itemsize
+		if os.fstat(self.__fd).st_size < size:
+			os.ftruncate(self.__fd, size)
+		self.__mm  = mmap.mmap(self.__fd, size)
+		self.count = count if exists else 0
+		if not exists:
+			self.__commit()
+
+
+	def __commit(self):
+		Column.HEADER.pack_into(self.__mm, 0, Column.MAGIC, self.typecode, self.capacity, self.count)
+
+
+	def truncate(self, count):
+		'''Forgets rows appended beyond count'''
+		self.count = min(self.count, count)
+		self.__commit()
+
+
+	def first(self):
+		'''Index of the oldest row still stored'''
+		return max(0, self.count - self.capacity)
+
+
+	def append(self, value):
+		off = Column.OFFSET + (self.count % self.capacity) * self.itemsize
+		struct.pack_into(self.typecode, self.__mm, off, value)
+		self.count += 1
+		self.__commit()
+
+
+	def __getitem__(self, i):
+		'''Value at absolute row index i'''
+		off = Column.OFFSET + (i % self.capacity) * self.itemsize
+		return struct.unpack_from(self.typecode, self.__mm, off)[0]
+
+
+	def slice(self, lo, hi):
+		'''Returns an array with rows [lo, hi)'''
+		result = array.array(self.typecode)
+		while lo < hi:
+			i   = lo % self.capacity
+			n   = min(hi - lo, self.capacity - i)
+			off = Column.OFFSET + i * self.itemsize
+			result.fromstring(self.__mm[off:off + n*self.itemsize])
+			lo += n
+		return result
+
+
+	def close(self):
+		self.__mm.flush()
+		self.__mm.close()
+		os.close(self.__fd)
+
+
+
+class HistoryStore(object):
+	'''
+	Columnar store of timestamped rows, one column per field.
+	'''
+
+	TIME = 'time'
+
+	# Max. seconds a timestamp may be ahead of the system clock
+	MAX_SKEW = 300
+
+	def __init__(self, directory, fields, capacity, typecode='i'):
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		self.directory = directory
+		self.fields    = tuple(fields)
+		self.__time    = Column(os.path.join(directory, HistoryStore.TIME), 'd', capacity)
+		self.__columns = dict((field, Column(os.path.join(directory, field), typecode, capacity))
+							  for field in self.fields)
+		# Recover from an append interrupted by a crash
+		columns = [self.__time] + self.__columns.values()
+		count   = min(c.count for c in columns)
+		for c in columns:
+			if c.count != count:
+				log.warning("%s has %d rows, trimming to %d", c.path, c.count, count)
+				c.truncate(count)
+		self.__last = self.__time[count - 1] if self.__time.count > self.__time.first() else 0.0
+		if self.__last > time.time() + HistoryStore.MAX_SKEW:
+			self.clear()
+		log.info("History store in %s with %d rows", directory, len(self))
+
+
+	def __len__(self):
+		return self.__time.count - self.__time.first()
+
+
+	def append(self, values, timestamp=None):
+		'''Appends a row with values, a dictionary keyed by field'''
+		now = time.time()
+		t   = now if timestamp is None else timestamp
+		if t > now + HistoryStore.MAX_SKEW:
+			log.warning("Rejecting history sample at %s, ahead of system clock", t)
+			return
+		if t < self.__last:
+			if self.__last <= now + HistoryStore.MAX_SKEW:
+				log.warning("Rejecting history sample at %s, older than last row at %s", t, self.__last)
+				return
+			self.clear()
+		self.__last = t
+		for field in self.fields:
+			self.__columns[field].append(values[field])
+		self.__time.append(t)              # row complete
+
+
+	def clear(self):
+		'''Forgets all rows, stamped ahead of the system clock'''
+		log.error("History in %s is ahead of system clock (last row at %s), discarding %d rows",
+			self.directory, self.__last, len(self))
+		for c in [self.__time] + self.__columns.values():
+			c.truncate(0)
+		self.__last = 0.0
+
+
+	def bisect(self, t):
+		'''Returns the index of the first row with timestamp >= t'''
+		times = self.__time
+		lo, hi = times.first(), times.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if times[mid] < t:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+
+	def select(self, field, t0, t1=None):
+		'''
+		Returns a tuple of arrays (timestamps, values) of field
+		for rows with t0 <= timestamp < t1.
+		'''
+		lo = self.bisect(t0)
+		hi = self.__time.count if t1 is None else self.bisect(t1)
+		return (self.__time.slice(lo, hi), self.__columns[field].slice(lo, hi))
+
+
+	def tail(self, field, n, since=None):
+		'''Returns an array with the last n values of field, not older than since'''
+		hi = self.__time.count
+		lo = max(hi - n, self.__time.first())
+		if since is not None:
+			lo = max(lo, self.bisect(since))
+		return self.__columns[field].slice(lo, hi)
+
+
+	def aggregate(self, field, t0, t1, window):
+		'''
+		Returns a dictionary of lists with the start time, number of
+		samples, minimum, maximum and mean of field in [t0, t1), per
+		window seconds aligned to UTC multiples of window.
+		Windows without samples are left out.
+		'''
+		times, values = self.select(field, t0, t1)
+		result = dict((key, []) for key in ('time', 'n', 'min', 'max', 'mean'))
+		lo = 0
+		while lo < len(times):
+			start  = times[lo] - times[lo] % window
+			hi     = bisect_left(times, start + window, lo)
+			sample = values[lo:hi]
+			result['time'].append(start)
+			result['n'].append(hi - lo)
+			result['min'].append(min(sample))
+			result['max'].append(max(sample))
+			result['mean'].append(round(float(sum(sample)) / (hi - lo), 3))
+			lo = hi
+		return result
+
+
+	def close(self):
+		for c in [self.__time] + self.__columns.values():
+			c.close()
+
+
+
+class StatusHistory(HistoryStore):
+	'''
+	History of the readings in EMA status messages.
+	Subscribed to status messages like any device.
+	'''
+
+	FIELDS = ('power', 'rain', 'cloud', 'abspressure', 'pluvcurrent', 'pluvaccum',
+			  'pyrometer', 'ambient', 'humidity', 'dewpoint', 'windaccum',
+			  'windcurrent', 'winddir')
+
+	def __init__(self, directory, capacity):
+		HistoryStore.__init__(self, directory, StatusHistory.FIELDS, capacity)
+
+
+	def onStatus(self, status):
+		self.append(status._asdict())
@@ -50,3 +50,7 @@ def logToFile(filename):
     fileHandler.setFormatter(formatter)
     ROOT.addHandler(fileHandler)
 
+
+
+def globalLevel(level):
+    ROOT.setLevel(level)
@@ -0,0 +1,149 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# Decoder of the 24h history pages read with '(@Hpppp)' bulk dumps.
+#
+# Each page is 24 triplets of a maxima status line (type 'M'), a minima
+# status line (type 'm') and a '(HH:MM:SS DD/MM/YYYY)' timestamp,
+# one per hour. Status lines are split with the same StatusFrame
+# struct layout used for the periodic status messages, so that the
+# offsets live in emaproto only, and timestamps are sliced at fixed
+# positions. No regular expressions are involved.
+#
+# The result is a MinMaxBatch in columnar form: a time column with
+# UTC seconds (EMA clock is kept in UTC by the RTC device) and, for
+# maxima and minima, one typed array per sensor field, one row per
+# hour. Consumers get the whole page with a single JSON decode.
+#
+# Fields StatusFrame leaves as strings are converted here: calibrated
+# pressure to int and photometer to float, NaN if not a number.
+# NaN is not valid JSON, so columns() turns it into None (JSON null).
+# ======================================================================
+
+import json
+import array
+import calendar
+
+from emaproto import STATLEN, MTMAX, MTMIN, SMTE, STATUS_FIELDS, StatusFrame
+
+
+# Sensor fields of a status line, all but relays and message type
+FIELDS = tuple(name for name, begin, end in STATUS_FIELDS if name not in ('roof', 'aux', 'mtype'))
+
+# array typecodes per field, 'i' if not given
+TYPECODE = {
+	'photometer' : 'd',
+}
+
+TSTAMPLEN = 21		# (HH:MM:SS DD/MM/YYYY)
+
+
+def number(field, value):
+	'''Converts the fields StatusFrame leaves as strings'''
+	if field == 'calpressure':
+		return int(value)
+	if field == 'photometer':
+		try:
+			return float(value)
+		except ValueError:
+			return float('nan')
+	return value
+
+
+def tolist(column):
+	'''Array as a list, with None for NaN values'''
+	if column.typecode != 'd':
+		return column.tolist()
+	return [None if x != x else x for x in column]
+
+
+def timestamp(line):
+	'''UTC seconds of a (HH:MM:SS DD/MM/YYYY) line'''
+	if len(line) != TSTAMPLEN:
+		raise ValueError("Bad history timestamp %r" % line)
+	return calendar.timegm((int(line[16:20]), int(line[13:15]), int(line[10:12]),
+		int(line[1:3]), int(line[4:6]), int(line[7:9])))
+
+
+
+class MinMaxBatch(object):
+	'''
+	Columnar hourly maxima and minima.
+	time is an array of UTC seconds, hhmm an array with the hour
+	tag of each row, maxima and minima dictionaries of arrays
+	keyed by field name.
+	'''
+
+	def __init__(self):
+		self.time   = array.array('l')
+		self.hhmm   = array.array('h')
+		self.maxima = dict((f, array.array(TYPECODE.get(f, 'i'))) for f in FIELDS)
+		self.minima = dict((f, array.array(TYPECODE.get(f, 'i'))) for f in FIELDS)
+
+
+	def __len__(self):
+		return len(self.time)
+
+
+	def append(self, maxima, minima, t):
+		'''Adds a row from maxima and minima StatusFrames and UTC seconds t'''
+		for f in FIELDS:
+			self.maxima[f].append(number(f, getattr(maxima, f)))
+			self.minima[f].append(number(f, getattr(minima, f)))
+		self.hhmm.append(int(maxima.raw[SMTE:STATLEN-1]))
+		self.time.append(t)
+
+
+	def columns(self):
+		'''Returns the batch as a dictionary of lists, None for NaN'''
+		return {
+			'fields' : FIELDS,
+			'time'   : self.time.tolist(),
+			'hhmm'   : self.hhmm.tolist(),
+			'max'    : dict((f, tolist(a)) for f, a in self.maxima.iteritems()),
+			'min'    : dict((f, tolist(a)) for f, a in self.minima.iteritems()),
+		}
+
+
+	def json(self):
+		'''Compact JSON encoding of columns()'''
+		return json.dumps(self.columns(), sort_keys=True, separators=(',',':'))
+
+
+
+def decode(lines):
+	'''
+	Decodes the raw lines of a bulk dump page into a MinMaxBatch.
+	Raises ValueError or struct.error on malformed pages.
+	'''
+	if len(lines) % 3:
+		raise ValueError("History page with %d lines, not a multiple of 3" % len(lines))
+	batch = MinMaxBatch()
+	for i in range(0, len(lines), 3):
+		maxima = StatusFrame.decode(lines[i])
+		minima = StatusFrame.decode(lines[i+1])
+		if maxima.mtype != MTMAX or minima.mtype != MTMIN:
+			raise ValueError("Bad history line types %r %r" % (maxima.mtype, minima.mtype))
+		batch.append(maxima, minima, timestamp(lines[i+2]))
+	return batch
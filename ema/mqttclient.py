@@ -30,29 +30,84 @@
 # The work() procedure eexectues twice as fast as the keepalive timeout specidied to
 # the client MQTT library.
 #
-# This version publushes a 24h bulk dump to the MQTT broker
-# by using an object of class Command and implementing the necessary callbacks.
+# This version publushes a 24h bulk dump to the MQTT broker, walking
+# the mqtt_history_first to mqtt_history_last flash pages with a
+# BulkDump object (see bulkdump.py). Each page is published as soon
+# as it is read, as a retained message of its own under
+# EMA/<id>/history/minmax/<page>, and only if it changed. If
+# mqtt_history_format is 'columns', pages are published decoded
+# by minmax.decode() as a columnar JSON batch instead of raw lines.
+#
+# If mqtt_publish_stats is set, the daemon instrumentation (see
+# EMAServer.stats()) is also published as JSON under EMA/<id>/stats.
+#
+# Readings are published in one of three modes (mqtt_publish_mode):
+#
+# - keys: the original one message per device key and period, under
+#   <id>/current/<device>/<key>, <id>/average/<device>/<key> and so on.
+#
+# - delta: same topics, but a key is only published when its value
+#   moved beyond mqtt_deadband since it was last sent, or when its
+#   unit or a non numeric value changed. Every key is published again
+#   every REFRESH periods, so that new subscribers get all of them.
+#
+# - snapshot: all readings packed into a single compact JSON object
+#   under EMA/<id>/snapshot, by section, device and key.
+#
+# Topic strings are computed once per device key and kept in a
+# dictionary, filled by publishTopics() and by the first publication
+# of keys that were not available yet at that time.
+#
+# If mqtt_outbox is set, readings keep being produced while the broker
+# is unreachable and are stored in an Outbox file (see outbox.py),
+# instead of being lost. Once reconnected, OutboxDrain republishes
+# them oldest first, at most mqtt_outbox_rate messages per second,
+# with QoS 1 so that each one is removed from the outbox only after
+# the broker acknowledges it. New readings go to the outbox as well
+# until it is empty, to keep their order. Connection errors are
+# retried on the next cycle instead of stopping the daemon.
+#
+# With the asyncio reactor, the paho client is driven by an
+# aio.mqtt.MQTTPublisher from the asyncio loop instead of by
+# readable registration and loop_misc() calls from work().
 # 
 # ======================================================================
 
+import json
+import time
+import struct
 import logging
 import paho.mqtt.client as mqtt
 import socket
 import datetime
 
 from server import Lazy, Server
+from outbox import Outbox
 from emaproto  import SPSB, STATLEN
-from command import Command, COMMAND
+from bulkdump import BulkDump
+from minmax   import decode
 from dev.todtimer import Timer
 
 
-# FLASH Pages where History data re stored
+# Default FLASH Pages where History data re stored
 FLASH_START = 300
 FLASH_END   = 300
 
 # tog info every NPLUBLIS times (ticks) 
 NPUBLISH = 60
 
+# Publish every key at least every REFRESH times in delta mode
+REFRESH = 60
+
+# Readings publishing modes
+PUBLISH_MODES = ('keys', 'delta', 'snapshot')
+
+# History pages publishing formats
+HISTORY_FORMATS = ('raw', 'columns')
+
+# Minimun QoS of outbox messages, for the broker to acknowledge them
+OUTBOX_QOS = 1
+
 # MQTT Connection Status
 NOT_CONNECTED = 0
 CONNECTING    = 1
@@ -71,6 +126,10 @@ def on_connect(client, userdata, flags, rc):
 def on_disconnect(client, userdata, rc):
    userdata.on_disconnect(rc)
 
+# The callback for when a message has been acknowledged by the broker
+def on_publish(client, userdata, mid):
+   userdata.on_publish(mid)
+
 # The callback for when a PUBLISH message is received from the server.
 # Not Needed. This is a pure 'publish type' client.
 def on_message(client, userdata, msg):
@@ -83,28 +142,17 @@ def transform(message):
 
 
 
-class BulkDumpCommand(Command):
+class OutboxDrain(Lazy):
    '''
-   Commad subclass to handle bulk dump request and responses via callbacks
+   Drains the MQTT client outbox every second
    '''
 
-   def __init__(self, ema, retries, **kargs):
-      Command.__init__(self,ema,retries,**kargs)
-
-   # delegate to MQTT client object as it has all the needed context
-   def onPartialCommand(self, message, userdata):
-      '''
-      Partial bulk dump handler
-      '''
-      self.ema.mqttclient.onPartialCommand(message,userdata)
-
-   # delegate to MQTT client object as it has all he needed context
-   def onCommandComplete(self, message, userdata):
-      '''
-      Bulk dump Command complete handler
-      '''
-      self.ema.mqttclient.onCommandComplete(message,userdata)
+   def __init__(self, client):
+      Lazy.__init__(self, 1)
+      self.client = client
 
+   def work(self):
+      self.client.drain()
 
 
 
@@ -115,6 +163,8 @@ class MQTTClient(Lazy):
    TOPIC_TOPICS         = "EMA/topics"
    TOPIC_HISTORY_MINMAX = "EMA/history/minmax"
    TOPIC_CURRENT_STATUS = "EMA/current/status"
+   TOPIC_STATS          = "EMA/stats"
+   TOPIC_SNAPSHOT       = "EMA/snapshot"
 
 
    def __init__(self, ema, parser, **kargs):
@@ -126,27 +176,78 @@ class MQTTClient(Lazy):
       period   = parser.getint("MQTT", "mqtt_period")
       histflag = parser.getboolean("MQTT", "mqtt_publish_history")
       publish_status = parser.getboolean("MQTT", "mqtt_publish_status")
+      publish_stats  = parser.has_option("MQTT", "mqtt_publish_stats") and \
+                       parser.getboolean("MQTT", "mqtt_publish_stats")
+      mode     = "keys"
+      if parser.has_option("MQTT", "mqtt_publish_mode"):
+         mode = parser.get("MQTT", "mqtt_publish_mode")
+      if mode not in PUBLISH_MODES:
+         raise ValueError("mqtt_publish_mode must be one of %s" % ', '.join(PUBLISH_MODES))
+      deadband = 0.0
+      if parser.has_option("MQTT", "mqtt_deadband"):
+         deadband = parser.getfloat("MQTT", "mqtt_deadband")
+      outbox   = None
+      if parser.has_option("MQTT", "mqtt_outbox"):
+         outbox = parser.get("MQTT", "mqtt_outbox")
+      outsize  = 1048576
+      if parser.has_option("MQTT", "mqtt_outbox_size"):
+         outsize = parser.getint("MQTT", "mqtt_outbox_size")
+      outrate  = 10
+      if parser.has_option("MQTT", "mqtt_outbox_rate"):
+         outrate = parser.getint("MQTT", "mqtt_outbox_rate")
+      first    = FLASH_START
+      if parser.has_option("MQTT", "mqtt_history_first"):
+         first = parser.getint("MQTT", "mqtt_history_first")
+      last     = FLASH_END
+      if parser.has_option("MQTT", "mqtt_history_last"):
+         last = parser.getint("MQTT", "mqtt_history_last")
+      histcache = None
+      if parser.has_option("MQTT", "mqtt_history_cache"):
+         histcache = parser.get("MQTT", "mqtt_history_cache")
+      histfmt  = "raw"
+      if parser.has_option("MQTT", "mqtt_history_format"):
+         histfmt = parser.get("MQTT", "mqtt_history_format")
+      if histfmt not in HISTORY_FORMATS:
+         raise ValueError("mqtt_history_format must be one of %s" % ', '.join(HISTORY_FORMATS))
       Lazy.__init__(self, period / 2.0 )
       MQTTClient.TOPIC_EVENTS         = "EMA/%s/events"  % id
       MQTTClient.TOPIC_TOPICS         = "EMA/%s/topics"  % id
       MQTTClient.TOPIC_HISTORY_MINMAX = "EMA/%s/history/minmax" % id
       MQTTClient.TOPIC_CURRENT_STATUS = "EMA/%s/current/status" % id
+      MQTTClient.TOPIC_STATS          = "EMA/%s/stats" % id
+      MQTTClient.TOPIC_SNAPSHOT       = "EMA/%s/snapshot" % id
       self.ema        = ema
       self.__id       = id
       self.__topics   = False
       self.__stats    = 0
       self.__count    = 0
       self.__histflag = histflag
+      self.__histfmt  = histfmt
       self.__state    = NOT_CONNECTED
       self.__host     = host
       self.__port     = port
       self.__period   = period
       self.__pubstat  = publish_status
+      self.__pubstats = publish_stats
+      self.__mode     = mode
+      self.__deadband = deadband
+      self.__topicmap = {}    # (section, device name, key) -> topic
+      self.__sent     = {}    # topic -> last value sent
+      self.__outbox   = Outbox(outbox, outsize) if outbox else None
+      self.__outrate  = outrate
+      self.__inflight = {}    # mid -> outbox entry
+      self.__history  = BulkDump(ema, first, last, self.onHistoryPage, histcache)
       self.__emastat  = "()"
       self.__mqtt     =  mqtt.Client(client_id=id+'@'+socket.gethostname(), userdata=self)
       self.__mqtt.on_connect    = on_connect
       self.__mqtt.on_disconnect = on_disconnect
+      self.__mqtt.on_publish    = on_publish
+      if ema.loop is not None:
+         import aio.mqtt     # trollius only needed by the asyncio reactor
+         self.__mqtt = aio.mqtt.MQTTPublisher(self.__mqtt, ema.loop)
       ema.addLazy(self)
+      if self.__outbox is not None:
+         ema.addLazy(OutboxDrain(self))
       ema.todtimer.addSubscriber(self)
       if publish_status:
          ema.subscribeStatus(self)
@@ -172,20 +273,31 @@ class MQTTClient(Lazy):
      log.warning("Unexpected disconnection, rc =%d" % rc)
      self.__state  = NOT_CONNECTED
      self.__topics = False
+     if self.__inflight:
+       self.__outbox.retry(self.__inflight.values())
+       self.__inflight.clear()
+     if self.ema.loop is not None:
+       return
      try:
        self.ema.delReadable(self)
      except ValueError as e:
        log.warning("Recovered from mqtt library 'double disconnection' bug")
 
+   def on_publish(self, mid):
+     '''Remove outbox messages acknowledged by the broker'''
+     entry = self.__inflight.pop(mid, None)
+     if entry is not None:
+       self.__outbox.done(entry)
+
    # ----------------------------------------
    # Implement the EMA Status Message calback
    # -----------------------------------------
 
-   def onStatus(self, message):
+   def onStatus(self, status):
       '''Pick up status message and transform it into pure ASCII string'''
       tstamp = (datetime.datetime.utcnow() + \
              datetime.timedelta(seconds=0.5)).strftime("\n(%H:%M:%S %d/%m/%Y)")
-      self.__emastat = transform(message)
+      self.__emastat = transform(status.raw)
       self.__emastat += tstamp
 
    # ---------------------------------
@@ -210,7 +322,7 @@ class MQTTClient(Lazy):
    # -----------------------------------------------
 
    def onNewInterval(self, where, i):
-      if self.__state == CONNECTED:
+      if self.__state == CONNECTED or self.__outbox is not None:
          if self.__histflag:
             self.publishBulkDump()
       else:
@@ -233,7 +345,8 @@ class MQTTClient(Lazy):
 	 
       if self.__state == NOT_CONNECTED:
          self.connect()
-      	 return
+         if self.__outbox is None:
+            return
 
       # Do this only once in server lifetime
       if self.__state == CONNECTED and not self.__topics:
@@ -243,39 +356,30 @@ class MQTTClient(Lazy):
             self.publishBulkDump()
 
       self.__count = (self.__count + 1) % 2
-      if self.__state == CONNECTED and self.__count == 0:
+      if self.__count == 0 and (self.__state == CONNECTED or self.__outbox is not None):
          self.publish()
 
-      self.__mqtt.loop_misc()
+      if self.__state != NOT_CONNECTED and self.ema.loop is None:
+         self.__mqtt.loop_misc()
 
    # ----------------------------------------
-   # Implement Command callbacks
+   # Implement the BulkDump sink
    # -----------------------------------------
 
-   def onPartialCommand(self, message, userdata):
-      '''
-      Partial bulk dump request command handler
-      '''
-      if len(message) == STATLEN:
-        self.bulkDump.append(transform(message))
-      else:
-        self.bulkDump.append(message)
-     
-
-   def onCommandComplete(self, message, userdata):
+   def onHistoryPage(self, page, lines):
       '''
-      Bulk dump request command complete handler
+      Publish a bulk dump page, as soon as it is read
       '''
-      log.debug("onCommandComplete => %s", message)
-      self.bulkDump.append(message)
-      if self.page < FLASH_END :
-        self.page += 1
-        self.requestPage(self.page)
-      else:
-        date = message[10:20]
-        log.info("Uploading (%s) hourly minmax history to %s", date, MQTTClient.TOPIC_HISTORY_MINMAX)
-        self.__mqtt.publish(topic=MQTTClient.TOPIC_HISTORY_MINMAX, payload='\n'.join(self.bulkDump), qos=2, retain=True)
-        log.info("Upload complete, processed %d lines", len(self.bulkDump))
+      topic = "%s/%04d" % (MQTTClient.TOPIC_HISTORY_MINMAX, page)
+      log.info("Uploading (%s) hourly minmax history page %d to %s", lines[-1][10:20], page, topic)
+      if self.__histfmt == 'columns':
+         try:
+            self.send(topic, decode(lines).json(), qos=2, retain=True)
+            return
+         except (ValueError, struct.error) as e:
+            log.error("History page %d not decoded (%s), publishing it raw", page, e)
+      lines = [transform(line) if len(line) == STATLEN else line for line in lines]
+      self.send(topic, '\n'.join(lines), qos=2, retain=True)
 
    # --------------
    # Helper methods
@@ -290,105 +394,217 @@ class MQTTClient(Lazy):
       try:
          log.info("Connecting to MQTT Broker %s:%s", self.__host, self.__port)
          self.__state = CONNECTING
+         if self.ema.loop is not None:
+            self.__mqtt.run(self.__host, self.__port, self.__period, self.connectFailed)
+            return
          self.__mqtt.connect(self.__host, self.__port, self.__period)
          self.ema.addReadable(self)
       except IOError, e:	
-         log.error("%s",e)
-         if e.errno == 101:
-            log.warning("Trying to connect on the next cycle")
-            self.__state = NOT_CONNECTED
-         else:
-            self.__state = FAILED
-            raise
+         self.connectFailed(e)
+
+
+   def connectFailed(self, e):
+      log.error("%s",e)
+      log.warning("Trying to connect on the next cycle")
+      self.__state = NOT_CONNECTED
+
+
+   def send(self, topic, payload, qos=0, retain=False):
+      '''
+      Publish a message, or store it in the outbox when not connected
+      or when older messages are still waiting there.
+      '''
+      if self.__outbox is not None:
+         if self.__state == CONNECTED and not len(self.__outbox):
+            info = self.__mqtt.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+               return
+         self.__outbox.append(topic, payload, qos, retain)
+      else:
+         self.__mqtt.publish(topic=topic, payload=payload, qos=qos, retain=retain)
+
+
+   def drain(self):
+      '''
+      Republish outbox messages, oldest first, keeping at most
+      mqtt_outbox_rate messages waiting for acknowledge
+      '''
+      if self.__state != CONNECTED:
+         return
+      for i in range(self.__outrate - len(self.__inflight)):
+         item = self.__outbox.pop()
+         if item is None:
+            break
+         entry, topic, payload, qos, retain = item
+         info = self.__mqtt.publish(topic=topic, payload=payload, qos=max(qos, OUTBOX_QOS), retain=retain)
+         if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.__outbox.retry([entry])
+            break
+         self.__inflight[info.mid] = entry
+
+
+   def counters(self):
+      '''Returns a dictionary of publishing counters'''
+      counters = {'connected': self.__state == CONNECTED, 'published': self.__stats}
+      if self.__outbox is not None:
+         counters['outbox']   = self.__outbox.counters()
+         counters['inflight'] = len(self.__inflight)
+      return counters
+
+
+   def close(self):
+      if self.__outbox is not None:
+         self.__outbox.close()
    
 
    def publish(self):
       '''
-      Publish real time individual readings to MQTT Broker
+      Publish real time readings to MQTT Broker
       '''
       # publish raw status line
       if self.__pubstat:
-        self.__mqtt.publish(topic=MQTTClient.TOPIC_CURRENT_STATUS, payload=self.__emastat)
+        self.send(MQTTClient.TOPIC_CURRENT_STATUS, self.__emastat)
         self.__emastat = "()"
 
-      # publish last current values
-      for device in self.ema.currentList:
-        if ('mqtt','current') in device.publishable:
-          try:
-            for key, value in device.current.iteritems():
-              log.debug("%s publishing current %s => %s %s", device.name, key, value[0], value[1])
-	      topic   = "%s/current/%s/%s" % (self.__id, device.name, key)
-              payload = "%s %s" % value 
-              self.__mqtt.publish(topic=topic, payload=payload)
-          except IndexError as e:
-            log.error("publish(current) Exception: %s reading device=%s", e, device.name)
-      
-      # Publish averages
-      for device in self.ema.averageList:
-        if ('mqtt','average') in device.publishable:
-          try:
-            for key, value in device.average.iteritems():
-              log.debug("%s publishing average %s => %s %s", device.name, key, value[0], value[1])
-	      topic   = "%s/average/%s/%s" % (self.__id, device.name, key)
-              payload = "%s %s" % value 
-              self.__mqtt.publish(topic=topic, payload=payload)
-          except IndexError as e:
-            log.error("publish(average) Exception: %s reading device=%s", e, device.name)
+      # publish current values, averages and rolling statistics
+      if self.__mode == 'snapshot':
+         self.publishSnapshot()
+      else:
+         delta = self.__mode == 'delta' and self.__stats % REFRESH != 0
+         for section, device, key, value in self.readings():
+            topic = self.topic(section, device, key)
+            if delta and not self.changed(topic, value):
+               continue
+            self.__sent[topic] = value
+            payload = self.payload(section, value)
+            log.debug("%s publishing %s %s => %s", device.name, section, key, payload)
+            self.send(topic, payload)
+
+      # Publish daemon instrumentation
+      if self.__pubstats:
+        self.send(MQTTClient.TOPIC_STATS, json.dumps(self.ema.stats(), sort_keys=True))
 
       if self.__stats % NPUBLISH == 0:
          log.info("Published %d measurements" % self.__stats)
       self.__stats += 1
 
 
-   def publishTopics(self):
+   def publishSnapshot(self):
       '''
-      Publish active topics
+      Publish all readings as a single JSON object
       '''
-      topics = [MQTTClient.TOPIC_EVENTS, MQTTClient.TOPIC_HISTORY_MINMAX]
-      if self.__pubstat:
-        topics.append(MQTTClient.TOPIC_CURRENT_STATUS)
+      snapshot = {'time': int(time.time())}
+      for section, device, key, value in self.readings():
+         if section == 'statistics':
+            value = dict(value[0], unit=value[1])
+         snapshot.setdefault(section, {}).setdefault(device.name, {})[key] = value
+      payload = json.dumps(snapshot, sort_keys=True, separators=(',',':'))
+      log.debug("publishing snapshot of %d bytes", len(payload))
+      self.send(MQTTClient.TOPIC_SNAPSHOT, payload)
+
 
+   def readings(self):
+      '''
+      Generates (section, device, key, value) tuples for all readings
+      to publish. value is a (value, unit) tuple for current and average
+      readings, and a (statistics dictionary, unit) tuple for statistics.
+      '''
       for device in self.ema.currentList:
-        if ('mqtt','current') in device.publishable:
-          try:
-            for key in device.current.iterkeys():
-              topics.append('%s/current/%s/%s' % (self.__id, device.name, key))
-          except IndexError as e:
-            log.error("Exception: %s listing device key=%s", e, device.name)
-            continue
+         if ('mqtt','current') in device.publishable:
+            try:
+               current = device.current
+            except IndexError as e:
+               log.error("publish(current) Exception: %s reading device=%s", e, device.name)
+               continue
+            for key, value in current.iteritems():
+               yield ('current', device, key, value)
 
       for device in self.ema.averageList:
-        if ('mqtt','average') in device.publishable:
-          try:
-            for key in device.average.iterkeys():
-              topics.append('%s/average/%s/%s' % (self.__id, device.name, key))
-          except IndexError as e:
-            log.error("Exception: %s listing device key=%s", e, device.name)
-            continue
-      self.__mqtt.publish(topic=MQTTClient.TOPIC_TOPICS, payload='\n'.join(topics), qos=2, retain=True)
+         if ('mqtt','average') in device.publishable:
+            try:
+               average = device.average
+            except (IndexError, ZeroDivisionError) as e:
+               log.error("publish(average) Exception: %s reading device=%s", e, device.name)
+               continue
+            for key, value in average.iteritems():
+               yield ('average', device, key, value)
 
-      log.info("Sent active topics to %s", MQTTClient.TOPIC_TOPICS)
-      
+      for device in self.ema.averageList:
+         if ('mqtt','statistics') in device.publishable:
+            try:
+               statistics = device.statistics
+            except (IndexError, ValueError) as e:
+               log.error("publish(statistics) Exception: %s reading device=%s", e, device.name)
+               continue
+            for key, value in statistics.iteritems():
+               yield ('statistics', device, key, value)
 
-   def requestPage(self, page):
+
+   def topic(self, section, device, key):
       '''
-      Request current flash page to EMA
+      Returns the topic of a device key, computed only once
       '''
-      log.debug("requesting page %d", page)
-      cmd = BulkDumpCommand(self.ema, retries=0, **COMMAND[-1])
-      cmd.request("(@H%04d)" % page, page)
+      try:
+         return self.__topicmap[section, device.name, key]
+      except KeyError:
+         topic = "%s/%s/%s/%s" % (self.__id, section, device.name, key)
+         self.__topicmap[section, device.name, key] = topic
+         return topic
 
 
-   
+   def payload(self, section, value):
+      '''
+      Per key payload, JSON for statistics, "<value> <unit>" otherwise
+      '''
+      if section == 'statistics':
+         stats, unit = value
+         return json.dumps(dict(stats, unit=unit), sort_keys=True)
+      return "%s %s" % value
+
+
+   def changed(self, topic, value):
+      '''
+      Returns True if value moved beyond the deadband since it was last
+      sent. Non numeric values are just compared.
+      '''
+      last = self.__sent.get(topic)
+      if last is None or last[1] != value[1]:
+         return True
+      try:
+         return abs(float(value[0]) - float(last[0])) > self.__deadband
+      except (TypeError, ValueError):
+         return value[0] != last[0]
+
+
+   def publishTopics(self):
+      '''
+      Publish active topics
+      '''
+      topics = [MQTTClient.TOPIC_EVENTS]
+      if self.__histflag:
+        topics.extend("%s/%04d" % (MQTTClient.TOPIC_HISTORY_MINMAX, page)
+                      for page in range(self.__history.first, self.__history.last + 1))
+      if self.__pubstat:
+        topics.append(MQTTClient.TOPIC_CURRENT_STATUS)
+      if self.__pubstats:
+        topics.append(MQTTClient.TOPIC_STATS)
+
+      if self.__mode == 'snapshot':
+         topics.append(MQTTClient.TOPIC_SNAPSHOT)
+      else:
+         for section, device, key, value in self.readings():
+            topics.append(self.topic(section, device, key))
+      self.__mqtt.publish(topic=MQTTClient.TOPIC_TOPICS, payload='\n'.join(topics), qos=2, retain=True)
+
+      log.info("Sent active topics to %s", MQTTClient.TOPIC_TOPICS)
+
 
    def publishBulkDump(self):
       '''
       Publish last 24h bulk dump
       '''
-      self.bulkDump = []
-      self.page = FLASH_START
-      self.requestPage(self.page)
       log.debug("Request to publish 24h Bulk data")
+      self.__history.start()
 
 
 if __name__ == "__main__":
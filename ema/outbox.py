@@ -0,0 +1,207 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# Store and forward queue of MQTT messages, so that readings published
+# while the broker is unreachable are not lost.
+#
+# Messages are appended to a single segment file. Each record has a
+# small header (magic, state, qos, retain, topic and payload lengths)
+# followed by the topic and payload. An in-memory index of the live
+# records (their offset and size) is rebuilt by scanning the file at
+# startup, so the queue survives daemon restarts.
+#
+# The only in place write is the state byte of a record, cleared when
+# the broker acknowledges it. When every record has been acknowledged
+# the file is truncated to zero. If appending would exceed the maximum
+# size, the live records are rewritten to a new segment, dropping the
+# oldest not yet sent ones if still needed, down to 3/4 of the size.
+#
+# Records are not fsync'ed, the kernel page writeback is good enough
+# for a weather station and spares SD card writes. A record cut by a
+# crash is detected by its length and discarded at startup.
+# ======================================================================
+
+import os
+import struct
+import logging
+from   collections import deque
+
+log = logging.getLogger('mqtt')
+
+
+
+class Outbox(object):
+	'''
+	Bounded persistent FIFO of MQTT messages.
+	Entries are [offset, size] lists, updated when compacting.
+	'''
+
+	MAGIC   = 0xE3
+	PENDING = 0xFF
+	DONE    = 0x00
+	RECORD  = struct.Struct('<BBBBHI')  # magic, state, qos, retain, topic len, payload len
+
+	def __init__(self, path, maxsize):
+		self.path     = path
+		self.maxsize  = maxsize
+		self.pending  = deque()    # entries not yet sent, oldest first
+		self.sent     = []         # entries sent, not acknowledged yet
+		self.size     = 0          # file size
+		self.nappend  = 0
+		self.nsent    = 0
+		self.ndropped = 0
+		dirname = os.path.dirname(path)
+		if dirname and not os.path.isdir(dirname):
+			os.makedirs(dirname)
+		self.__fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+		self.scan()
+		log.info("MQTT outbox in %s with %d queued messages", path, len(self))
+
+
+	def __len__(self):
+		'''Number of messages not acknowledged yet'''
+		return len(self.pending) + len(self.sent)
+
+
+	def scan(self):
+		'''Rebuilds the index of pending records from the file'''
+		data   = os.read(self.__fd, os.fstat(self.__fd).st_size)
+		offset = 0
+		while offset + Outbox.RECORD.size <= len(data):
+			magic, state, qos, retain, tlen, plen = Outbox.RECORD.unpack_from(data, offset)
+			size = Outbox.RECORD.size + tlen + plen
+			if magic != Outbox.MAGIC or offset + size > len(data):
+				break
+			if state == Outbox.PENDING:
+				self.pending.append([offset, size])
+			offset += size
+		if offset != len(data):
+			log.warning("%s: discarding %d bytes of damaged records", self.path, len(data) - offset)
+		self.size = offset
+		if not self.pending:
+			self.size = 0
+		os.ftruncate(self.__fd, self.size)
+
+
+	def append(self, topic, payload, qos=0, retain=False):
+		'''Queues a message. Returns False if it did not fit'''
+		record = Outbox.RECORD.pack(Outbox.MAGIC, Outbox.PENDING, qos, int(retain), len(topic), len(payload)) \
+			+ topic + payload
+		if self.size + len(record) > self.maxsize:
+			self.compact(len(record))
+			if self.size + len(record) > self.maxsize:
+				log.warning("MQTT outbox full, dropping message to %s", topic)
+				self.ndropped += 1
+				return False
+		os.lseek(self.__fd, self.size, os.SEEK_SET)
+		os.write(self.__fd, record)
+		self.pending.append([self.size, len(record)])
+		self.size    += len(record)
+		self.nappend += 1
+		return True
+
+
+	def pop(self):
+		'''
+		Returns (entry, topic, payload, qos, retain) for the oldest
+		pending message, or None. The entry must be given back to
+		done() or retry().
+		'''
+		if not self.pending:
+			return None
+		entry = self.pending.popleft()
+		os.lseek(self.__fd, entry[0], os.SEEK_SET)
+		data = os.read(self.__fd, entry[1])
+		magic, state, qos, retain, tlen, plen = Outbox.RECORD.unpack_from(data)
+		start = Outbox.RECORD.size
+		self.sent.append(entry)
+		self.nsent += 1
+		return (entry, data[start:start+tlen], data[start+tlen:], qos, bool(retain))
+
+
+	def done(self, entry):
+		'''Marks a sent message as acknowledged'''
+		self.sent.remove(entry)
+		if not len(self):
+			self.size = 0
+			os.ftruncate(self.__fd, 0)
+			return
+		os.lseek(self.__fd, entry[0] + 1, os.SEEK_SET)
+		os.write(self.__fd, chr(Outbox.DONE))
+
+
+	def retry(self, entries):
+		'''Requeues sent but unacknowledged messages, keeping their order'''
+		for entry in sorted(entries, reverse=True):
+			self.sent.remove(entry)
+			self.pending.appendleft(entry)
+
+
+	def compact(self, room=0):
+		'''
+		Rewrites the live records to a new segment. If there is no room
+		for room more bytes, the oldest pending records are dropped to
+		leave a quarter of the maximum size free, so that a full outbox
+		is not rewritten on every append. Sent records are kept, as their
+		acknowledgement may still come.
+		'''
+		entries = sorted(self.sent + list(self.pending))
+		nbytes  = sum(entry[1] for entry in entries)
+		if nbytes + room > self.maxsize:
+			ndropped = 0
+			while self.pending and nbytes + room > self.maxsize * 3 // 4:
+				entry = self.pending.popleft()
+				entries.remove(entry)
+				nbytes   -= entry[1]
+				ndropped += 1
+			self.ndropped += ndropped
+			log.warning("MQTT outbox full, dropped %d oldest messages", ndropped)
+		tmp = self.path + '.tmp'
+		fd  = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+		offset = 0
+		for entry in entries:
+			os.lseek(self.__fd, entry[0], os.SEEK_SET)
+			os.write(fd, os.read(self.__fd, entry[1]))
+			entry[0] = offset
+			offset  += entry[1]
+		os.rename(tmp, self.path)
+		os.close(self.__fd)
+		self.__fd = fd
+		self.size = offset
+		log.debug("MQTT outbox compacted to %d bytes", offset)
+
+
+	def counters(self):
+		'''Returns a dictionary of outbox counters'''
+		return {
+			'queued'  : len(self),
+			'bytes'   : self.size,
+			'appended': self.nappend,
+			'sent'    : self.nsent,
+			'dropped' : self.ndropped,
+		}
+
+
+	def close(self):
+		os.close(self.__fd)
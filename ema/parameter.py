@@ -54,13 +54,34 @@
 # expression from a 'set' regular expression. However, they are still
 # in the code (who knows ...)
 #
+# Parameters are not started all at once. sync() hands them to the
+# SyncScheduler, which keeps at most 'window' GET exchanges in flight,
+# so that the serial output queue stays short and timeouts are
+# meaningful. Parameters sharing the same GET request (i.e. '(f)' for
+# the voltmeter threshold and offset) are started together, the GET
+# is sent once and every parameter picks its own response line.
+# Parameter chains (see Parameter.next) are scheduled as a whole.
+# Timeouts follow an estimate of EMA round trip time, smoothed as in
+# TCP (RFC 6298), sampled only from exchanges that were not retried.
+# Per parameter sync latency is kept for statistics.
+#
+# With the asyncio reactor, the timeout & retry bookkeeping of the FSM
+# is done by the aio.server.request() coroutine waiting on an
+# Exchange, instead of the tick based Alarmable. Subclasses are the
+# same for both reactors: setTimeout() is forwarded to the Exchange.
+#
 # ======================================================================
 
 import re
 import logging
 from abc import ABCMeta, abstractmethod
+from collections import deque
+
+from server    import Server, Alarmable, monotonic
+from emaproto  import patternKey
+from serdriver import OutputQueue
 
-from server import Server, Alarmable
+log = logging.getLogger('parameter')
 
 # Note that AbstractClass also uses ABCMetaclass, inherited from Alarmable
 class AbstractParameter(Alarmable):
@@ -70,6 +91,8 @@ class AbstractParameter(Alarmable):
 	TIMEOUT = 5                 # timeout in seconds
 	RETRIES = 2                 # retries (0 = no retry)
 
+	get = None                  # GET request, shared by equal parameters
+
 	# States
 	BEGIN = 0
 	GET   = 1
@@ -83,11 +106,24 @@ class AbstractParameter(Alarmable):
 		self.setPat = re.compile(setPat)
 		self.state  = AbstractParameter.BEGIN
 		self.NRetries = nretries
+		self.exchange = None	# asyncio reactor only
 
 
 	def sync(self):
-		'''First Event'''
+		'''First Event. Queues this parameter for synchronization'''
+		self.ema.scheduler.submit(self)
+
+
+	def start(self):
+		'''Starts synchronization. Called by the SyncScheduler'''
 		self.retries = 0
+		if self.ema.loop is not None:
+			import aio.server      # trollius only needed by the asyncio reactor
+			self.exchange = aio.server.Exchange(self.ema.loop)
+			self.ema.addRequest(self)
+			self.state = AbstractParameter.GET   # next state
+			self.exchange.run(self.resend, self.NRetries, self.fail)
+			return
 		self.resetAlarm()       # maybe not necessary
 		self.ema.addAlarmable(self)
 		self.ema.addRequest(self)
@@ -95,33 +131,38 @@ class AbstractParameter(Alarmable):
 		self.state = AbstractParameter.GET   # next state
 
 
+	def routes(self):
+		'''Routing keys of the expected responses'''
+		return (patternKey(self.getPat.pattern), patternKey(self.setPat.pattern))
+
+
 	def onResponseDo(self, message):
 		'''Input message handler'''
 		if self.state == AbstractParameter.GET:
 			matched = self.getPat.search(message)
 			if matched:
-				self.resetAlarm()
-				self.retries = 0
+				self.ema.scheduler.onResponse(self)
 				syncNeeded = self.actionGet(message, matched) # overriden in subclass
+				self.progress(not syncNeeded)
 				if syncNeeded:
 					self.state = AbstractParameter.SET # transition to next state
 				else:
 					self.state = AbstractParameter.END # or to END state
 					self.ema.delRequest(self)
-					self.ema.delAlarmable(self)
 					self.actionEnd()   # overriden in subclass
+					self.ema.scheduler.done(self)
 			return matched is not None
 
 		elif self.state == AbstractParameter.SET:
 			matched = self.setPat.search(message)
 			if matched:
-				self.resetAlarm()
-				self.retries = 0
+				self.ema.scheduler.onResponse(self)
+				self.progress(True)
 				self.actionSet(message, matched) # overriden in subclass
 				self.state = AbstractParameter.END # transtition to next state
 				self.ema.delRequest(self)
-				self.ema.delAlarmable(self)
 				self.actionEnd() # overriden in subclass
+				self.ema.scheduler.done(self)
 			return matched is not None
 
 		else:
@@ -140,9 +181,44 @@ class AbstractParameter(Alarmable):
 			self.retries += 1
 			self.ema.addAlarmable(self)
 		else:	# to END state
-			self.state = AbstractParameter.END 
-			self.ema.delRequest(self)
-			self.actionTimeout() # overriden in subclass
+			self.fail()
+
+
+	def resend(self, retry):
+		'''Sends the GET request (retry 0) or resends the pending one'''
+		if not retry:
+			self.actionStart()                 # overriden in subclass
+			return
+		self.retries = retry
+		if self.state == AbstractParameter.SET:
+			self.retrySet()      # overriden in subclass
+		else:
+			self.retryGet()     # overriden in subclass
+
+
+	def progress(self, complete):
+		'''A response matched, restart timeout or stop it when complete'''
+		self.retries = 0
+		if self.exchange is not None:
+			self.exchange.progress(complete)
+		elif complete:
+			self.ema.delAlarmable(self)
+		else:
+			self.resetAlarm()
+
+
+	def fail(self):
+		'''Retries exhausted, to END state'''
+		self.state = AbstractParameter.END
+		self.ema.delRequest(self)
+		self.actionTimeout() # overriden in subclass
+		self.ema.scheduler.done(self, False)
+
+
+	def setTimeout(self, timeout):
+		Alarmable.setTimeout(self, timeout)
+		if self.exchange is not None:
+			self.exchange.setTimeout(timeout)
 			
 
 	def isDone(self):
@@ -272,20 +348,14 @@ class Parameter(AbstractParameter):
 
 
 	def sendValue(self):
-		t = AbstractParameter.TIMEOUT
-		t += self.ema.serdriver.queueDelay()*Server.TIMEOUT
-		self.setTimeout(t)      # adjusted for queue length
 		value = self.set % self.value
 		self.log.debug("Parameter %s: sending new value", self.name)
-		self.ema.serdriver.write(value)
+		self.ema.scheduler.request(self, value)
 
 
 	def actionStart(self):
 		self.log.debug("Parameter %s: starting sync", self.name)
-		t = AbstractParameter.TIMEOUT
-		t += self.ema.serdriver.queueDelay()*Server.TIMEOUT
-		self.setTimeout(t)      # adjusted for queue length
-		self.ema.serdriver.write(self.get)
+		self.ema.scheduler.request(self, self.get)
 		
 
 	def actionGet(self, message, matchobj):
@@ -308,10 +378,8 @@ class Parameter(AbstractParameter):
 
 
 	def actionEnd(self):
+		# Next parameters in chain are scheduled along with this one
 		self.log.debug("Parameter %s succesfully synchronized", self.name)
-		if(self.next):
-			self.log.debug("Parameter %s: Triggering next parameter sync: %s", self.name, self.next.name)
-			self.next.sync()
 
 	def retryGet(self):
 		i, N = self.getRetries()
@@ -327,3 +395,152 @@ class Parameter(AbstractParameter):
 
 	def actionTimeout(self):
 		self.log.error("Parameter %s: Timeout. EMA not responding to sync request", self.name)
+
+
+
+class SyncScheduler(object):
+	'''
+	Runs parameter synchronizations with a bounded number of
+	GET exchanges in flight and adaptive timeouts.
+	'''
+
+	WINDOW = 2          # GET exchanges in flight
+	MINRTO = 2.0        # timeout bounds in seconds
+	MAXRTO = 60.0
+
+	def __init__(self, ema, window=WINDOW):
+		self.ema      = ema
+		self.window   = window
+		self.pending  = deque()   # parameters waiting to start
+		self.inflight = {}        # exchange key -> started parameters
+		self.sent     = {}        # parameter -> (message, time, retried)
+		self.tsubmit  = {}        # parameter -> submission time
+		self.tstart   = {}        # parameter -> start time
+		self.latency  = {}        # parameter name -> latency statistics
+		self.srtt     = None
+		self.rttvar   = None
+		self.rto      = float(AbstractParameter.TIMEOUT)
+		self.t0       = None      # start of the current batch
+
+
+	def key(self, param):
+		'''Exchange key: parameters with the same GET request share it'''
+		return param.get if param.get is not None else param
+
+
+	def scheduled(self, param):
+		return param in self.tsubmit
+
+
+	def idle(self):
+		'''Returns True if no synchronization is queued or running'''
+		return not self.tsubmit
+
+	# ---------------
+	# Parameter calls
+	# ---------------
+
+	def submit(self, param):
+		'''Queues param and the rest of its chain'''
+		now = monotonic()
+		if self.idle():
+			self.t0 = now
+		while param is not None:
+			if not self.scheduled(param):
+				self.tsubmit[param] = now
+				self.pending.append(param)
+			param = getattr(param, 'next', None)
+		self.pump()
+
+
+	def request(self, param, message):
+		'''
+		Sends message for param and sets its timeout.
+		Not sent if another parameter of the same exchange
+		has just sent it.
+		'''
+		now     = monotonic()
+		retried = param in self.sent and self.sent[param][0] == message
+		for other in self.inflight.get(self.key(param), ()):
+			if other is param or other not in self.sent:
+				continue
+			msg, t, flag = self.sent[other]
+			if msg == message and now - t < Server.TIMEOUT:
+				self.sent[param] = (message, t, flag or retried)
+				break
+		else:
+			self.sent[param] = (message, now, retried)
+			self.ema.serdriver.write(message, OutputQueue.SYNC)
+		param.setTimeout(self.rto)
+
+
+	def onResponse(self, param):
+		'''Takes a round trip time sample from non retried exchanges'''
+		message, t, retried = self.sent.pop(param, (None, None, True))
+		if retried:
+			return
+		rtt = monotonic() - t
+		if self.srtt is None:
+			self.srtt   = rtt
+			self.rttvar = rtt / 2
+		else:
+			self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+			self.srtt   = 0.875*self.srtt + 0.125*rtt
+		self.rto = min(max(self.srtt + 4*self.rttvar, SyncScheduler.MINRTO), SyncScheduler.MAXRTO)
+
+
+	def done(self, param, ok=True):
+		'''Parameter reached its END state'''
+		now     = monotonic()
+		key     = self.key(param)
+		started = self.tstart.pop(param, now)
+		self.latency[param.name] = {
+			'wait'    : round(started - self.tsubmit.pop(param, started), 3),
+			'latency' : round(now - started, 3),
+			'retries' : param.getRetries()[0],
+			'ok'      : ok,
+		}
+		self.sent.pop(param, None)
+		group = self.inflight.get(key, [])
+		if param in group:
+			group.remove(param)
+		if not group:
+			self.inflight.pop(key, None)
+		self.pump()
+		if self.idle():
+			log.info("Synchronized parameters in %.1f s (rtt = %s s, timeout = %.1f s)",
+				now - self.t0, self.srtt if self.srtt is None else round(self.srtt, 2), self.rto)
+
+	# --------------
+	# Helper methods
+	# --------------
+
+	def pump(self):
+		'''Starts queued exchanges while there is room in the window'''
+		while len(self.inflight) < self.window:
+			# Parameters of a running exchange wait for it to finish
+			ready = [p for p in self.pending if self.key(p) not in self.inflight]
+			if not ready:
+				break
+			key   = self.key(ready[0])
+			group = [p for p in ready if self.key(p) == key]
+			for p in group:
+				self.pending.remove(p)
+			self.inflight[key] = group
+			now = monotonic()
+			for p in group:
+				self.tstart[p] = now
+				self.sent.pop(p, None)
+			for p in list(group):
+				p.start()
+
+
+	def stats(self):
+		'''Returns a dictionary of synchronization statistics'''
+		return {
+			'rtt'        : self.srtt,
+			'timeout'    : self.rto,
+			'pending'    : len(self.pending),
+			'inflight'   : sum(len(g) for g in self.inflight.values()),
+			'parameters' : dict(self.latency),
+		}
@@ -52,17 +52,314 @@
 #
 # I have never had the need to unregister a handler, 
 # so there is no delHandler()
+#
+# Message reassembly is done by a FrameDecoder, which keeps incoming
+# bytes in a bytearray and only scans the newly arrived bytes for the
+# closing bracket, instead of running a regular expression over an
+# ever growing string. All complete messages in a read are delivered,
+# so bursts like the bulk dump do not pile up in the buffer. Bytes
+# outside brackets and partial messages exceeding MAXLEN are dropped
+# and accounted for, resynchronizing on the next opening bracket.
+# Frames are the same ones that the FRAME regexp would match.
+#
+# 'python -m ema.serdriver bench' compares both methods at 57600 bps.
+#
+# The pace of output messages is no longer a fixed one per second.
+# A Pacer measures the latency between each request and the first
+# message with the expected response key (see emaproto.responseKey)
+# and adapts the gap between messages to EMA's real response time,
+# between serial_mingap and serial_maxgap seconds. The gap doubles
+# when a response does not arrive, as EMA is probably overloaded.
+# While on hold (i.e. photometer readings) nothing is transmitted and
+# responses already awaited are not taken as samples. With the select
+# reactor the gap cannot be shorter than Server.TIMEOUT.
+# The Pacer also keeps queue wait and line utilisation statistics.
+#
+# The output queue is an OutputQueue with one deque per priority class:
+# safety commands (roof and aux relay forcing), interactive commands
+# from UDP, parameter sync and finally keepalives and bulk dumps.
+# The highest non empty class is always served first, so a roof close
+# request never waits behind GETs. A message already waiting in its
+# class is not queued again (two keepalives, retried GETs). Messages
+# are classified by classify() unless the writer gives the class, and
+# queueDelay(priority) only counts the messages served before it.
+#
+# Writes never block the event loop. The port file descriptor is in
+# non blocking mode and output bytes go to a pending buffer, written
+# as far as the UART driver accepts them. Only while bytes remain the
+# driver is registered as a writable object, and onOutput() writes the
+# rest. No new message is dequeued until the previous one is out.
+# 'python -m ema.serdriver ptytest' checks this on a pseudo terminal.
 # ======================================================================
 
 import serial
+import os
 import re
+import math
+import fcntl
+import errno
 import logging
+from   collections import deque
 
-from server import Lazy
+from server   import Lazy, Server, monotonic
+from vector   import Vector
+from emaproto import STATLEN, messageKey, responseKey
 
 
 log = logging.getLogger('serdriver')
 
+# An EMA message, surronded by brackets
+FRAME = re.compile('\([^)]+\)')
+
+# Roof and Aux Relay forcing commands
+SAFETY = re.compile('\((X00[07]|S00[45])\)')
+
+
+class FrameDecoder(object):
+   '''
+   Incremental EMA message reassembly from a stream of bytes.
+   '''
+
+   MAXLEN = 1024  # Max. partial message length before resync
+
+   def __init__(self, maxlen=MAXLEN):
+      self.__buffer   = bytearray()
+      self.__scanned  = 0         # bytes already known to have no ')'
+      self.maxlen     = maxlen
+      self.nframes    = 0         # complete messages decoded
+      self.ndropped   = 0         # bytes discarded as garbage
+      self.noverflows = 0         # resyncs due to maxlen exceeded
+
+
+   def feed(self, data):
+      '''
+      Appends data to buffer.
+      Returns a list with all complete messages found.
+      '''
+      buf = self.__buffer
+      buf.extend(data)
+      n       = len(buf)
+      start   = 0
+      scanned = self.__scanned
+      frames  = []
+      while start < n:
+         if buf[start] != 0x28:                    # resync on '('
+            i = buf.find('(', start)
+            if i < 0:
+               self.ndropped += n - start
+               start = n
+               break
+            self.ndropped += i - start
+            start   = i
+            scanned = i + 1
+         end = buf.find(')', max(scanned, start + 1))
+         if end < 0:
+            scanned = n
+            break
+         if end == start + 1:                      # empty '()'
+            self.ndropped += 2
+         else:
+            frames.append(str(buf[start:end+1]))
+         start   = end + 1
+         scanned = start
+      del buf[:start]
+      self.__scanned = scanned - start
+      self.nframes  += len(frames)
+      if len(buf) > self.maxlen:
+         self.resync()
+      return frames
+
+
+   def resync(self):
+      '''Drops partial message up to the next '(' or the whole buffer'''
+      self.noverflows += 1
+      buf = self.__buffer
+      while len(buf) > self.maxlen:
+         i = buf.find('(', 1)
+         i = len(buf) if i < 0 else i
+         self.ndropped += i
+         del buf[:i]
+      self.__scanned = len(buf)
+      log.warning("message longer than %d bytes, resynchronizing", self.maxlen)
+
+
+   def __len__(self):
+      '''Bytes pending in buffer'''
+      return len(self.__buffer)
+
+
+def classify(message):
+   '''Returns the OutputQueue priority class of message'''
+   if SAFETY.match(message):
+      return OutputQueue.SAFETY
+   if message == '( )' or message.startswith('(@'):
+      return OutputQueue.BULK
+   return OutputQueue.INTERACTIVE
+
+
+
+class OutputQueue(object):
+   '''
+   Output messages in priority classes, FIFO within each class,
+   with duplicates in a class coalesced.
+   '''
+
+   # Priority classes, highest first
+   SAFETY      = 0
+   INTERACTIVE = 1
+   SYNC        = 2
+   BULK        = 3
+   NAMES       = ('safety', 'interactive', 'sync', 'bulk')
+
+   def __init__(self):
+      self.__queues    = [deque() for name in OutputQueue.NAMES]
+      self.__waiting   = [set()   for name in OutputQueue.NAMES]
+      self.ncoalesced  = 0
+
+
+   def push(self, message, priority, t):
+      '''
+      Queues message enqueued at time t in priority class.
+      Returns False if already waiting in that class.
+      '''
+      if message in self.__waiting[priority]:
+         self.ncoalesced += 1
+         return False
+      self.__waiting[priority].add(message)
+      self.__queues[priority].append((message, t))
+      return True
+
+
+   def pop(self):
+      '''Returns (message, enqueuing time, priority) of the next message'''
+      for priority, queue in enumerate(self.__queues):
+         if queue:
+            message, t = queue.popleft()
+            self.__waiting[priority].discard(message)
+            return (message, t, priority)
+      raise IndexError("pop from empty OutputQueue")
+
+
+   def ahead(self, priority):
+      '''Number of messages to be sent before a new one in priority class'''
+      return sum(len(q) for q in self.__queues[:priority+1])
+
+
+   def lengths(self):
+      '''Returns a dictionary of queue length per class name'''
+      return dict(zip(OutputQueue.NAMES, [len(q) for q in self.__queues]))
+
+
+   def __len__(self):
+      return sum(len(q) for q in self.__queues)
+
+
+
+class Pacer(object):
+   '''
+   Adaptive gap between output messages from the measured
+   request to response latency.
+   '''
+
+   MINGAP = 0.25   # gap limits in seconds
+   MAXGAP = 2.0
+   GAP    = 1.0    # initial gap, the former fixed pace
+   EXPIRE = 5.0    # seconds to consider a response lost
+   TAU    = 60.0   # line utilisation time constant in seconds
+   NWAIT  = 256    # queue wait samples kept
+
+   def __init__(self, baud, mingap=MINGAP, maxgap=MAXGAP):
+      self.baud     = baud
+      self.mingap   = mingap
+      self.maxgap   = max(mingap, maxgap)
+      self.gap      = self.clamp(Pacer.GAP)
+      self.srtt     = None
+      self.rttvar   = 0.0
+      self.latency  = {}    # request key -> [samples, smoothed latency]
+      self.awaiting = {}    # response key -> (request key, tx time)
+      self.wait     = Vector(Pacer.NWAIT, 'd')
+      self.nlost    = 0
+      self.utilisation = 0.0
+      self.__bits   = 0
+      self.__t      = monotonic()
+
+
+   def clamp(self, gap):
+      return min(max(gap, self.mingap), self.maxgap)
+
+
+   def sent(self, message, queued, now):
+      '''Accounts message transmitted at now, enqueued at queued'''
+      self.wait.append(now - queued)
+      self.__bits += 10*len(message)       # 8N1
+      reply = responseKey(message)
+      if reply is not None and reply not in self.awaiting:
+         self.awaiting[reply] = (messageKey(message), now)
+
+
+   def received(self, message, now):
+      '''Accounts message received at now'''
+      self.__bits += 10*len(message)
+      if len(message) == STATLEN:
+         return                            # periodic status
+      entry = self.awaiting.pop(messageKey(message), None)
+      if entry is not None:
+         self.sample(entry[0], now - entry[1])
+
+
+   def sample(self, key, rtt):
+      '''Updates latency estimates and moves the gap towards them'''
+      stat = self.latency.setdefault(key, [0, rtt])
+      stat[0] += 1
+      stat[1] += (rtt - stat[1]) / 8
+      if self.srtt is None:
+         self.srtt   = rtt
+         self.rttvar = rtt / 2
+      else:
+         self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt - rtt)
+         self.srtt   = 0.875*self.srtt + 0.125*rtt
+      self.gap = self.clamp(0.75*self.gap + 0.25*(self.srtt + 2*self.rttvar))
+
+
+   def expire(self, now):
+      '''Forgets responses not received in time and backs off'''
+      lost = [k for k, (key, t) in self.awaiting.iteritems() if now - t > Pacer.EXPIRE]
+      for k in lost:
+         del self.awaiting[k]
+      if lost:
+         self.nlost += len(lost)
+         self.gap    = self.clamp(2*self.gap)
+         log.debug("%d responses lost, gap = %.2f s", len(lost), self.gap)
+
+
+   def forget(self):
+      '''Stop waiting for responses, as when EMA is on hold'''
+      self.awaiting.clear()
+
+
+   def update(self, now):
+      '''Updates the line utilisation average'''
+      dt = now - self.__t
+      if dt <= 0:
+         return
+      alpha = 1.0 - math.exp(-dt / Pacer.TAU)
+      self.utilisation += alpha * (float(self.__bits) / (self.baud * dt) - self.utilisation)
+      self.__bits = 0
+      self.__t    = now
+
+
+   def stats(self):
+      '''Returns a dictionary of pacing statistics'''
+      return {
+         'gap'         : self.gap,
+         'rtt'         : self.srtt,
+         'lost'        : self.nlost,
+         'utilisation' : self.utilisation,
+         'wait'        : self.wait.stats() if self.wait.len() else {},
+         'latency'     : dict((k, {'n': n, 'latency': l}) for k, (n, l) in self.latency.iteritems()),
+      }
+
+
 
 class SerialDriver(Lazy):
 
@@ -72,13 +369,15 @@ class SerialDriver(Lazy):
       Lazy.__init__(self)
       self.__nreads   = 0
       self.__nwrites  = 0
-      self.__buffer   = ''
+      self.__decoder  = FrameDecoder(int(kargs.get('serial_maxframe', FrameDecoder.MAXLEN)))
       self.__handlers = []
-      self.__outqueue = []
+      self.__outqueue = OutputQueue()
       self.__stopped  = False
-      
-      # An EMA message, surronded by brackets
-      self.__patt     = re.compile('\([^)]+\)') 
+      self.__pending  = bytearray()   # output bytes not yet written
+      self.__writable = False
+      self.__pacer    = Pacer(baud,
+                              float(kargs.get('serial_mingap', Pacer.MINGAP)),
+                              float(kargs.get('serial_maxgap', Pacer.MAXGAP)))
       self.__serial          = serial.Serial()
       self.__serial.port     = port
       self.__serial.baudrate = baud
@@ -89,23 +388,41 @@ class SerialDriver(Lazy):
       except serial.SerialException, e:
          log.error("Could not open serial port %s: %s", self.__serial.name, e)
          raise
+      fd = self.__serial.fileno()
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
       log.info("Opened %s at %s bps", self.__serial.port, self.__serial.baudrate)
+      self.__gap = self.__pacer.gap
+      self.setPeriod(self.__gap)
       
    # ----------------------------------------
    # Public interface exposed to upper layers
    # -----------------------------------------
 
 
-   def write(self, message):
+   def write(self, message, priority=None):
       '''
-      Enqueues message to output queue
+      Enqueues message to output queue in priority class,
+      by default as given by classify()
       '''
-      self.__outqueue.append(message)
+      if priority is None:
+         priority = classify(message)
+      if not self.__outqueue.push(message, priority, monotonic()):
+         log.debug("%s already queued", message)
+
+
+   def queueDelay(self, priority=OutputQueue.BULK):
+       '''returns the max wait time in multiples of Server.TIMEOUT
+       for a message in priority class'''
+       return (1+self.__outqueue.ahead(priority)) * self.__pacer.gap / Server.TIMEOUT
 
 
-   def queueDelay(self):
-       '''returns the max wait time in multiples of Server.TIMEOUT'''
-       return 1+len(self.__outqueue) 
+   def pacing(self):
+      '''Returns a dictionary of pacing, queue wait and line statistics'''
+      self.__pacer.update(monotonic())
+      stats = self.__pacer.stats()
+      stats['queue']     = self.__outqueue.lengths()
+      stats['coalesced'] = self.__outqueue.ncoalesced
+      return stats
 
 
    def hold(self, flag):
@@ -114,6 +431,8 @@ class SerialDriver(Lazy):
       and transmitting to serial port.
       '''
       self.__stopped = flag
+      if flag:
+         self.__pacer.forget()
       log.debug("on hold = %s", flag)
 
 
@@ -129,21 +448,51 @@ class SerialDriver(Lazy):
    def work(self):
       '''
       Writes data to serial port configured at init. 
-      Called periodically from a Server object.
-      Write blocking behaviour.
+      Called periodically from a Server object, every pacer gap.
+      Non blocking behaviour.
       '''
-      qlen = len(self.__outqueue)
+      now = monotonic()
+      self.__pacer.update(now)
       if self.__stopped:
          return
+      self.__pacer.expire(now)
 
-      if qlen:
-         try:
-            log.debug("Tx %s",  self.__outqueue[0])
-            self.__nwrites += 1
-            self.__serial.write(self.__outqueue.pop(0))                 
-         except serial.__serialException, e:
+      if self.__outqueue and not self.__pending:
+         message, queued, prio = self.__outqueue.pop()
+         log.debug("Tx %s",  message)
+         self.__nwrites += 1
+         self.__pending.extend(message)
+         self.flush()
+         self.__pacer.sent(message, queued, now)
+      if self.__pacer.gap != self.__gap:
+         self.__gap = self.__pacer.gap
+         self.setPeriod(self.__gap)
+
+
+   def flush(self):
+      '''
+      Writes pending bytes as far as the port accepts them.
+      Registers for writability only while bytes remain.
+      '''
+      try:
+         n = os.write(self.__serial.fileno(), self.__pending)
+      except OSError, e:
+         if e.errno not in (errno.EAGAIN, errno.EINTR):
             log.error("%s: %s" , self.__serial.portstr, e)
-            raise
+            raise serial.SerialException(str(e))
+         n = 0
+      del self.__pending[:n]
+      if self.__pending and not self.__writable:
+         Server.instance.addWritable(self)
+         self.__writable = True
+      elif not self.__pending and self.__writable:
+         Server.instance.delWritable(self)
+         self.__writable = False
+
+
+   def pending(self):
+      '''Output bytes not yet written to the port'''
+      return len(self.__pending)
 
 
    def read(self):
@@ -157,41 +506,47 @@ class SerialDriver(Lazy):
          log.error("%s: %s" , self.__serial.portstr, e)
          raise
 
-      
-   def extract(self):
-      '''
-      Extracts a complete EMA message
-      Returns whole message if available or null string if not.
-      '''
-      matched = self.__patt.search(self.__buffer)
-      message = ''
-      if matched:
-         message = matched.group()
-         self.__buffer = self.__buffer[matched.end():]
-         self.__nreads += 1
-         log.debug("Rx %s", message)
-      return message
+
+
+   def counters(self):
+      '''Returns a dictionary of read/written message counters'''
+      return {
+         'reads'   : self.__nreads,
+         'writes'  : self.__nwrites,
+         'queued'  : len(self.__outqueue),
+         'dropped' : self.__decoder.ndropped,
+      }
 
 
    def show(self):
       '''print read/written message statistcs every NSTATs times'''
       n = max(self.__nreads, self.__nwrites) % SerialDriver.NSTATS
       if not n:
-         log.info("nreads = %d, nwrites = %d , queue = %d", self.__nreads, self.__nwrites, len(self.__outqueue))
+         log.info("nreads = %(reads)d, nwrites = %(writes)d , queued = %(queued)d, dropped = %(dropped)d bytes", self.counters())
 
 
    def onInput(self):
       '''
-      Read from message buffer and notify handlers if message complete.
+      Read from message buffer and notify handlers of every complete message.
       Called from Server object
       '''
-      self.__buffer += self.read()           # accumulate reading
-      message        = self.extract()        # extract whole message
-      if message:
+      now = monotonic()
+      for message in self.__decoder.feed(self.read()):
+         self.__nreads += 1
+         self.__pacer.received(message, now)
+         log.debug("Rx %s", message)
          for handler in self.__handlers:
             handler.onSerialMessage(message)
 
 
+   def onOutput(self):
+      '''
+      Writes the rest of pending bytes.
+      Called from Server object when the port is writable
+      '''
+      self.flush()
+
+
    def fileno(self):
       '''Implement this interface to be added in select() system call'''
       return self.__serial.fileno()
@@ -199,8 +554,130 @@ class SerialDriver(Lazy):
 
 
 
+def benchmark(baud=57600, seconds=60, seed=1):
+   '''
+   Compares the former regexp reassembly, extracting one message per
+   read, with FrameDecoder over the traffic of seconds at baud bps
+   (status messages with bulk dump bursts), read in random chunks.
+   One read in ten comes after a busy loop iteration and gets the
+   bytes accumulated in the meantime.
+   '''
+   import random
+   import time
+   from emaproto import STATLEN
+
+   rnd    = random.Random(seed)
+   status = '(' + 'x'*(STATLEN-2) + ')'
+   page   = ''.join(['(%s)' % ('%04d' % i + 'y'*76) for i in range(24)])
+   nbytes = baud // 10 * seconds                 # 8N1
+   stream = []
+   size   = 0
+   while size < nbytes:
+      msg = page if rnd.random() < 0.02 else status
+      stream.append(msg)
+      size += len(msg)
+   stream = ''.join(stream)
+   chunks = []
+   i = 0
+   while i < len(stream):
+      k = rnd.randint(256, 2048) if rnd.random() < 0.1 else rnd.randint(1, 64)
+      chunks.append(stream[i:i+k])
+      i += k
+   total = stream.count(')')
+
+   t0 = time.time()
+   buf = ''
+   nold = 0
+   maxbuf = 0
+   for chunk in chunks:
+      buf += chunk
+      matched = FRAME.search(buf)
+      if matched:
+         buf = buf[matched.end():]
+         nold += 1
+      maxbuf = max(maxbuf, len(buf))
+   told = time.time() - t0
+
+   t0 = time.time()
+   decoder = FrameDecoder()
+   nnew = 0
+   maxnew = 0
+   for chunk in chunks:
+      nnew += len(decoder.feed(chunk))
+      maxnew = max(maxnew, len(decoder))
+   tnew = time.time() - t0
+
+   print "%d bytes (%d s at %d bps) in %d reads, %d messages" % (len(stream), seconds, baud, len(chunks), total)
+   print "regexp : %.3f s, %d messages, %d backlogged, max buffer %d bytes" % (told, nold, total-nold, maxbuf)
+   print "decoder: %.3f s, %d messages, %d backlogged, max buffer %d bytes" % (tnew, nnew, total-nnew, maxnew)
+
+
+
+def ptytest(reactor='select', nmessages=200, size=1000, stall=2.0):
+   '''
+   Writes nmessages of size bytes through a SerialDriver on a pseudo
+   terminal whose other end is not read for stall seconds, so that
+   the terminal buffer fills up. Checks that no loop step blocks and
+   that all bytes arrive in order once the other end is read.
+   '''
+   import pty
+   import tty
+   import server
+
+   master, slave = pty.openpty()
+   tty.setraw(master)
+   tty.setraw(slave)
+   s = server.Server()
+   s.SetTimeout(0.01)
+   s.setReactor(reactor)
+   driver = SerialDriver(os.ttyname(slave), 9600, serial_mingap=0.01, serial_maxgap=0.01)
+   s.addLazy(driver)
+   s.addReadable(driver)
+   messages = ['(%04d%s)' % (i, 'x'*(size-6)) for i in range(nmessages)]
+   for message in messages:
+      driver.write(message, OutputQueue.BULK)
+   expected = ''.join(messages)
+
+   class Reader(object):
+      def __init__(self):
+         self.data = bytearray()
+      def fileno(self):
+         return master
+      def onInput(self):
+         self.data.extend(os.read(master, 65536))
+
+   reader  = Reader()
+   reading = False
+   slowest = 0.0
+   backlog = 0
+   t0 = monotonic()
+   while len(reader.data) < len(expected) and monotonic() - t0 < stall + 30:
+      if not reading and monotonic() - t0 >= stall:
+         s.addReadable(reader)
+         reading = True
+      t = monotonic()
+      s.step(0.05)
+      slowest = max(slowest, monotonic() - t)
+      backlog = max(backlog, driver.pending())
+
+   ok = str(reader.data) == expected
+   print "%s reactor: %d bytes in %.1f s, max pending %d bytes, slowest step %.3f s, %s" % (
+      reactor, len(reader.data), monotonic() - t0, backlog, slowest, "OK" if ok else "FAILED")
+   return ok
+
+
+
 if __name__ == "__main__":
 
+   import sys
+   if sys.argv[1:] == ['bench']:
+      benchmark()
+      sys.exit(0)
+   if sys.argv[1:2] == ['ptytest']:
+      ok = all([ptytest(reactor) for reactor in sys.argv[2:] or ['select', 'epoll']])
+      sys.exit(0 if ok else 1)
+
+   import server
    from utils import setDebug
    class Sample(object):
       def onSerialMessage(self, message):
@@ -212,7 +689,6 @@ if __name__ == "__main__":
    driver.addHandler( Sample() )
    driver.write('( )')
    s = server.Server()
+   s.addLazy(driver)
    s.addReadable(driver)
    s.run()
-
-
@@ -58,9 +58,49 @@
 # of several hours with seconds precision. There is onle one SIGALARM
 # handler. ALarmable and Laazy classers are just fine for short timeouts.
 #
+# In v3.0, the I/O multiplexing and timer bookkeeping is delegated to
+# a reactor object, so that the event loop can be chosen at startup
+# without touching the rest of the objects:
+#
+# - SelectReactor is the original select() loop with a fixed tick,
+#   anchored to the monotonic clock. Lazy and Alarmable counters are
+#   advanced once per elapsed tick, whether there was I/O or not.
+#
+# - EPollReactor uses epoll() for I/O and a min-heap of deadlines,
+#   measured with a monotonic clock, for Lazy and Alarmable objects.
+#   It sleeps exactly until the next due timer and fires timers after
+#   serving I/O, even if there was I/O activity in the same iteration.
+#   There are no periodic wakeups when nothing is due.
+#
+# Both reactors guarantee that timers are serviced independently of
+# I/O traffic. A chattering serial line or an MQTT burst must not
+# starve the watchdog keepalives or the command timeouts.
+# Each iteration may spend at most IO_BUDGET seconds in I/O handlers.
+# Ready objects not served within the budget are served first in the
+# next iteration, once timers have had their chance.
+#
+# To support deadlines, Lazy, Alarmable and Alarmable2 objects keep
+# their period/timeout in seconds alongside the counters and expose a
+# deadline() method. Whenever a deadline changes (resetAlarm(),
+# setTimeout(), reset(), setPeriod()) the running Server instance
+# is told to reschedule the object. This is a no-op in SelectReactor.
+#
+# Every reactor invokes the onInput()/onOutput(), work() and
+# onTimeoutDo() callbacks through an Instruments object shared with
+# the Server. It keeps, per 'Class.method', the number of calls and
+# a histogram of their run time in power of 2 microsecond buckets,
+# and for timers, a histogram of the loop lag: how late the callback
+# fired with respect to its deadline. Run times are measured with
+# time.time(), as monotonic() may fall back to clock tick resolution
+# in Python 2. Server.instruments.snapshot() returns all of it as a
+# dictionary, ready to be published as JSON.
+#
 # ======================================================================
 
+import os
+import time
 import errno
+import heapq
 import select
 import logging
 import datetime
@@ -69,6 +109,162 @@ from   abc import ABCMeta, abstractmethod
 log = logging.getLogger('server')
 
 
+# Monotonic clock for deadlines, not affected by RTC/NTP time steps.
+# Python 2 has no time.monotonic(), so clock_gettime(CLOCK_MONOTONIC)
+# is called through ctypes. The elapsed real time returned by
+# os.times() is only a last resort: it has clock tick resolution and
+# wraps around after some 248 days of uptime where clock_t is 32 bits.
+CLOCK_MONOTONIC = 1     # from <linux/time.h>
+
+def _clock_gettime():
+    '''Returns clock_gettime(CLOCK_MONOTONIC) as a function, or None'''
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        if path is None:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(path, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            continue
+
+        def monotonic():
+            '''Returns CLOCK_MONOTONIC time in seconds'''
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        return monotonic
+    return None
+
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = _clock_gettime()
+    if monotonic is None:
+        def monotonic():
+            '''Returns elapsed real time in seconds from an arbitrary point'''
+            return os.times()[4]
+
+
+def reschedule(obj):
+    '''Notifies the running server that obj deadline has changed'''
+    if Server.instance is not None:
+        Server.instance.reschedule(obj)
+
+
+# ==========================================================
+
+class Histogram(object):
+    '''
+    Counts of durations in logarithmic buckets.
+    Bucket i holds durations below 2**i microseconds.
+    '''
+
+    NBUCKETS = 28       # last bucket is for 2**27 us (134 s) and above
+
+    def __init__(self):
+        self.buckets = [0] * Histogram.NBUCKETS
+        self.n       = 0
+        self.total   = 0.0
+        self.max     = 0.0
+
+
+    def add(self, seconds):
+        i = min(int(seconds * 1000000).bit_length(), Histogram.NBUCKETS - 1)
+        self.buckets[i] += 1
+        self.n       += 1
+        self.total   += seconds
+        self.max      = max(self.max, seconds)
+
+
+    def percentile(self, q):
+        '''Upper bound in seconds of the bucket holding the q quantile'''
+        rank, accum = q * self.n, 0
+        for i, count in enumerate(self.buckets):
+            accum += count
+            if count and accum >= rank:
+                return min(2**i / 1000000.0, self.max)
+        return self.max
+
+
+    def snapshot(self):
+        '''Dictionary with times in milliseconds'''
+        ms = lambda x: round(1000 * x, 3)
+        return {
+            'n'       : self.n,
+            'mean'    : ms(self.total / self.n) if self.n else 0,
+            'p50'     : ms(self.percentile(0.50)),
+            'p99'     : ms(self.percentile(0.99)),
+            'max'     : ms(self.max),
+            'buckets' : [[ms(2**i / 1000000.0), count] for i, count in enumerate(self.buckets) if count],
+        }
+
+
+
+class Instruments(object):
+    '''
+    Run time and loop lag histograms of reactor callbacks,
+    keyed by 'Class.method'.
+    '''
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.__keys  = {}   # (class, method) -> 'Class.method'
+        self.runtime = {}   # key -> Histogram
+        self.lag     = {}   # key -> Histogram
+        self.since   = time.time()
+
+
+    def call(self, obj, method, lag=None):
+        '''
+        Invokes obj.method(), timing it.
+        lag is how late a timer callback is invoked.
+        '''
+        cls = obj.__class__
+        key = self.__keys.get((cls, method))
+        if key is None:
+            key = self.__keys[(cls, method)] = '%s.%s' % (cls.__name__, method)
+            self.runtime[key] = Histogram()
+        if lag is not None:
+            hist = self.lag.get(key)
+            if hist is None:
+                hist = self.lag[key] = Histogram()
+            hist.add(max(0.0, lag))
+        t0 = time.time()
+        try:
+            getattr(obj, method)()
+        finally:
+            self.runtime[key].add(max(0.0, time.time() - t0))
+
+
+    def snapshot(self):
+        '''Returns a dictionary with all histograms'''
+        return {
+            'period'  : round(time.time() - self.since, 3),
+            'runtime' : dict((k, h.snapshot()) for k, h in self.runtime.iteritems()),
+            'lag'     : dict((k, h.snapshot()) for k, h in self.lag.iteritems()),
+        }
+
+
+
+
 class Server(object):
 
     TIMEOUT = 1   # seconds timeout in select()
@@ -76,16 +272,39 @@ class Server(object):
     instance = None
 
     def __init__(self):
-        self.__readables  = []
-        self.__writables  = []
-        self.__alarmables = []
-        self.__lazy       = []
+        self.instruments  = Instruments()
+        self.__reactor    = SelectReactor()
+        self.__reactor.instruments = self.instruments
         Server.instance   = self
 
     def SetTimeout(self, newT):
         '''Set the select() timeout'''
         Server.TIMEOUT = newT
 
+
+    def setReactor(self, reactor):
+        '''
+        Replaces the current reactor by another one, given by name
+        (see REACTORS) or as an object.
+        Already registered objects are moved to the new reactor.
+        '''
+        if isinstance(reactor, basestring):
+            reactor = REACTORS[reactor]()
+        readables, writables, alarmables, lazies = self.__reactor.registered()
+        self.__reactor.close()
+        self.__reactor = reactor
+        reactor.instruments = self.instruments
+        for obj in readables:
+            reactor.addReadable(obj)
+        for obj in writables:
+            reactor.addWritable(obj)
+        for obj in alarmables:
+            reactor.addAlarmable(obj)
+        for obj in lazies:
+            reactor.addLazy(obj)
+        log.info("Using %s", reactor.__class__.__name__)
+
+
     def addReadable(self, obj):
         '''
         Adds a readable object implementing the following methods:
@@ -95,31 +314,31 @@ class Server(object):
         # Returns AttributeError exception if not
         callable(getattr(obj,'fileno'))
         callable(getattr(obj,'onInput'))
-        self.__readables.append(obj)
+        self.__reactor.addReadable(obj)
 
 
     def delReadable(self, obj):
         '''Removes readable object from the list, 
         thus avoiding onInput() callback'''
-        self.__readables.pop(self.__readables.index(obj))
+        self.__reactor.delReadable(obj)
 
 
     def addWritable(self, obj):
         '''
-        Adds a readable object implementing the following methods:
+        Adds a writable object implementing the following methods:
         fileno()
         onOutput()
         '''
         # Returns AttributeError exception if not
         callable(getattr(obj,'fileno'))
         callable(getattr(obj,'onOutput'))
-        self.__readables.append(obj)
+        self.__reactor.addWritable(obj)
 
 
     def delWritable(self, obj):
         '''Removes writable object from the list, 
         thus avoiding onOutput() callback'''
-        self.__writables.pop(self.__writables.index(obj))
+        self.__reactor.delWritable(obj)
 
 
     def addAlarmable(self, obj):
@@ -131,13 +350,13 @@ class Server(object):
         # Returns AttributeError exception if not
         callable(getattr(obj,'timeout'))
         callable(getattr(obj,'onTimeoutDo'))
-        self.__alarmables.append(obj)
+        self.__reactor.addAlarmable(obj)
 
 
     def delAlarmable(self, obj):
         '''Removes alarmable object from the list, 
         thus avoiding onTimeoutDo() callback'''
-        self.__alarmables.pop(self.__alarmables.index(obj))
+        self.__reactor.delAlarmable(obj)
 
 
     def addLazy(self, obj):
@@ -148,40 +367,21 @@ class Server(object):
         # Returns AttributeError exception if not
         callable(getattr(obj,'work'))
         callable(getattr(obj,'mustWork'))
-        self.__lazy.append(obj)
+        self.__reactor.addLazy(obj)
+
+
+    def reschedule(self, obj):
+        '''Recomputes obj position in the timer queue after a deadline change'''
+        self.__reactor.reschedule(obj)
 
 
-    def step(self,timeout):
+    def step(self, timeout=None):
         '''
-        Single step run, invoking I/O handlers or timeout handlers
+        Single step run, invoking I/O handlers or timeout handlers.
+        With no timeout given, the reactor decides how long to wait.
         '''
+        self.__reactor.step(timeout)
 
-        nreadables, nwritables, nexceptionals = select.select(
-              self.__readables, self.__writables, [], timeout)
-
-        io_activity = False
-        if nreadables:
-            io_activity = True
-            for readable in nreadables:
-                readable.onInput()
-        
-        if nwritables:
-            io_activity = True
-            for writable in nwritables:
-                readable.onOutput()
-
-        if not io_activity:                   
-            # Execute alarms first
-            for alarm in self.__alarmables:
-                if alarm.timeout():
-                    self.delAlarmable(alarm)
-                    alarm.onTimeoutDo()
-
-            # Executes recurring work procedures last
-            for lazy in self.__lazy:
-                if lazy.mustWork():
-                    lazy.work()
-    
 
     def run(self):
         '''
@@ -189,7 +389,7 @@ class Server(object):
         '''
         while True:
             try:
-                self.step(Server.TIMEOUT)
+                self.step()
             except KeyboardInterrupt:
                 log.warning("Server.run() aborted by user request")
                 break
@@ -206,6 +406,352 @@ class Server(object):
         pass
 
 
+# ==========================================================
+
+class SelectReactor(object):
+    '''
+    Original select() based event loop with a fixed Server.TIMEOUT tick.
+    Alarms and lazy objects are serviced once per elapsed tick.
+    '''
+
+    IO_BUDGET = 0.5     # max. seconds spent in I/O handlers per iteration
+
+    def __init__(self):
+        self.__readables  = []
+        self.__writables  = []
+        self.__alarmables = []
+        self.__lazy       = []
+        self.__pending    = []    # ready objects left out by the I/O budget
+        self.__tick       = monotonic() + Server.TIMEOUT
+        self.instruments  = Instruments()
+
+
+    def registered(self):
+        '''Returns a tuple of lists with all registered objects'''
+        return (self.__readables[:], self.__writables[:],
+                self.__alarmables[:], self.__lazy[:])
+
+    def close(self):
+        pass
+
+    def addReadable(self, obj):
+        self.__readables.append(obj)
+
+    def delReadable(self, obj):
+        self.__readables.pop(self.__readables.index(obj))
+
+    def addWritable(self, obj):
+        self.__writables.append(obj)
+
+    def delWritable(self, obj):
+        self.__writables.pop(self.__writables.index(obj))
+
+    def addAlarmable(self, obj):
+        self.__alarmables.append(obj)
+
+    def delAlarmable(self, obj):
+        self.__alarmables.pop(self.__alarmables.index(obj))
+
+    def addLazy(self, obj):
+        self.__lazy.append(obj)
+
+    def reschedule(self, obj):
+        pass
+
+
+    def dispatch(self, ready, method):
+        '''
+        Invokes method on ready objects, previously postponed ones first,
+        until the I/O budget is exhausted.
+        '''
+        pending = self.__pending
+        ready   = [obj for obj in pending if obj in ready] + \
+                  [obj for obj in ready if obj not in pending]
+        limit   = monotonic() + SelectReactor.IO_BUDGET
+        for i, obj in enumerate(ready):
+            if monotonic() >= limit:
+                self.__pending = ready[i:]
+                break
+            self.instruments.call(obj, method)
+        else:
+            self.__pending = []
+
+
+    def tick(self, now):
+        '''Advances alarm and lazy counters one tick'''
+        # Execute alarms first
+        for alarm in self.__alarmables[:]:
+            if alarm.timeout():
+                self.delAlarmable(alarm)
+                lag = monotonic() - alarm.deadline()
+                alarm.rearm(now)
+                self.instruments.call(alarm, 'onTimeoutDo', lag)
+
+        # Executes recurring work procedures last
+        for lazy in self.__lazy:
+            if lazy.mustWork():
+                lag = monotonic() - lazy.deadline()
+                lazy.rearm(now)
+                self.instruments.call(lazy, 'work', lag)
+
+
+    def step(self, timeout):
+        '''
+        Single step run, invoking I/O handlers and, if a tick has
+        elapsed, timeout handlers
+        '''
+        delay = max(0, self.__tick - monotonic())
+        if timeout is not None:
+            delay = min(delay, timeout)
+
+        nreadables, nwritables, nexceptionals = select.select(
+              self.__readables, self.__writables, [], delay)
+
+        if nreadables:
+            self.dispatch(nreadables, 'onInput')
+
+        for writable in nwritables:
+            if writable in self.__writables:    # may be gone meanwhile
+                self.instruments.call(writable, 'onOutput')
+
+        now = monotonic()
+        if now >= self.__tick:
+            self.__tick += Server.TIMEOUT
+            if self.__tick <= now:
+                self.__tick = now + Server.TIMEOUT  # lagging, resync
+            self.tick(now)
+
+# ==========================================================
+
+class EPollReactor(object):
+    '''
+    epoll() based event loop with a min-heap of monotonic deadlines.
+    Sleeps until the next due timer and fires timers on every iteration,
+    regardless of I/O activity.
+    '''
+
+    MAXEVENTS = 64      # max. number of I/O events served per iteration
+    IO_BUDGET = 0.5     # max. seconds spent in I/O handlers per iteration
+
+    # Timer kinds in the heap
+    ALARM = 0
+    LAZY  = 1
+
+    def __init__(self):
+        self.__epoll     = select.epoll()
+        self.__readers   = {}    # fd  -> readable object
+        self.__writers   = {}    # fd  -> writable object
+        self.__rfd       = {}    # readable object -> registered fd
+        self.__wfd       = {}    # writable object -> registered fd
+        self.__masks     = {}    # fd  -> epoll mask
+        self.__heap      = []    # [deadline, seq, obj, kind] entries
+        self.__entries   = {}    # timer object -> its live heap entry
+        self.__seq       = 0
+        self.__pending   = []    # ready fds left out by the I/O budget
+        self.instruments = Instruments()
+
+
+    def registered(self):
+        '''Returns a tuple of lists with all registered objects'''
+        alarms = [obj for obj, entry in self.__entries.items() if entry[3] == EPollReactor.ALARM]
+        lazies = [obj for obj, entry in self.__entries.items() if entry[3] == EPollReactor.LAZY]
+        return (self.__rfd.keys(), self.__wfd.keys(), alarms, lazies)
+
+
+    def close(self):
+        self.__epoll.close()
+
+    # -------------------------
+    # I/O objects registration
+    # -------------------------
+
+    def __update(self, fd):
+        '''Syncs the epoll interest set for fd with the readers/writers tables'''
+        mask = 0
+        if fd in self.__readers:
+            mask |= select.EPOLLIN
+        if fd in self.__writers:
+            mask |= select.EPOLLOUT
+        old = self.__masks.get(fd, 0)
+        try:
+            if mask and old:
+                self.__epoll.modify(fd, mask)
+            elif mask:
+                self.__epoll.register(fd, mask)
+            elif old:
+                self.__epoll.unregister(fd)
+        except IOError as e:
+            # closed fds are silently dropped from the epoll set and
+            # their numbers may be reused by new sockets
+            if e.errno == errno.EEXIST:
+                self.__epoll.modify(fd, mask)
+            elif e.errno == errno.ENOENT and mask:
+                self.__epoll.register(fd, mask)
+            elif e.errno not in (errno.ENOENT, errno.EBADF):
+                raise
+        if mask:
+            self.__masks[fd] = mask
+        else:
+            self.__masks.pop(fd, None)
+
+
+    def addReadable(self, obj):
+        fd = obj.fileno()
+        self.__rfd[obj]    = fd
+        self.__readers[fd] = obj
+        self.__update(fd)
+
+    def delReadable(self, obj):
+        if obj not in self.__rfd:
+            raise ValueError("not a registered readable object")
+        fd = self.__rfd.pop(obj)
+        del self.__readers[fd]
+        self.__update(fd)
+
+    def addWritable(self, obj):
+        fd = obj.fileno()
+        self.__wfd[obj]    = fd
+        self.__writers[fd] = obj
+        self.__update(fd)
+
+    def delWritable(self, obj):
+        if obj not in self.__wfd:
+            raise ValueError("not a registered writable object")
+        fd = self.__wfd.pop(obj)
+        del self.__writers[fd]
+        self.__update(fd)
+
+    # ---------------------------
+    # Timer objects registration
+    # ---------------------------
+
+    def __push(self, obj, kind):
+        '''Pushes a new heap entry for obj, invalidating the old one'''
+        old = self.__entries.get(obj)
+        if old is not None:
+            old[2] = None
+        self.__seq += 1
+        entry = [obj.deadline(), self.__seq, obj, kind]
+        self.__entries[obj] = entry
+        heapq.heappush(self.__heap, entry)
+
+
+    def __remove(self, obj):
+        '''Invalidates obj heap entry. It is discarded when popped'''
+        if obj not in self.__entries:
+            raise ValueError("not a registered timer object")
+        self.__entries.pop(obj)[2] = None
+
+
+    def addAlarmable(self, obj):
+        self.__push(obj, EPollReactor.ALARM)
+
+    def delAlarmable(self, obj):
+        self.__remove(obj)
+
+    def addLazy(self, obj):
+        self.__push(obj, EPollReactor.LAZY)
+
+    def reschedule(self, obj):
+        entry = self.__entries.get(obj)
+        if entry is not None:
+            self.__push(obj, entry[3])
+
+    # --------------
+    # Loop execution
+    # --------------
+
+    def __delay(self, now, timeout):
+        '''Seconds to wait in epoll(), -1 meaning forever'''
+        heap = self.__heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)    # discard invalidated entries
+        delay = max(0, heap[0][0] - now) if heap else -1
+        if timeout is not None and (delay < 0 or timeout < delay):
+            delay = timeout
+        return delay
+
+
+    def __poll(self, delay):
+        try:
+            return self.__epoll.poll(delay, EPollReactor.MAXEVENTS)
+        except IOError as e:
+            if e.errno != errno.EINTR:
+                raise
+            return []
+
+
+    def __dispatch(self, events):
+        '''
+        Invokes I/O handlers for the polled events, previously
+        postponed ones first, until the I/O budget is exhausted.
+        '''
+        if self.__pending:
+            # stable sort, still ready postponed fds go first
+            order = dict((fd, i) for i, fd in enumerate(self.__pending))
+            last  = len(order)
+            events.sort(key=lambda ev: order.get(ev[0], last))
+        limit = monotonic() + EPollReactor.IO_BUDGET
+        for i, (fd, mask) in enumerate(events):
+            if monotonic() >= limit:
+                self.__pending = [ev[0] for ev in events[i:]]
+                break
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                obj = self.__readers.get(fd)
+                if obj is not None:
+                    self.instruments.call(obj, 'onInput')
+            if mask & (select.EPOLLOUT | select.EPOLLERR):
+                obj = self.__writers.get(fd)
+                if obj is not None:
+                    self.instruments.call(obj, 'onOutput')
+        else:
+            self.__pending = []
+
+
+    def __expire(self, now):
+        '''Fires all timers due at now'''
+        heap = self.__heap
+        due  = []
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if entry[2] is not None:
+                due.append(entry)
+        # Timers added by callbacks below wait for the next iteration
+        for entry in due:
+            obj, kind = entry[2], entry[3]
+            if obj is None:
+                continue                 # deleted by a previous callback
+            if obj.deadline() > now:
+                self.__push(obj, kind)   # deadline moved forward meanwhile
+                continue
+            lag = monotonic() - obj.deadline()
+            if kind == EPollReactor.ALARM:
+                self.__remove(obj)
+                obj.rearm(now)
+                self.instruments.call(obj, 'onTimeoutDo', lag)
+            else:
+                obj.rearm(now)
+                self.__push(obj, kind)
+                self.instruments.call(obj, 'work', lag)
+
+
+    def step(self, timeout):
+        '''
+        Single step run: wait for I/O or the next deadline,
+        invoke I/O handlers and then fire due timers
+        '''
+        events = self.__poll(self.__delay(monotonic(), timeout))
+        if events:
+            self.__dispatch(events)
+        self.__expire(monotonic())
+
+
+# Available reactors by name
+REACTORS = {
+    'select' : SelectReactor,
+    'epoll'  : EPollReactor,
+}
+
 # ==========================================================
 
 class Lazy(object):
@@ -218,16 +764,22 @@ class Lazy(object):
     __metaclass__ = ABCMeta     # Only Python 2.7
 
     def __init__(self, period=1.0):
-        self.__count = 0
-        self.__limit = int(round(period/Server.TIMEOUT))
+        self.__count  = 0
+        self.__limit  = max(1, int(round(period/Server.TIMEOUT)))
+        self.__period = period
+        self.__t0     = monotonic()
 
 
     def reset(self):
         self.__count = 0
+        self.__t0    = monotonic()
+        reschedule(self)
 
 
     def setPeriod(self, period):
-        self.__limit = int(round(period/Server.TIMEOUT))
+        self.__limit  = max(1, int(round(period/Server.TIMEOUT)))
+        self.__period = period
+        reschedule(self)
 
 
     def mustWork(self):
@@ -238,6 +790,22 @@ class Lazy(object):
         self.__count = (self.__count + 1) % self.__limit
         return  (self.__count == 0)
 
+
+    def deadline(self):
+        '''Monotonic time when work() is due'''
+        return self.__t0 + self.__period
+
+
+    def rearm(self, now):
+        '''
+        Advances the deadline one period without drifting.
+        If lagging more than one period, start again from now.
+        '''
+        self.__t0 += self.__period
+        if self.__t0 + self.__period <= now:
+            self.__t0 = now
+
+
     @abstractmethod
     def work(self):
         '''
@@ -258,16 +826,22 @@ class Alarmable(object):
     __metaclass__ = ABCMeta     # Only Python 2.7
 
     def __init__(self, timeout=1.0):
-        self.__count = 0
-        self.__limit = int(round(timeout/Server.TIMEOUT))
+        self.__count   = 0
+        self.__limit   = int(round(timeout/Server.TIMEOUT))
+        self.__timeout = timeout
+        self.__t0      = monotonic()
 
 
     def resetAlarm(self):
         self.__count = 0
+        self.__t0    = monotonic()
+        reschedule(self)
 
 
     def setTimeout(self, timeout):
-        self.__limit = int(round(timeout/Server.TIMEOUT))
+        self.__limit   = int(round(timeout/Server.TIMEOUT))
+        self.__timeout = timeout
+        reschedule(self)
 
 
     def timeout(self):
@@ -279,6 +853,16 @@ class Alarmable(object):
         return  (self.__count == 0)
 
 
+    def deadline(self):
+        '''Monotonic time when onTimeoutDo() is due'''
+        return self.__t0 + self.__timeout
+
+
+    def rearm(self, now):
+        '''Restarts counting from now, as the tick counter wraps to 0'''
+        self.__t0 = now
+
+
     @abstractmethod
     def onTimeoutDo(self):
         '''
@@ -303,6 +887,7 @@ class Alarmable2(object):
 
     def resetAlarm(self):
 	self.__tsFinal    = datetime.datetime.utcnow() + self.__delta
+	reschedule(self)
 
     def setTimeout(self, timeout):
 	self.__delta = datetime.timedelta(seconds=timeout)
@@ -315,6 +900,20 @@ class Alarmable2(object):
         return datetime.datetime.utcnow() >= self.__tsFinal   
 
 
+    def deadline(self):
+        '''
+        Monotonic time when onTimeoutDo() is due.
+        Final timestamp is kept in UTC, so it is recomputed each time.
+        '''
+        remaining = self.__tsFinal - datetime.datetime.utcnow()
+        return monotonic() + remaining.total_seconds()
+
+
+    def rearm(self, now):
+        '''Nothing to do, final timestamp is only set by resetAlarm()'''
+        pass
+
+
     @abstractmethod
     def onTimeoutDo(self):
         '''
@@ -324,7 +923,56 @@ class Alarmable2(object):
 
 
 if __name__ == "__main__":
-    utils.setDebug()
-    server = Server()
-    server.run()
-    server.stop()
+
+    # Stress check: floods a fake fd with a slow handler, as a
+    # chattering serial line would, and verifies that a watchdog-like
+    # Lazy object keeps its cadence in every reactor.
+    # Run as: python -m ema.server
+
+    import sys
+
+    class Flood(object):
+        '''A pipe that is always readable, with a costly handler'''
+        def __init__(self):
+            self.rd, self.wr = os.pipe()
+            os.write(self.wr, 'x'*4096)
+            self.n = 0
+        def fileno(self):
+            return self.rd
+        def onInput(self):
+            os.read(self.rd, 64)
+            os.write(self.wr, 'x'*64)   # keep it readable forever
+            time.sleep(0.02)            # handler cost
+            self.n += 1
+        def close(self):
+            os.close(self.rd)
+            os.close(self.wr)
+
+    class KeepAlive(Lazy):
+        def __init__(self, period):
+            Lazy.__init__(self, period)
+            self.stamps = [monotonic()]
+        def work(self):
+            self.stamps.append(monotonic())
+
+    logging.basicConfig(level=logging.INFO)
+    PERIOD, DURATION, TOLERANCE = 2.0, 11.0, 0.5
+    failed = False
+    for name in sorted(REACTORS):
+        server = Server()
+        server.setReactor(name)
+        flood = Flood()
+        wdog  = KeepAlive(PERIOD)
+        server.addReadable(flood)
+        server.addLazy(wdog)
+        end = monotonic() + DURATION
+        while monotonic() < end:
+            server.step()
+        flood.close()
+        gaps = [b - a for a, b in zip(wdog.stamps, wdog.stamps[1:])]
+        ok   = len(gaps) == int(DURATION // PERIOD) and \
+               max(abs(g - PERIOD) for g in gaps) < TOLERANCE
+        failed |= not ok
+        log.info("%-6s: %d inputs, keepalive gaps %s [%s]", name, flood.n,
+                 ' '.join('%.2f' % g for g in gaps), 'OK' if ok else 'FAIL')
+    sys.exit(1 if failed else 0)
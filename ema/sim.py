@@ -0,0 +1,376 @@
+# ----------------------------------------------------------------------
+# Copyright (c) 2015 Rafael Gonzalez.
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+# 
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+# ----------------------------------------------------------------------
+
+# ========================== DESIGN NOTES ==============================
+# EMA hardware simulator on a pseudo terminal.
+#
+# Simulator opens a pty pair and speaks EMA protocol on the master
+# side, so that the daemon can be run against the slave side (its
+# path is in Simulator.port) without the real station:
+#
+# 1) Status messages at a configurable rate, far above one every
+#    PERIOD seconds if needed, with slowly drifting readings.
+# 2) GET and SET requests of every parameter descriptor found in the
+#    device modules (dictionaries with 'get', 'set' and 'pat' keys).
+#    Parameters sharing a GET request are all answered.
+# 3) RTC get/set, keepalive echo, roof and aux relay commands.
+# 4) '(@Hpppp)' bulk dumps of flash page pppp: 24 hourly records of
+#    maxima, minima and timestamp. Page 0 holds the last 24 hours,
+#    page p the 24 hours before page p-1, so that any walk over a page
+#    range sees contiguous hourly records.
+# 5) Unsolicited photometer and thermopile readings, on startup and
+#    every READINGS seconds.
+#
+# Requests may be lost with a given probability and responses are
+# delayed by a given latency plus a random jitter, to reproduce a
+# busy EMA. A seed makes runs reproducible.
+#
+# Simulator is a Lazy and readable object, so it runs in any Server
+# reactor. 'python -m ema.sim' runs it standalone with epoll.
+#
+# ======================================================================
+
+import os
+import re
+import pty
+import tty
+import fcntl
+import errno
+import heapq
+import random
+import logging
+import datetime
+
+from server    import Lazy, monotonic
+from serdriver import FrameDecoder
+from emaproto  import PERIOD, MTCUR, StatusFrame
+
+import dev.watchdog    as wdog
+import dev.voltmeter   as volt
+import dev.barometer   as barom
+import dev.rain        as rain
+import dev.cloudpelt   as cloud
+import dev.pyranometer as pyran
+import dev.photometer  as photom
+import dev.thermometer as thermom
+import dev.anemometer  as anemom
+import dev.pluviometer as pluviom
+import dev.relay       as relay
+
+log = logging.getLogger('sim')
+
+DEVICES = (wdog, volt, barom, rain, cloud, pyran, photom, thermom, anemom, pluviom, relay)
+
+
+def descriptors(modules=DEVICES):
+   '''Returns the parameter descriptors declared in device modules'''
+   result = []
+   for module in modules:
+      for name in sorted(vars(module)):
+         obj = getattr(module, name)
+         if isinstance(obj, dict) and 'get' in obj and 'set' in obj and 'pat' in obj:
+            result.append(obj)
+   return result
+
+
+# Roof and Aux relay commands: (status change, second response line)
+TSTAMP = '(%H:%M:%S %d/%m/%Y)'
+RELAY = {
+   '(X007)' : (('roof', 'A'), '(%H:%M:%S Abrir Obs. FORZADO)'),
+   '(X000)' : (('roof', 'C'), '(%H:%M:%S Cerrar Obs.)'),
+   '(S005)' : (('aux',  'E'), '(%H:%M:%S Calentador on.)'),
+   '(S004)' : (('aux',  'A'), '(%H:%M:%S Calentador off.)'),
+   '(S009)' : (None,          '(%H:%M:%S %d/%m/%Y Timer ON)'),
+   '(S008)' : (None,          '(%H:%M:%S %d/%m/%Y Timer OFF)'),
+}
+
+SETRTC = re.compile('\(Y(\d{12})\)')
+BULK   = re.compile('\(@H(\d{4})\)')
+
+
+
+class Simulator(Lazy):
+
+   TICK       = 0.005      # seconds between output checks
+   MAXPENDING = 65536      # output bytes kept while the daemon does not read
+   READINGS   = 10         # seconds between photometer & thermopile readings
+
+   def __init__(self, rate=1.0/PERIOD, loss=0.0, latency=0.0, jitter=0.0, seed=None):
+      Lazy.__init__(self, Simulator.TICK)
+      self.rate     = rate
+      self.loss     = loss
+      self.latency  = latency
+      self.jitter   = jitter
+      self.random   = random.Random(seed)
+      self.master, self.slave = pty.openpty()
+      tty.setraw(self.master)
+      tty.setraw(self.slave)
+      flags = fcntl.fcntl(self.master, fcntl.F_GETFL)
+      fcntl.fcntl(self.master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+      self.port     = os.ttyname(self.slave)
+      self.nframes  = 0        # status messages sent
+      self.nrequests = 0       # requests received
+      self.nlost    = 0        # requests ignored on purpose
+      self.noverrun = 0        # status messages dropped, daemon not reading
+      self.__decoder = FrameDecoder()
+      self.__pending = bytearray()
+      self.__delayed = []      # heap of [due time, seq, response]
+      self.__seq     = 0
+      self.__t0      = monotonic()
+      self.__reading = self.__t0  # next unsolicited readings
+      self.__clock   = datetime.timedelta(0)   # RTC - UTC
+      self.__gets    = {}      # GET request -> descriptors
+      self.__sets    = []      # (regexp, descriptor)
+      self.values    = {}      # descriptor name -> value
+      for desc in descriptors():
+         self.__gets.setdefault(desc['get'], []).append(desc)
+         self.__sets.append((re.compile(desc['pat']), desc))
+         self.values[desc['name']] = 0
+      self.status = StatusFrame('C', 'A', 130, 0, 50, '10130', 9500, 0, 0,
+                                100, '18.50', 150, 60, 70, 10, 20, 180, MTCUR, None)
+      log.info("EMA simulator on %s, %g status/s, loss %g, latency %g+%g s",
+               self.port, rate, loss, latency, jitter)
+
+   # ----------------------------
+   # Readable and Lazy interfaces
+   # ----------------------------
+
+   def fileno(self):
+      return self.master
+
+
+   def onInput(self):
+      try:
+         data = os.read(self.master, 4096)
+      except OSError as e:
+         if e.errno in (errno.EAGAIN, errno.EINTR):
+            return
+         raise
+      for message in self.__decoder.feed(data):
+         self.onRequest(message)
+      self.flush(monotonic())
+
+
+   def work(self):
+      now = monotonic()
+      if now >= self.__reading:
+         self.__reading = now + Simulator.READINGS
+         self.__pending.extend(self.readings())
+      due = int((now - self.__t0) * self.rate) + 1
+      while self.nframes < due:
+         self.nframes += 1
+         if len(self.__pending) < Simulator.MAXPENDING:
+            self.__pending.extend(self.frame())
+         else:
+            self.noverrun += 1
+      self.flush(now)
+
+   # ------------------
+   # Protocol emulation
+   # ------------------
+
+   def now(self):
+      '''EMA RTC time'''
+      return datetime.datetime.utcnow() + self.__clock
+
+
+   def onRequest(self, message):
+      self.nrequests += 1
+      log.debug("Rx %s", message)
+      if self.loss and self.random.random() < self.loss:
+         self.nlost += 1
+         return
+      responses = self.respond(message)
+      if not responses:
+         return
+      delay = self.latency + self.jitter * self.random.random()
+      self.__seq += 1
+      heapq.heappush(self.__delayed, [monotonic() + delay, self.__seq, ''.join(responses)])
+
+
+   def respond(self, message):
+      '''Returns the list of response messages to message'''
+      if message == '( )':
+         return [message]
+      if message == '(y)':
+         return [self.now().strftime(TSTAMP)]
+      matched = SETRTC.match(message)
+      if matched:
+         rtc = datetime.datetime.strptime(matched.group(1), '%d%m%y%H%M%S')
+         self.__clock = rtc - datetime.datetime.utcnow()
+         return [self.now().strftime(TSTAMP)]
+      matched = BULK.match(message)
+      if matched:
+         return self.bulk(int(matched.group(1)))
+      if message in self.__gets:
+         return [desc['set'] % self.values[desc['name']] for desc in self.__gets[message]]
+      responses = []
+      for regexp, desc in self.__sets:
+         matched = regexp.match(message)
+         if matched:
+            self.values[desc['name']] = int(matched.group(desc['grp']))
+            responses.append(message)
+            break
+      if message in RELAY:
+         change, line = RELAY[message]
+         if change:
+            self.status = self.status._replace(**dict([change]))
+         responses[:] = [message, self.now().strftime(line)]
+      return responses
+
+
+   def bulk(self, page):
+      '''24 hourly records of maxima, minima and timestamp in flash page'''
+      t0 = self.now().replace(minute=0, second=0, microsecond=0)
+      t0 -= datetime.timedelta(hours=24*(page + 1) - 1)
+      responses = []
+      for i in range(24):
+         t = t0 + datetime.timedelta(hours=i)
+         hhmm = t.strftime('%H%M')
+         responses.append(self.nextStatus()._replace(mtype='M').encode(hhmm))
+         responses.append(self.nextStatus()._replace(mtype='m').encode(hhmm))
+         responses.append(t.strftime(TSTAMP))
+      return responses
+
+
+   def readings(self):
+      '''Unsolicited photometer and thermopile readings'''
+      t = self.now().strftime('%H:%M:%S')
+      return '(%s wait)(%s mv:%s)(>100 %+.2f)(>101 %+.2f)' % (t, t,
+         self.status.photometer, self.status.ambient/10.0 - 20, self.status.ambient/10.0)
+
+
+   def frame(self):
+      '''Next status message to send'''
+      return self.nextStatus().encode()
+
+
+   def nextStatus(self):
+      '''Next status readings, a random walk within plausible ranges'''
+      walk = lambda v, lo, hi: min(max(v + self.random.randint(-1, 1), lo), hi)
+      s = self.status
+      self.status = s._replace(
+         ambient     = walk(s.ambient, -150, 400),
+         humidity    = walk(s.humidity, 0, 100),
+         dewpoint    = walk(s.dewpoint, -150, 300),
+         abspressure = walk(s.abspressure, 9000, 9999),
+         windcurrent = walk(s.windcurrent, 0, 999),
+         winddir     = walk(s.winddir, 0, 359),
+         cloud       = walk(s.cloud, 0, 100),
+      )
+      return self.status
+
+   # --------------
+   # Helper methods
+   # --------------
+
+   def flush(self, now):
+      '''Writes due responses and pending output as far as possible'''
+      while self.__delayed and self.__delayed[0][0] <= now:
+         response = heapq.heappop(self.__delayed)[2]
+         log.debug("Tx %s", response)
+         self.__pending.extend(response)
+      if not self.__pending:
+         return
+      try:
+         n = os.write(self.master, self.__pending)
+      except OSError as e:
+         if e.errno not in (errno.EAGAIN, errno.EINTR):
+            raise
+         n = 0
+      del self.__pending[:n]
+
+
+   def stats(self):
+      return {
+         'frames'   : self.nframes,
+         'requests' : self.nrequests,
+         'lost'     : self.nlost,
+         'overrun'  : self.noverrun,
+      }
+
+
+   def close(self):
+      os.close(self.master)
+      os.close(self.slave)
+
+
+
+if __name__ == "__main__":
+
+   import argparse
+   import server
+   from logger import logToConsole
+
+   _parser = argparse.ArgumentParser(prog='ema.sim')
+   _parser.add_argument('-r', '--rate', type=float, default=1.0/PERIOD, help='status messages per second')
+   _parser.add_argument('-l', '--loss', type=float, default=0.0, help='request loss probability')
+   _parser.add_argument('-d', '--latency', type=float, default=0.0, help='response latency in seconds')
+   _parser.add_argument('-j', '--jitter', type=float, default=0.0, help='max. random extra latency in seconds')
+   _parser.add_argument('-s', '--seed', type=int, default=None, help='random seed')
+   _parser.add_argument('-p', '--link', type=str, default=None, metavar='<path>', help='symbolic link to the serial port')
+   _parser.add_argument('-c', '--check', action='store_true', help='check bulk dumps over a page range and exit')
+   opts = _parser.parse_args()
+
+   logToConsole()
+
+   if opts.check:
+      # Walks pages the way BulkDump does, including both ends of the
+      # page range, and verifies that every page decodes and that
+      # consecutive pages hold contiguous hourly records.
+      import sys
+      import minmax
+      sim = Simulator(seed=opts.seed)
+      failed = False
+      newer  = None
+      for page in [0] + range(295, 425) + [9998, 9999]:
+         lines = sim.respond('(@H%04d)' % page)
+         batch = minmax.decode(lines)
+         times = batch.time.tolist()
+         ok = len(batch) == 24 and all(b - a == 3600 for a, b in zip(times, times[1:]))
+         if newer is not None and newer[0] == page - 1:
+            ok = ok and times[-1] + 3600 == newer[1]
+         newer = (page, times[0])
+         if not ok:
+            log.error("Bulk dump of page %d is not 24 contiguous hourly records", page)
+            failed = True
+      sim.close()
+      log.info("Bulk dump check %s", "FAILED" if failed else "OK")
+      sys.exit(1 if failed else 0)
+
+   sim = Simulator(opts.rate, opts.loss, opts.latency, opts.jitter, opts.seed)
+   if opts.link:
+      if os.path.islink(opts.link):
+         os.unlink(opts.link)
+      os.symlink(sim.port, opts.link)
+   print sim.port
+   s = server.Server()
+   s.setReactor('epoll')
+   s.addLazy(sim)
+   s.addReadable(sim)
+   try:
+      s.run()
+   finally:
+      log.info("%s", sim.stats())
+      if opts.link:
+         os.unlink(opts.link)
@@ -60,14 +60,35 @@
 # to the sender IP+port to allow simultaneous commands from 
 # several programs.
 #
+# Each origin with a partial message has its own FrameDecoder (see
+# serdriver), so all messages in a datagram are extracted in a single
+# pass without copying the buffer after every message. Decoders are
+# dropped as soon as they are empty. Partial messages are bounded in
+# length by FrameDecoder, in number by MAXORIGINS and in age by MAXAGE,
+# so that fragments from dead or misbehaving senders in the LAN do not
+# make the daemon grow forever.
+#
+# The socket is non blocking and every readable event drains all
+# pending datagrams, up to MAXBATCH, with recvfrom_into() into a pool
+# of preallocated buffers, instead of costing one reactor iteration
+# per datagram. Datagrams left over are read in the next iteration.
+# Batch sizes per drain are accounted in power of two buckets and
+# logged by show(), to see how bursty the traffic is.
+#
+# Being non blocking, sendto() may fail with EAGAIN or ENOBUFS on
+# bursts of outgoing datagrams (i.e. chunked query replies). They are
+# counted as lost and the datagram is dropped, as UDP would do anyway.
 # ======================================================================
 
 
-import re
+import errno
 import struct
 import socket
 import logging
 
+from server    import monotonic
+from serdriver import FrameDecoder
+
 log = logging.getLogger('udpdriver')
 
 def udpsocket(rx_port, mcast_ip=None):
@@ -82,22 +103,92 @@ def udpsocket(rx_port, mcast_ip=None):
       sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
    return sock       
 
+class Reassembler(object):
+   '''
+   Reassembles EMA messages from chunks of several origins.
+   '''
+
+   MAXAGE     = 30   # seconds a partial message may wait for the rest
+   MAXORIGINS = 64   # max. origins with partial messages
+
+   def __init__(self, maxlen=FrameDecoder.MAXLEN, maxage=MAXAGE, maxorigins=MAXORIGINS):
+      self.__decoders  = {}     # origin -> [FrameDecoder, last seen]
+      self.__lastsweep = monotonic()
+      self.maxlen      = maxlen
+      self.maxage      = maxage
+      self.maxorigins  = maxorigins
+      self.ndropped    = 0      # bytes discarded from deleted decoders
+      self.nevicted    = 0      # partial messages evicted
+
+
+   def feed(self, data, origin):
+      '''
+      Appends data to origin buffer.
+      Returns a list with all complete messages found.
+      '''
+      now   = monotonic()
+      entry = self.__decoders.get(origin)
+      if entry is None:
+         entry = [FrameDecoder(self.maxlen), now]
+      frames = entry[0].feed(data)
+      if len(entry[0]):
+         entry[1] = now
+         if origin not in self.__decoders:
+            if len(self.__decoders) >= self.maxorigins:
+               self.evict(min(self.__decoders, key=lambda k: self.__decoders[k][1]))
+            self.__decoders[origin] = entry
+      else:
+         self.__decoders.pop(origin, None)
+         self.ndropped += entry[0].ndropped
+      if now - self.__lastsweep >= 1:
+         self.__lastsweep = now
+         self.expire(now)
+      return frames
+
+
+   def expire(self, now):
+      '''Evicts partial messages older than maxage seconds'''
+      for origin, (decoder, seen) in self.__decoders.items():
+         if now - seen > self.maxage:
+            self.evict(origin)
+
+
+   def evict(self, origin):
+      decoder, seen = self.__decoders.pop(origin)
+      self.ndropped += decoder.ndropped + len(decoder)
+      self.nevicted += 1
+      log.debug("evicted %d bytes partial message from %s", len(decoder), origin)
+
+
+   def pending(self):
+      '''Returns a dictionary with pending bytes per origin'''
+      return dict((origin, len(entry[0])) for origin, entry in self.__decoders.iteritems())
+
+
+
 class UDPDriver(object):
 
-   NSTATS = 100  # Print number of reads ecah NSTATs times
+   NSTATS   = 100   # Print number of reads ecah NSTATs times
+   MAXDGRAM = 1024  # Max. datagram size
+   MAXBATCH = 32    # Max. datagrams read per readable event
 	
    def __init__(self, ip, rx_port, tx_port, **kargs):
       self.__nreads   = 0
       self.__nwrites  = 0
-      self.__buffer   = {}
+      self.__nlost    = 0        # datagrams not sent, socket busy
+      self.__ndrains  = 0
+      self.__batches  = {}       # batch size bucket -> count
+      self.__maxbatch = 0
+      self.__pool     = [bytearray(UDPDriver.MAXDGRAM) for i in range(UDPDriver.MAXBATCH)]
+      self.__views    = [memoryview(buf) for buf in self.__pool]
+      self.__buffer   = Reassembler()
       self.__handlers = []
       self.__ip       = ip
       self.__rx_port  = rx_port
       self.__tx_port  = tx_port
-      # An EMA message, surronded by brackets
-      self.__patt     = re.compile('\([^)]+\)') 
       try:
          self.__sock = udpsocket(rx_port, ip)
+         self.__sock.setblocking(0)
       except Exception as e:
          log.error(e)
          raise
@@ -116,8 +207,12 @@ class UDPDriver(object):
       try:
          self.__sock.sendto(data,(ip, self.__tx_port))
          self.__nwrites += 1
-      except socket.error, msg:
-         log.error(msg)
+      except socket.error, e:
+         if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+            self.__nlost += 1
+            log.warning("Tx to '%s' dropped: %s", (ip, self.__tx_port), e)
+            return
+         log.error(e)
          raise
 
    def addHandler(self, object):
@@ -128,46 +223,62 @@ class UDPDriver(object):
    # Helper methods
    # --------------
 
-   def read(self):
+   def drain(self):
       '''
-      Reads from UDP socket. 
-      Return (data, origin) tuple, where origin is itsel a tuple.
+      Reads all pending datagrams from UDP socket, up to MAXBATCH.
+      Return a list of (data, origin) tuples, where origin is itsel a tuple.
       '''
-      try:
-         data, origin = self.__sock.recvfrom(1024)
+      batch = []
+      for view in self.__views:
+         try:
+            nbytes, origin = self.__sock.recvfrom_into(view)
+         except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+               break
+            log.error(e)
+            raise
+         data = view[:nbytes].tobytes()
          log.debug("Rx %s from '%s'", data, origin)
-         return data, origin
-      except socket.error, msg:
-         log.error(msg)
-         raise
+         batch.append((data, origin))
+      self.account(len(batch))
+      return batch
 
-      
-   def extract(self, origin):
+
+   def account(self, n):
+      '''Accounts a drain of n datagrams in power of two buckets'''
+      self.__ndrains += 1
+      self.__maxbatch = max(self.__maxbatch, n)
+      bucket = 1 << (n.bit_length() - 1) if n else 0
+      self.__batches[bucket] = self.__batches.get(bucket, 0) + 1
+
+
+   def batchStats(self):
       '''
-      Extracts a complete EMA message
-      Returns whole message if available or null string if not.
+      Returns (number of drains, max batch size, histogram) where
+      histogram maps batch size buckets (0, 1, 2-3, 4-7, ...) to counts
       '''
-      message = ''
-      matched = None
-      if origin in self.__buffer:
-         matched = self.__patt.search(self.__buffer[origin])
+      return (self.__ndrains, self.__maxbatch, dict(self.__batches))
+
 
-      if matched:
-         message = matched.group()
-         self.__buffer[origin] = self.__buffer[origin][matched.end():]
-         log.debug("extracted %s, remains %s", message, self.__buffer[origin] if self.__buffer[origin] else None)
-         if not self.__buffer[origin]:
-            del self.__buffer[origin]
-         self.__nreads += 1
-      return message
+   def counters(self):
+      '''Returns a dictionary of read/written message counters'''
+      return {
+         'reads'    : self.__nreads,
+         'writes'   : self.__nwrites,
+         'lost'     : self.__nlost,
+         'dropped'  : self.__buffer.ndropped,
+         'drains'   : self.__ndrains,
+         'maxbatch' : self.__maxbatch,
+      }
 
 
    def show(self):
       '''print read/written message statistcs every NSTATs times'''
-      n = max(self.__nreads, self.__nwrites) % MulticastDriver.NSTATS
+      n = max(self.__nreads, self.__nwrites) % UDPDriver.NSTATS
       if not n:
-         log.info("nreads = %d, nwrites = %d, buffer =%s", 
-                  self.__nreads, self.__nwrites, self.__buffer)
+         log.info("nreads = %d, nwrites = %d, buffer =%s, dropped = %d bytes",
+                  self.__nreads, self.__nwrites, self.__buffer.pending(), self.__buffer.ndropped)
+         log.info("drains = %d, max batch = %d, batches = %s", *self.batchStats())
 
 
    def onInput(self):
@@ -175,18 +286,11 @@ class UDPDriver(object):
       Update message buffer and notify 
       if necessary by invoking onUDPMessage()
       '''
-      chunk, origin  = self.read()
-      if origin in self.__buffer:
-         self.__buffer[origin] += chunk               # accumulate reading
-      else:
-         self.__buffer[origin] = chunk
-
-      # Loop: May be 1+ messages in buffer, process all until none.
-      message = self.extract(origin) # extract whole message
-      while message:
-         for handler in self.__handlers:
-            handler.onUDPMessage(message, origin)
-         message = self.extract(origin) # extract whole message
+      for chunk, origin in self.drain():
+         for message in self.__buffer.feed(chunk, origin):
+            self.__nreads += 1
+            for handler in self.__handlers:
+               handler.onUDPMessage(message, origin)
 
 
    def fileno(self):
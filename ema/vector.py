@@ -40,13 +40,38 @@
 # 3) Compute the sum of the entire array or a given slice.
 # 4) inform about the actual sum and vector length 
 #
-# In a future we could add a vector of timestamps alongside 
-# with the samples, if this is necessary to identifysamples in a
-# bulk dump.
+# Timestamped samples are kept on disk by the history store (see
+# history.py), which is also used to rehydrate vectors at startup.
+#
+# The vector is a fixed size ring buffer over a typed array.array
+# ('l' for integer readings, 'd' for float ones, 'b' for flags), so
+# that appending a sample is O(1) no matter how long upload_period is.
+# Running sums are kept for the whole vector and for an optional
+# sub-window (i.e. the voltmeter low voltage check), so both sum()
+# calls are O(1) as well. Other sub-window sizes are summed on demand.
+# Float running sums are recomputed every N samples to avoid the
+# accumulation of rounding errors.
+#
+# min() and max() are also O(1) (amortized), using monotonic deques
+# of (sequence number, value) pairs which drop samples that can no
+# longer be the minimum or maximum of the window.
+#
+# On top of that, a streaming statistics layer is maintained as
+# samples come and go, so that devices can publish more than a mean
+# without rescanning the window:
+# - mean and variance with Welford's algorithm, extended to remove
+#   the sample leaving the window. Recomputed every N samples as well.
+# - an exponentially weighted moving average with a half-life given
+#   in samples (HALFLIFE class default, N/2 if not set).
+# - approximate percentiles from a histogram sketch of the window with
+#   buckets 'resolution' wide (exact for integer readings by default).
 #
 # ======================================================================
 
+import math
+import array
 import logging
+from   collections import deque
 
 log = logging.getLogger('vector')
 
@@ -56,31 +81,197 @@ class Vector(object):
 	to calculate moving average
 	"""
 
+	HALFLIFE = None    # Default EWMA half-life, in samples
 
-	def __init__(self, N):
-		'''Initializes a vector with max size N'''
+	def __init__(self, N, typecode='l', window=None, halflife=None, resolution=None):
+		'''
+		Initializes a vector with max size N of typecode samples
+		keeping also a running sum of the last window samples,
+		an EWMA with halflife (in samples) and a percentile sketch
+		with resolution wide buckets
+		'''
 		self.N       = N
+		self.window  = min(window, N) if window else None
 		self.accum   = 0
-		self.samples = []
+		self.waccum  = 0
+		self.samples = array.array(typecode, [0]*N)
+		self.__float = typecode in 'fd'
+		self.__head  = 0         # next position to write
+		self.__count = 0         # samples in vector
+		self.__seq   = 0         # samples ever appended
+		self.__mins  = deque()   # increasing values candidates to min
+		self.__maxs  = deque()   # decreasing values candidates to max
+		self.__mean  = 0.0       # Welford mean
+		self.__m2    = 0.0       # Welford sum of squared deviations
+		self.__ewma  = None
+		halflife     = halflife or Vector.HALFLIFE or N/2.0
+		self.alpha   = 1.0 - 0.5 ** (1.0/halflife)
+		self.resolution = resolution or (0.01 if self.__float else 1)
+		self.__sketch   = {}     # bucket -> samples in window
 
 
 	def append(self, sample):
 		'''append a sample to the vector and move the window if necessary'''
-		self.samples.append(sample)
-		self.accum += sample
-		if len(self.samples) > self.N:
-			pop = self.samples[0]
-			self.accum -= self.samples.pop(0)
+		N       = self.N
+		i       = self.__head
+		samples = self.samples
+		if self.window and self.__count >= self.window:
+			self.waccum -= samples[i - self.window]
+		if self.__count == N:
+			self.accum -= samples[i]
+			self.__leave(samples[i])
+		samples[i] = sample
+		sample = samples[i]                    # as stored in the array
+		self.accum  += sample
+		if self.window:
+			self.waccum += sample
+		self.__enter(sample)
+		self.__head  = (i + 1) % N
+		self.__seq  += 1
+		seq = self.__seq
+
+		mins = self.__mins
+		while mins and mins[-1][1] >= sample:
+			mins.pop()
+		mins.append((seq, sample))
+		if mins[0][0] <= seq - N:
+			mins.popleft()
+		maxs = self.__maxs
+		while maxs and maxs[-1][1] <= sample:
+			maxs.pop()
+		maxs.append((seq, sample))
+		if maxs[0][0] <= seq - N:
+			maxs.popleft()
+
+		if seq % N == 0:
+			if self.__float:
+				self.accum  = self.__tail(N)
+				if self.window:
+					self.waccum = self.__tail(self.window)
+			self.__mean = self.accum / float(N)
+			self.__m2   = math.fsum((x - self.__mean)**2 for x in samples)
+
+
+	def __enter(self, x):
+		'''Accounts a sample entering the window'''
+		self.__count += 1
+		delta = x - self.__mean
+		self.__mean += delta / self.__count
+		self.__m2   += delta * (x - self.__mean)
+		self.__ewma  = x if self.__ewma is None else self.__ewma + self.alpha * (x - self.__ewma)
+		bucket = int(math.floor(x / self.resolution))
+		self.__sketch[bucket] = self.__sketch.get(bucket, 0) + 1
+
+
+	def __leave(self, x):
+		'''Accounts a sample leaving the window'''
+		self.__count -= 1
+		if self.__count:
+			delta = x - self.__mean
+			self.__mean -= delta / self.__count
+			self.__m2    = max(0.0, self.__m2 - delta * (x - self.__mean))
+		else:
+			self.__mean = self.__m2 = 0.0
+		bucket = int(math.floor(x / self.resolution))
+		n = self.__sketch[bucket] - 1
+		if n:
+			self.__sketch[bucket] = n
+		else:
+			del self.__sketch[bucket]
+
+
+	def extend(self, samples):
+		'''append samples in order, i.e. to rehydrate the vector'''
+		for sample in samples:
+			self.append(sample)
 
 
 	def last(self):
 		'''Returns the newest sample added'''
-		return self.samples[-1]
+		if not self.__count:
+			raise IndexError("empty vector")
+		return self.samples[self.__head - 1]
 
 
 	def len(self):
 		'''Returns the vector length'''
-		return len(self.samples)
+		return self.__count
+
+
+	def min(self):
+		'''Returns the minimum sample in vector'''
+		if not self.__count:
+			raise ValueError("empty vector")
+		return self.__mins[0][1]
+
+
+	def max(self):
+		'''Returns the maximum sample in vector'''
+		if not self.__count:
+			raise ValueError("empty vector")
+		return self.__maxs[0][1]
+
+
+	def mean(self):
+		'''Returns the mean of samples in vector'''
+		if not self.__count:
+			raise ValueError("empty vector")
+		return self.__mean
+
+
+	def variance(self):
+		'''Returns the sample variance in vector'''
+		n = self.__count
+		return self.__m2 / (n - 1) if n > 1 else 0.0
+
+
+	def stddev(self):
+		'''Returns the sample standard deviation in vector'''
+		return math.sqrt(self.variance())
+
+
+	def ewma(self):
+		'''Returns the exponentially weighted moving average'''
+		if self.__ewma is None:
+			raise ValueError("empty vector")
+		return self.__ewma
+
+
+	def percentile(self, p):
+		'''
+		Returns the approximate p-th percentile (0-100) of samples
+		in vector, within resolution
+		'''
+		if not self.__count:
+			raise ValueError("empty vector")
+		rank = max(1, int(math.ceil(p * self.__count / 100.0)))
+		seen = 0
+		for bucket in sorted(self.__sketch):
+			seen += self.__sketch[bucket]
+			if seen >= rank:
+				break
+		if self.__float:
+			return (bucket + 0.5) * self.resolution
+		return bucket * self.resolution
+
+
+	def stats(self, scale=1):
+		'''
+		Returns a dictionary with the rolling statistics of samples
+		in vector, divided by scale
+		'''
+		scale = float(scale)
+		return {
+			'n'      : self.__count,
+			'mean'   : self.mean()   / scale,
+			'stddev' : self.stddev() / scale,
+			'min'    : self.min()    / scale,
+			'max'    : self.max()    / scale,
+			'ewma'   : self.ewma()   / scale,
+			'p10'    : self.percentile(10) / scale,
+			'p50'    : self.percentile(50) / scale,
+			'p90'    : self.percentile(90) / scale,
+		}
 
 
 	def sum(self, N=None):
@@ -89,10 +280,20 @@ class Vector(object):
 		and vector length. 
 		If N is supplied, returns min(N, vector size)
 		'''
-		if not N: 
-			return (self.accum, len(self.samples))
-		else:
-			return (sum(self.samples[-N:]), min(N,len(self.samples)))
+		if not N or N >= self.N:
+			return (self.accum, self.__count)
+		n = min(N, self.__count)
+		if N == self.window:
+			return (self.waccum, n)
+		return (self.__tail(n), n)
+
+
+	def __tail(self, n):
+		'''Sums the newest n samples, n <= vector length'''
+		i = self.__head
+		if n <= i:
+			return sum(self.samples[i-n:i])
+		return sum(self.samples[i-n:]) + sum(self.samples[:i])
 
 
 if __name__ == '__main__':